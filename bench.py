@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+"""
+HTTP level benchmarks for napfs.
+
+Drives the app built by `napfs.create_app` through `falcon.testing` and
+through a real local server, with redislite or sqlite as the metadata
+store. Results are written out as json so two runs can be compared:
+
+    python bench.py --output baseline.json
+    ... make changes ...
+    python bench.py --output new.json --compare baseline.json
+
+To compare the metadata backends on the PATCH path:
+
+    python bench.py --scenario patch --backend redis --backend sqlite
+"""
+
+# std lib imports
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+# 3rd party
+import falcon
+import falcon.testing
+import redislite
+
+# import library
+import napfs
+
+
+class FalconClient(object):
+    """
+    calls the wsgi app in-process through falcon.testing.
+    """
+    name = 'falcon'
+
+    def __init__(self, app):
+        self.client = falcon.testing.TestClient(app)
+
+    def request(self, method, path, body=None, headers=None):
+        res = self.client.simulate_request(
+            method=method, path=path.split('?')[0],
+            query_string=path.partition('?')[2],
+            body=body, headers=headers)
+        return res.status_code, res.content
+
+    def close(self):
+        pass
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ServerClient(object):
+    """
+    runs the wsgi app in a real threaded http server on localhost and talks
+    to it over sockets.
+    """
+    name = 'server'
+
+    def __init__(self, app):
+        self.httpd = make_server('127.0.0.1', 0, app,
+                                 server_class=_ThreadingWSGIServer,
+                                 handler_class=_QuietHandler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            res = conn.getresponse()
+            return res.status, res.read()
+        finally:
+            conn.close()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+TRANSPORTS = {
+    'falcon': FalconClient,
+    'server': ServerClient,
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def summarize(latencies, elapsed, nbytes):
+    return {
+        'count': len(latencies),
+        'elapsed': elapsed,
+        'ops_per_sec': len(latencies) / elapsed if elapsed else 0.0,
+        'mb_per_sec': nbytes / elapsed / 1024 / 1024 if elapsed else 0.0,
+        'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+        'min': min(latencies) if latencies else 0.0,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies) if latencies else 0.0,
+    }
+
+
+def timed(client, method, path, body=None, headers=None, expect=None):
+    start = time.perf_counter()
+    status, content = client.request(method, path, body=body,
+                                     headers=headers)
+    latency = time.perf_counter() - start
+    if expect is not None and status not in expect:
+        raise RuntimeError('%s %s returned %s' % (method, path, status))
+    return latency, content
+
+
+def run_concurrently(fn, jobs, concurrency):
+    """
+    call fn for every item in jobs, spread across `concurrency` threads.
+    returns the latencies and the wall clock time for the whole batch.
+    """
+    start = time.perf_counter()
+    if concurrency <= 1:
+        latencies = [fn(job) for job in jobs]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            latencies = list(pool.map(fn, jobs))
+    return latencies, time.perf_counter() - start
+
+
+def new_path(prefix):
+    return '/bench/%s/%s.bin' % (prefix, uuid.uuid4().hex)
+
+
+def upload(client, path, content):
+    timed(client, 'POST', path, body=content, expect=(200,))
+
+
+def bench_get(client, args, rng):
+    content = os.urandom(args.file_size)
+    path = new_path('get')
+    upload(client, path, content)
+    variants = [
+        ('get_full', {}),
+        ('get_range', {'Range': 'bytes=%d-%d' % (
+            args.file_size // 4, args.file_size // 2)}),
+        ('get_checksum', {'x-checksum': 'sha256'}),
+    ]
+    for name, headers in variants:
+        _, body = timed(client, 'GET', path, headers=headers)
+        for concurrency in args.concurrency:
+            def fn(_):
+                latency, _ = timed(client, 'GET', path, headers=headers,
+                                   expect=(200, 206))
+                return latency
+
+            latencies, elapsed = run_concurrently(
+                fn, range(args.iterations), concurrency)
+            yield name, {'file_size': args.file_size,
+                         'concurrency': concurrency}, \
+                summarize(latencies, elapsed, len(body) * len(latencies))
+
+
+def bench_post(client, args, rng):
+    content = os.urandom(args.file_size)
+    for concurrency in args.concurrency:
+        def fn(_):
+            latency, _ = timed(client, 'POST', new_path('post'),
+                               body=content, expect=(200,))
+            return latency
+
+        latencies, elapsed = run_concurrently(
+            fn, range(args.iterations), concurrency)
+        yield 'post', {'file_size': args.file_size,
+                       'concurrency': concurrency}, \
+            summarize(latencies, elapsed, len(content) * len(latencies))
+
+
+def bench_patch(client, args, rng):
+    for chunk_size in args.chunk_sizes:
+        chunk_count = max(1, args.file_size // chunk_size)
+        content = os.urandom(chunk_size * chunk_count)
+        for ordering in ('sequential', 'reverse', 'shuffled'):
+            offsets = [i * chunk_size for i in range(chunk_count)]
+            if ordering == 'reverse':
+                offsets.reverse()
+            elif ordering == 'shuffled':
+                rng.shuffle(offsets)
+
+            for concurrency in args.concurrency:
+                path = new_path('patch')
+
+                def fn(offset):
+                    latency, _ = timed(
+                        client, 'PATCH', '%s?offset=%d' % (path, offset),
+                        body=content[offset:offset + chunk_size],
+                        expect=(200,))
+                    return latency
+
+                latencies, elapsed = run_concurrently(
+                    fn, offsets, concurrency)
+                _, body = timed(client, 'GET', path, expect=(200,))
+                if body != content:
+                    raise RuntimeError('patch %s produced bad content' % path)
+                yield 'patch', {'chunk_size': chunk_size,
+                                'ordering': ordering,
+                                'concurrency': concurrency}, \
+                    summarize(latencies, elapsed, len(content))
+
+
+def bench_copy(client, args, rng):
+    content = os.urandom(args.file_size)
+    src = new_path('copy-src')
+    upload(client, src, content)
+    for concurrency in args.concurrency:
+        def fn(_):
+            latency, _ = timed(client, 'POST', new_path('copy-dst'),
+                               headers={'x-source': src}, expect=(200,))
+            return latency
+
+        latencies, elapsed = run_concurrently(
+            fn, range(args.iterations), concurrency)
+        yield 'copy', {'file_size': args.file_size,
+                       'concurrency': concurrency}, \
+            summarize(latencies, elapsed, len(content) * len(latencies))
+
+
+SCENARIOS = {
+    'get': bench_get,
+    'post': bench_post,
+    'patch': bench_patch,
+    'copy': bench_copy,
+}
+
+
+BACKENDS = ['redis', 'sqlite']
+
+
+def result_key(result):
+    return (result['name'], result['transport'],
+            result.get('backend', 'redis'),
+            json.dumps(result['params'], sort_keys=True))
+
+
+def compare(baseline, results, threshold):
+    """
+    print how each result moved against the baseline.
+    returns the number of results where p50 latency got worse by more than
+    `threshold` percent.
+    """
+    old = {result_key(r): r for r in baseline['results']}
+    regressions = 0
+    for r in results:
+        prev = old.get(result_key(r))
+        if prev is None or not prev['stats']['p50']:
+            continue
+        change = (r['stats']['p50'] / prev['stats']['p50'] - 1) * 100
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('%-8s %-7s %-6s %-60s p50 %+7.1f%%%s' % (
+            r['name'], r['transport'], r.get('backend', 'redis'),
+            json.dumps(r['params'], sort_keys=True), change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='napfs http benchmarks')
+    parser.add_argument('--transport', choices=sorted(TRANSPORTS),
+                        action='append',
+                        help='transport to use, can be given more than once. '
+                             'defaults to all of them')
+    parser.add_argument('--backend', choices=BACKENDS, action='append',
+                        help='metadata backend to use, can be given more '
+                             'than once. defaults to redis')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS),
+                        action='append',
+                        help='scenario to run, can be given more than once. '
+                             'defaults to all of them')
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='requests per measurement')
+    parser.add_argument('--file-size', type=int, default=1024 * 256,
+                        help='size of the files uploaded and read back')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+',
+                        default=[1024 * 4, 1024 * 64, 1024 * 256],
+                        help='chunk sizes used for PATCH uploads')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 4, 16],
+                        help='number of concurrent clients')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed for the shuffled PATCH orderings')
+    parser.add_argument('--output', help='write json results to this file')
+    parser.add_argument('--compare',
+                        help='json results of an earlier run to compare to')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percent slowdown in p50 flagged as regression')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='napfs-bench-')
+    data_dir = os.path.join(work_dir, 'data')
+    os.mkdir(data_dir)
+    redis_connection = redislite.StrictRedis(
+        dbfilename=os.path.join(work_dir, 'bench.db'))
+    backends = {
+        'redis': redis_connection,
+        'sqlite': napfs.SqliteBackend(os.path.join(work_dir, 'bench.sqlite')),
+    }
+
+    results = []
+    try:
+        for backend in args.backend or ['redis']:
+            for transport in args.transport or sorted(TRANSPORTS):
+                app = napfs.create_app(data_dir=data_dir,
+                                       redis_connection=backends[backend])
+                client = TRANSPORTS[transport](app)
+                try:
+                    for scenario in args.scenario or sorted(SCENARIOS):
+                        rng = random.Random(args.seed)
+                        for name, params, stats in SCENARIOS[scenario](
+                                client, args, rng):
+                            results.append({'name': name,
+                                            'transport': transport,
+                                            'backend': backend,
+                                            'params': params,
+                                            'stats': stats})
+                            print('%-8s %-7s %-6s %-60s p50 %.6f '
+                                  'ops/s %.1f' % (
+                                      name, transport, backend,
+                                      json.dumps(params, sort_keys=True),
+                                      stats['p50'], stats['ops_per_sec']))
+                finally:
+                    client.close()
+    finally:
+        backends['sqlite'].close()
+        redis_connection.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {
+        'meta': {
+            'napfs': napfs.__version__,
+            'falcon': falcon.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("")
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
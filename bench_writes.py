@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+"""
+Filesystem level write contention benchmarks for napfs.
+
+Writes files chunk by chunk through `napfs.fs.write_file_chunk` from many
+threads, many processes or a mix of both, with the chunks sent in order,
+in reverse or shuffled, and either side by side, overlapping their
+neighbours or all on the same bytes. Every file is read back and checked
+once written, so this doubles as the race condition check.
+
+Next to the latencies, each result has the time the writes spent waiting
+on the file locks against the time they held them, taken from
+`napfs.fs.lock_stats`. POSIX record locks belong to the process, so the
+threads of one process never wait on each other; that only shows up in
+the process and mixed modes. Results are written out as json so two runs
+can be compared:
+
+    python bench_writes.py --output baseline.json
+    ... change the locking ...
+    python bench_writes.py --output new.json --compare baseline.json
+
+To see how a filesystem copes, point it at a directory on it:
+
+    python bench_writes.py --dir /mnt/nfs/tmp --mode processes
+"""
+
+# std lib imports
+import argparse
+import concurrent.futures
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+# import library
+import napfs
+import napfs.fs
+from bench import summarize
+
+
+def split_workers(mode, concurrency):
+    """
+    :return: tuple of the number of processes and threads per process
+    """
+    if mode == 'threads':
+        return 1, concurrency
+    if mode == 'processes':
+        return concurrency, 1
+    processes = max(1, concurrency // 2)
+    return processes, concurrency // processes
+
+
+MODES = ['threads', 'processes', 'mixed']
+
+ORDERINGS = ['sequential', 'reverse', 'shuffled']
+
+
+def chunk_jobs(overlap, file_size, chunk_size):
+    """
+    lay the chunks of a file out.
+
+    adjacent chunks sit side by side, overlapping ones run half a chunk
+    into the next one, and same chunks all cover the first `chunk_size`
+    bytes.
+
+    :return: list of (offset, length)
+    """
+    count = max(1, file_size // chunk_size)
+    if overlap == 'same':
+        return [(0, chunk_size)] * count
+    offsets = [i * chunk_size for i in range(count)]
+    if overlap == 'adjacent':
+        return [(offset, chunk_size) for offset in offsets]
+    size = count * chunk_size
+    return [(offset, min(chunk_size + chunk_size // 2, size - offset))
+            for offset in offsets]
+
+
+OVERLAPS = ['adjacent', 'overlapping', 'same']
+
+
+def diff_stats(before, after):
+    stats = dict((k, after[k] - before[k]) for k in before)
+    stats['max_wait_seconds'] = after['max_wait_seconds']
+    return stats
+
+
+def merge_stats(stats):
+    merged = dict(stats[0])
+    for s in stats[1:]:
+        for k, v in s.items():
+            if k == 'max_wait_seconds':
+                merged[k] = max(merged[k], v)
+            else:
+                merged[k] += v
+    return merged
+
+
+def write_chunks(path, chunks, threads):
+    """
+    write the chunks into the file from `threads` threads. runs in the
+    worker processes.
+
+    :param path: str
+    :param chunks: list of (offset, bytes)
+    :param threads: int
+    :return: tuple of the latencies and the lock stats of the writes
+    """
+    before = napfs.fs.lock_stats.snapshot()
+
+    def write(chunk):
+        offset, data = chunk
+        start = time.perf_counter()
+        napfs.fs.write_file_chunk(path, io.BytesIO(data), offset, len(data))
+        return time.perf_counter() - start
+
+    if threads <= 1:
+        latencies = [write(chunk) for chunk in chunks]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+            latencies = list(pool.map(write, chunks))
+    return latencies, diff_stats(before, napfs.fs.lock_stats.snapshot())
+
+
+def _ready(_):
+    return os.getpid()
+
+
+def run(work_dir, mode, ordering, overlap, chunk_size, concurrency, args,
+        rng):
+    jobs = chunk_jobs(overlap, args.file_size, chunk_size)
+    content = os.urandom(max(offset + length for offset, length in jobs))
+    if ordering == 'reverse':
+        jobs.reverse()
+    elif ordering == 'shuffled':
+        rng.shuffle(jobs)
+    chunks = [(offset, content[offset:offset + length])
+              for offset, length in jobs]
+    path = os.path.join(work_dir, '%s.bin' % uuid.uuid4().hex)
+
+    processes, threads = split_workers(mode, concurrency)
+    if processes <= 1:
+        start = time.perf_counter()
+        results = [write_chunks(path, chunks, threads)]
+        elapsed = time.perf_counter() - start
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            # make sure every worker is up before the clock starts.
+            pool.map(_ready, range(processes))
+            start = time.perf_counter()
+            results = pool.starmap(write_chunks, [
+                (path, chunks[i::processes], threads)
+                for i in range(processes)])
+            elapsed = time.perf_counter() - start
+
+    with open(path, 'rb') as f:
+        if f.read() != content:
+            raise RuntimeError('%s %s %s writes of %d bytes produced bad '
+                               'content in %s' % (mode, ordering, overlap,
+                                                  chunk_size, path))
+    os.unlink(path)
+
+    latencies = [latency for r in results for latency in r[0]]
+    lock = merge_stats([r[1] for r in results])
+    held = lock['wait_seconds'] + lock['write_seconds']
+    lock['wait_share'] = lock['wait_seconds'] / held if held else 0.0
+    stats = summarize(latencies, elapsed,
+                      sum(len(data) for _, data in chunks))
+    stats['lock'] = lock
+    return stats
+
+
+def result_key(result):
+    return json.dumps(result['params'], sort_keys=True)
+
+
+def compare(baseline, results, threshold):
+    """
+    print how each result moved against the baseline.
+    returns the number of results where p50 latency got worse by more than
+    `threshold` percent.
+    """
+    old = {result_key(r): r for r in baseline['results']}
+    regressions = 0
+    for r in results:
+        prev = old.get(result_key(r))
+        if prev is None or not prev['stats']['p50']:
+            continue
+        change = (r['stats']['p50'] / prev['stats']['p50'] - 1) * 100
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('%-70s p50 %+7.1f%% wait %5.1f%% -> %5.1f%%%s' % (
+            result_key(r), change,
+            prev['stats']['lock']['wait_share'] * 100,
+            r['stats']['lock']['wait_share'] * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='napfs write contention benchmarks')
+    parser.add_argument('--mode', choices=MODES, action='append',
+                        help='run the writers in threads, processes or '
+                             'threads in several processes. can be given '
+                             'more than once, defaults to all of them')
+    parser.add_argument('--ordering', choices=ORDERINGS, action='append',
+                        help='order the chunks are written in, can be '
+                             'given more than once. defaults to all of them')
+    parser.add_argument('--overlap', choices=OVERLAPS, action='append',
+                        help='how the chunks lie against each other, can '
+                             'be given more than once. defaults to all of '
+                             'them')
+    parser.add_argument('--file-size', type=int, default=1024 * 1024,
+                        help='size of the files written')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+',
+                        default=[1024 * 4, 1024 * 64, 1024 * 256],
+                        help='chunk sizes to write the files in')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 4, 16],
+                        help='number of concurrent writers')
+    parser.add_argument('--dir',
+                        help='directory to write the files in, defaults to '
+                             'a temp dir')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed for the shuffled orderings')
+    parser.add_argument('--output', help='write json results to this file')
+    parser.add_argument('--compare',
+                        help='json results of an earlier run to compare to')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percent slowdown in p50 flagged as regression')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='napfs-bench-writes-', dir=args.dir)
+    results = []
+    try:
+        for mode in args.mode or MODES:
+            for ordering in args.ordering or ORDERINGS:
+                for overlap in args.overlap or OVERLAPS:
+                    for chunk_size in args.chunk_sizes:
+                        for concurrency in args.concurrency:
+                            rng = random.Random(args.seed)
+                            params = {'mode': mode,
+                                      'ordering': ordering,
+                                      'overlap': overlap,
+                                      'chunk_size': chunk_size,
+                                      'concurrency': concurrency}
+                            stats = run(work_dir, mode, ordering, overlap,
+                                        chunk_size, concurrency, args, rng)
+                            results.append({'name': 'write',
+                                            'params': params,
+                                            'stats': stats})
+                            print('%-70s p50 %.6f ops/s %.1f '
+                                  'contended %d wait %.1f%%' % (
+                                      json.dumps(params, sort_keys=True),
+                                      stats['p50'], stats['ops_per_sec'],
+                                      stats['lock']['contended'],
+                                      stats['lock']['wait_share'] * 100))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {
+        'meta': {
+            'napfs': napfs.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("")
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,52 @@
 import falcon
+from .admission import Admission
+from .cache import ObjectCache
+from .cluster import Cluster
+from .data import MetaDataBackend, RedisBackend
 from .instrumentation import trace, wrap_app
+from .jobs import Sweeper
+from .manifest import Manifests
+from .media import MediaIndexes
+from .metrics import Metrics
+from .profiling import Profiler, profiled
+from .peers import Peer
+from .replication import Replicator
 from .rest import Router
+from .shaping import Shaper, TokenBucket
+from .sharding import ShardedRedis, reshard
+from .sqlite_backend import SqliteBackend
+from .tiering import Tiering
 from .version import __version__  # noqa
+from .writebehind import WriteBehind
 
-__all__ = ['Router', 'create_app']
+__all__ = ['Router', 'ObjectCache', 'Metrics', 'Profiler', 'Sweeper',
+           'ShardedRedis', 'reshard', 'MetaDataBackend', 'RedisBackend',
+           'SqliteBackend', 'WriteBehind', 'Manifests', 'Shaper',
+           'TokenBucket', 'Admission', 'Replicator', 'Peer',
+           'Cluster', 'Tiering', 'MediaIndexes', 'create_app']
 
 group = "Python/napfs"
-Router.on_get = trace(Router.on_get, group=group)
-Router.on_post = trace(Router.on_post, group=group)
-Router.on_patch = trace(Router.on_patch, group=group)
-Router.on_delete = trace(Router.on_delete, group=group)
+Router.on_get = trace(profiled(Router.on_get), group=group)
+Router.on_post = trace(profiled(Router.on_post), group=group)
+Router.on_patch = trace(profiled(Router.on_patch), group=group)
+Router.on_delete = trace(profiled(Router.on_delete), group=group)
 
 
-def create_app(data_dir, redis_connection=None):
-    router = Router(data_dir=data_dir, redis_connection=redis_connection)
+def create_app(data_dir, redis_connection=None, **kwargs):
+    """
+    build the wsgi app.
+    Any extra keyword arguments are passed along to the `Router`.
+
+    :param data_dir: str
+    :param redis_connection: redis.StrictRedis, or a list or dict of them
+        to shard the metadata across several redis instances, or a
+        MetaDataBackend to keep the metadata somewhere else
+    :param kwargs: options for the `Router`, e.g. cache, metrics or a
+        `Shaper` to pace the transfers
+    :return: wsgi app
+    """
+    router = Router(data_dir=data_dir, redis_connection=redis_connection,
+                    **kwargs)
     app = falcon.API()
     app.add_sink(router, '/')
     return wrap_app(app)
@@ -0,0 +1,140 @@
+import collections
+import math
+import threading
+import time
+
+__all__ = ['Admission']
+
+
+class _Ticket(object):
+    __slots__ = ['path', 'size']
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+
+class Admission(object):
+    """
+    Limits the writes in progress, so an upload storm gets turned away at
+    the door instead of piling up behind the file locks and the metadata
+    store and slowing down everyone.
+
+    A write is let in if it keeps all of these within bounds, each one
+    optional:
+
+      max_writes: writes in progress in this process.
+      max_writes_per_path: writes in progress on any single path.
+      max_buffered_bytes: the total declared size of the bodies of the
+        writes in progress. A chunked body of unknown size counts as
+        `unknown_size` bytes.
+
+    Rejected writes should get a 503 with the `retry_after` seconds, an
+    estimate of how long it takes to work through the writes in progress at
+    the rate they have been finishing lately.
+    """
+    __slots__ = ['max_writes', 'max_writes_per_path', 'max_buffered_bytes',
+                 'unknown_size', 'min_retry_after', 'max_retry_after',
+                 'in_flight', 'buffered_bytes', 'admitted', 'rejected',
+                 'rejected_by', 'peak', '_paths', '_interval', '_last',
+                 '_lock']
+
+    def __init__(self, max_writes=None, max_writes_per_path=None,
+                 max_buffered_bytes=None, unknown_size=1024 * 1024,
+                 min_retry_after=1, max_retry_after=60):
+        self.max_writes = max_writes
+        self.max_writes_per_path = max_writes_per_path
+        self.max_buffered_bytes = max_buffered_bytes
+        self.unknown_size = unknown_size
+        self.min_retry_after = min_retry_after
+        self.max_retry_after = max_retry_after
+        self.in_flight = 0
+        self.buffered_bytes = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.rejected_by = collections.Counter()
+        self.peak = 0
+        self._paths = collections.Counter()
+        self._interval = None
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def admit(self, path, size):
+        """
+        let a write in, if there is room for it.
+
+        :param path: str
+        :param size: int, or None if unknown
+        :return: a ticket to pass to `release` once the write is done, or
+            None if the write got rejected
+        """
+        size = self.unknown_size if size is None else size
+        with self._lock:
+            reason = self._check(path, size)
+            if reason is not None:
+                self.rejected += 1
+                self.rejected_by[reason] += 1
+                return None
+
+            self.in_flight += 1
+            self.buffered_bytes += size
+            self._paths[path] += 1
+            self.admitted += 1
+            self.peak = max(self.peak, self.in_flight)
+            return _Ticket(path, size)
+
+    def _check(self, path, size):
+        if self.max_writes is not None and \
+                self.in_flight >= self.max_writes:
+            return 'writes'
+        if self.max_writes_per_path is not None and \
+                self._paths[path] >= self.max_writes_per_path:
+            return 'path'
+        # a single body bigger than the limit still gets in when nothing
+        # else is buffered, or it could never get in at all.
+        if self.max_buffered_bytes is not None and self.buffered_bytes and \
+                self.buffered_bytes + size > self.max_buffered_bytes:
+            return 'bytes'
+        return None
+
+    def release(self, ticket):
+        with self._lock:
+            self.in_flight -= 1
+            self.buffered_bytes -= ticket.size
+            self._paths[ticket.path] -= 1
+            if not self._paths[ticket.path]:
+                del self._paths[ticket.path]
+
+            # a moving average of the time between two writes finishing.
+            now = time.monotonic()
+            interval = now - self._last
+            self._last = now
+            self._interval = interval if self._interval is None else \
+                self._interval * 0.9 + interval * 0.1
+
+    def retry_after(self):
+        """
+        the seconds a rejected client should wait before trying again.
+
+        :return: int
+        """
+        with self._lock:
+            depth = self.in_flight
+            interval = self._interval
+        seconds = self.min_retry_after
+        if interval is not None:
+            seconds = math.ceil(depth * interval)
+        return int(min(max(seconds, self.min_retry_after),
+                       self.max_retry_after))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'buffered_bytes': self.buffered_bytes,
+                'paths': len(self._paths),
+                'peak': self.peak,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'rejected_by': dict(self.rejected_by),
+            }
@@ -0,0 +1,141 @@
+import collections
+import threading
+import time
+
+__all__ = ['ObjectCache']
+
+
+class CacheEntry(object):
+    __slots__ = ['content', 'headers', 'expires']
+
+    def __init__(self, content, headers, expires=None):
+        self.content = content
+        self.headers = headers
+        self.expires = expires
+
+    def reader(self, first_byte, length):
+        """
+        same contract as `napfs.fs.read_file_chunk`, but the bytes come
+        straight out of memory in a single slice.
+
+        :param first_byte: int
+        :param length: int
+        :return: function
+        """
+        content = self.content
+
+        def response():
+            if length > 0:
+                yield content[first_byte:first_byte + length]
+
+        return response
+
+
+class ObjectCache(object):
+    """
+    A byte-budgeted LRU cache of small, fully uploaded files.
+
+    Each entry holds the content of the file along with the metadata headers
+    that get sent back with it, so GET and HEAD requests for hot objects can
+    be answered without opening the file or querying redis.
+
+    The cache is local to the process. Writes handled by this process
+    invalidate entries right away; if several worker processes serve the
+    same data dir, use `ttl` to bound how long a change made by another
+    worker can go unnoticed.
+    """
+    __slots__ = ['max_bytes', 'max_object_size', 'ttl', 'hits', 'misses',
+                 'size', 'generation', '_entries', '_lock']
+
+    def __init__(self, max_bytes=1024 * 1024 * 64,
+                 max_object_size=1024 * 256, ttl=None):
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.expires is not None \
+                    and entry.expires < time.time():
+                self._remove(path)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return entry
+
+    def set(self, path, content, headers, generation=None):
+        """
+        add a file to the cache.
+
+        Pass in the value of `generation` read before the file and its
+        metadata were fetched. If anything was invalidated in the meantime,
+        the content may already be stale and is not stored.
+
+        :param path: str
+        :param content: bytes
+        :param headers: list of (name, value) tuples
+        :param generation: int
+        :return: CacheEntry or None
+        """
+        size = len(content)
+        if size > self.max_object_size or size > self.max_bytes:
+            return None
+
+        expires = None if self.ttl is None else time.time() + self.ttl
+        entry = CacheEntry(content, headers, expires=expires)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return None
+
+            self._remove(path)
+            self._entries[path] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+        return entry
+
+    def invalidate(self, path):
+        with self._lock:
+            self.generation += 1
+            self._remove(path)
+
+    def invalidate_prefix(self, prefix):
+        with self._lock:
+            self.generation += 1
+            for path in [p for p in self._entries if p.startswith(prefix)]:
+                self._remove(path)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'bytes': self.size,
+        }
+
+    def _remove(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry.content)
@@ -0,0 +1,261 @@
+import logging
+import os
+import urllib.parse
+
+import falcon
+
+from .data import delete_many, get_many
+from .fs import walk_files, remove_empty_dirs, delete_file, is_temp_file, \
+    file_slice
+from .helpers import parse_byte_ranges_from_list, condense_byte_ranges
+from .jobs import Job, RateLimiter
+from .peers import Peer
+from .sharding import HashRing
+
+__all__ = ['Cluster', 'RebalanceJob']
+
+log = logging.getLogger('napfs')
+
+# set on requests one node sends another, so the receiving node serves them
+# itself even if its view of the ring differs, and they never loop.
+FORWARDED_HEADER = 'x-napfs-forwarded'
+
+# headers that only make sense for a single hop.
+_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'transfer-encoding', 'upgrade', 'host',
+    'content-length'])
+
+STREAM_BLOCK_SIZE = 1024 * 64
+
+
+class Cluster(object):
+    """
+    Shards the files across several napfs nodes with a consistent hash ring
+    of the paths. Every node gets the same list of node urls, and its own
+    url as `url`.
+
+    A request for a path owned by another node is either redirected there
+    with a 307, so the client talks to the owner directly from then on, or
+    with `mode='proxy'` passed through to the owner over a pool of kept
+    alive connections and streamed back, for clients that can't follow
+    redirects.
+
+    Listings and prefix deletes are served by whichever node gets them, and
+    only cover the files on that node.
+
+    When nodes join or leave, start every node with the new list of urls
+    and run a `RebalanceJob` on each. Thanks to the ring only the files
+    whose owner changed move.
+    """
+    __slots__ = ['url', 'mode', 'ring', 'peers', 'timeout']
+
+    modes = ['redirect', 'proxy']
+
+    def __init__(self, nodes, url, mode='redirect', replicas=128,
+                 timeout=10, max_idle=8):
+        if mode not in self.modes:
+            raise ValueError('invalid cluster mode %s' % mode)
+        nodes = [n.rstrip('/') for n in nodes]
+        self.url = url.rstrip('/')
+        if self.url not in nodes:
+            raise ValueError('%s is not one of the cluster nodes' % url)
+        self.mode = mode
+        self.ring = HashRing(nodes, replicas=replicas)
+        self.timeout = timeout
+        self.peers = dict((n, Peer(n, timeout=timeout, max_idle=max_idle))
+                          for n in nodes if n != self.url)
+
+    def owner(self, path):
+        """
+        :param path: str
+        :return: str, the url of the node the path belongs to
+        """
+        return self.ring.get(path)
+
+    def is_local(self, path):
+        return self.owner(path) == self.url
+
+    def should_forward(self, req):
+        """
+        whether a request has to be handled by another node.
+
+        :param req: falcon.Request
+        :return: str url of the owner, or None to serve it here
+        """
+        if req.get_header(FORWARDED_HEADER) is not None:
+            return None
+        if req.get_param('list') is not None or \
+                req.get_param_as_bool('prefix'):
+            return None
+        owner = self.owner(req.path)
+        return None if owner == self.url else owner
+
+    def forward(self, req, resp, owner):
+        """
+        send a request on to the node that owns its path.
+
+        :param req: falcon.Request
+        :param resp: falcon.Response
+        :param owner: str, the url of the node
+        :return: None
+        """
+        if self.mode == 'redirect':
+            raise falcon.HTTPTemporaryRedirect(owner + req.relative_uri)
+
+        headers = dict((k, v) for k, v in req.headers.items()
+                       if k.lower() not in _HOP_HEADERS)
+        headers[FORWARDED_HEADER] = self.url
+        body = None
+        if req.method in ('PATCH', 'PUT', 'POST'):
+            encoding = req.get_header('transfer-encoding') or ''
+            if 'chunked' not in encoding.lower():
+                headers['Content-Length'] = '%d' % (req.content_length or 0)
+            # without a content-length, http.client sends the stream with
+            # chunked transfer encoding.
+            body = req.bounded_stream
+
+        peer = self.peers[owner]
+        try:
+            conn, res = peer.open(req.method, _uri(req), body=body,
+                                  headers=headers)
+        except Exception as e:
+            log.error('proxying %s %s to %s failed: %s', req.method,
+                      req.path, owner, e)
+            raise falcon.HTTPBadGateway(
+                title='PEER_UNAVAILABLE',
+                description='the node owning this path did not respond')
+
+        resp.status = '%d %s' % (res.status, res.reason)
+        for k, v in res.getheaders():
+            if k.lower() not in _HOP_HEADERS or k.lower() == 'content-length':
+                resp.append_header(k, v)
+        resp.stream = _relay(peer, conn, res)
+
+    def close(self):
+        for peer in self.peers.values():
+            peer.close()
+
+
+def _uri(req):
+    uri = urllib.parse.quote(req.path)
+    if req.query_string:
+        uri += '?' + req.query_string
+    return uri
+
+
+def _relay(peer, conn, res):
+    try:
+        while True:
+            chunk = res.read(STREAM_BLOCK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    except BaseException:
+        conn.close()
+        raise
+    peer.release(conn, res)
+
+
+class RebalanceJob(Job):
+    """
+    moves the files this node no longer owns to the node that does, along
+    with their parts and headers, then deletes them here.
+
+    Each contiguous part of a file goes over as a PATCH at its offset, so
+    uploads in progress carry on at the new owner where they left off.
+    Files with no metadata are sent whole. `rate` caps the files moved per
+    second.
+    """
+    __slots__ = ['router', 'rate', 'batch_size']
+    kind = 'rebalance'
+
+    def __init__(self, router, rate=None, batch_size=500):
+        super(RebalanceJob, self).__init__()
+        self.router = router
+        self.rate = rate
+        self.batch_size = batch_size
+        self.progress.update(scanned=0, files=0, bytes=0, failed=0, dirs=0)
+
+    def run(self):
+        limiter = RateLimiter(self.rate)
+        data_dir = self.router.data_dir.rstrip('/')
+        cluster = self.router.cluster
+        batch = []
+        for entry in walk_files(data_dir):
+            self.progress['scanned'] += 1
+            if is_temp_file(entry.name):
+                continue
+            path = entry.path[len(data_dir):]
+            if cluster.is_local(path):
+                continue
+            batch.append((path, entry.path))
+            if len(batch) >= self.batch_size:
+                self._move(batch, limiter)
+                batch = []
+        self._move(batch, limiter)
+        # the data dir itself stays, even if nothing is left in it.
+        with os.scandir(data_dir) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    self.progress['dirs'] += remove_empty_dirs(entry.path)
+
+    def _move(self, batch, limiter):
+        if not batch:
+            return
+        router = self.router
+        metadata = get_many([path for path, _ in batch], db=router._db)
+        moved = []
+        for (path, local_path), data in zip(batch, metadata):
+            try:
+                size = self._send(path, local_path, data)
+            except Exception as e:
+                log.error('moving %s to %s failed: %s', path,
+                          router.cluster.owner(path), e)
+                self.progress['failed'] += 1
+                continue
+            delete_file(local_path)
+            if router.cache is not None:
+                router.cache.invalidate(path)
+            for store in router.sidecars:
+                store.delete(path)
+            moved.append(path)
+            self.progress['bytes'] += size
+        delete_many(moved, db=router._db)
+        self.progress['files'] += len(moved)
+        limiter.wait(len(batch))
+
+    def _send(self, path, local_path, data):
+        cluster = self.router.cluster
+        peer = cluster.peers[cluster.owner(path)]
+        headers = self.router._forward_headers(data.headers)
+        headers[FORWARDED_HEADER] = cluster.url
+        if data.total_length is not None:
+            headers['x-total-length'] = '%d' % data.total_length
+        uri = urllib.parse.quote(path)
+        sent = 0
+        # the content is streamed from the file, never read into memory.
+        with open(local_path, 'rb') as f:
+            if data.disabled or not data.parts:
+                body = file_slice(f)
+                headers['Content-Length'] = '%d' % body.length
+                self._check(peer.request('POST', uri, body=body,
+                                         headers=headers))
+                return body.length
+
+            ranges = condense_byte_ranges(
+                parse_byte_ranges_from_list(data.parts))
+            for first, last in ranges:
+                body = file_slice(f, first, last - first + 1)
+                headers['Content-Length'] = '%d' % body.length
+                self._check(peer.request(
+                    'PATCH', '%s?offset=%d' % (uri, first), body=body,
+                    headers=headers))
+                sent += body.length
+        return sent
+
+    @staticmethod
+    def _check(result):
+        status = result[0]
+        if status >= 300:
+            raise IOError('status %d' % status)
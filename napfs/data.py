@@ -1,61 +1,63 @@
+import time
+
 from .helpers import parse_byte_ranges_from_list, \
-    get_last_contiguous_byte
+    get_last_contiguous_byte, parse_markers, total_length_marker, \
+    complete_marker
+
+
+def headers_key(path):
+    return 'H{%s}' % path
+
+
+def parts_key(path):
+    return 'P{%s}' % path
 
 
 class MetaData(object):
-    __slots__ = ['disabled', 'headers', 'parts']
+    """
+    the headers and uploaded parts of a path.
+
+    An upload can declare the `total_length` of the file. Once the parts
+    cover it from the first byte on, the file is complete: its parts get
+    replaced by a single range and a marker with the time it completed, so
+    reading it back doesn't mean parsing every part.
+    """
+    __slots__ = ['disabled', 'headers', 'parts', 'total_length',
+                 'completed_at']
 
     HEADER_EXPIRE_TIMEOUT = 3600
     PARTS_EXPIRE_TIMEOUT = 86400 * 3
 
-    def __init__(self, path, headers=None, parts=None, reset=False, db=None):
+    def __init__(self, path, headers=None, parts=None, reset=False, db=None,
+                 total_length=None):
         self.disabled = True if db is None else False
         self.headers = {}
         self.parts = []
+        self.total_length = None
+        self.completed_at = None
         if self.disabled:
             return
 
-        callbacks = []
-        pipe = db.pipeline(transaction=False)
-        headers_key = 'H{%s}' % path
-        parts_key = 'P{%s}' % path
-        if reset:
-            pipe.delete(headers_key)
-            callbacks.append(None)
-            pipe.delete(parts_key)
-            callbacks.append(None)
-
-        if headers:
-            pipe.hmset(headers_key, headers)
-            callbacks.append(None)
-            pipe.expire(headers_key, self.HEADER_EXPIRE_TIMEOUT)
-            callbacks.append(None)
+        if parts is not None and total_length is not None:
+            parts = list(parts) + [total_length_marker(total_length)]
 
-        pipe.hgetall(headers_key)
-        callbacks.append(self._handle_header_results)
+        backend = get_backend(db)
+        self.headers, self.parts = backend.update(
+            path, headers=headers, parts=parts, reset=reset)
+        self.total_length, self.completed_at = parse_markers(self.parts)
 
-        if parts is not None:
-            for element in parts:
-                pipe.sadd(parts_key, element)
-                callbacks.append(None)
-            pipe.expire(parts_key, self.PARTS_EXPIRE_TIMEOUT)
-            callbacks.append(None)
-
-        pipe.smembers(parts_key)
-        callbacks.append(self._handle_parts_results)
-
-        for i, result in enumerate(pipe.execute()):
-            callback = callbacks[i]
-            if callback is None:
-                continue
-
-            callback(result)
-
-        if parts is None:
+        if parts is None or self.completed_at is not None:
             return
 
         byte_ranges = parse_byte_ranges_from_list(self.parts)
 
+        if self.total_length is not None and byte_ranges and \
+                byte_ranges[0][0] == 0 and \
+                get_last_contiguous_byte(byte_ranges) + 1 >= \
+                self.total_length:
+            self._complete(backend, path)
+            return
+
         if len(byte_ranges) < 4:
             return
 
@@ -64,25 +66,246 @@ class MetaData(object):
         for offset, last in byte_ranges:
             if last > max_len:
                 break
-            to_remove.append((offset, last))
-
-        pipe = db.pipeline(transaction=False)
-        for offset, last in to_remove:
-            pipe.srem(parts_key, "%s-%s" % (offset, last))
-            pipe.sadd(parts_key, '0-%s' % max_len)
-        pipe.expire(parts_key, self.PARTS_EXPIRE_TIMEOUT)
-        pipe.smembers(parts_key)
-        res = pipe.execute().pop()
-        self._handle_parts_results(res)
-
-    def _handle_header_results(self, results):
-        if results is None:
+            to_remove.append("%s-%s" % (offset, last))
+
+        self.parts = backend.compact(path, to_remove, '0-%s' % max_len)
+
+    @property
+    def complete(self):
+        return self.completed_at is not None
+
+    def _complete(self, backend, path):
+        completed_at = time.time()
+        backend.compact(path, list(self.parts),
+                        '0-%d' % (self.total_length - 1))
+        self.headers, self.parts = backend.update(
+            path, parts=[complete_marker(self.total_length, completed_at)])
+        self.total_length, self.completed_at = parse_markers(self.parts)
+
+
+class MetaDataBackend(object):
+    """
+    The interface between `MetaData` and wherever the metadata is stored.
+
+    For each path there is a dict of headers, which expires
+    `MetaData.HEADER_EXPIRE_TIMEOUT` seconds after the last time headers
+    were written, and a set of byte range strings for the parts uploaded so
+    far, which expires `MetaData.PARTS_EXPIRE_TIMEOUT` seconds after the
+    last time parts were added.
+    """
+    __slots__ = []
+
+    def update(self, path, headers=None, parts=None, reset=False):
+        """
+        apply the changes to a path, then read it back.
+
+        :param path: str
+        :param headers: dict of headers to add
+        :param parts: list of byte range strings to add
+        :param reset: bool, clear the path before applying the changes
+        :return: headers dict, parts list
+        """
+        raise NotImplementedError()
+
+    def compact(self, path, remove, add):
+        """
+        replace some parts of a path with one that covers all of them.
+
+        :param path: str
+        :param remove: list of byte range strings
+        :param add: str
+        :return: parts list
+        """
+        raise NotImplementedError()
+
+    def get_many(self, paths):
+        """
+        read many paths at once.
+
+        :param paths: list of str
+        :return: list of (headers dict, parts list), in the order of paths
+        """
+        raise NotImplementedError()
+
+    def delete_many(self, paths):
+        """
+        remove the metadata of many paths at once.
+
+        :param paths: list of str
+        :return: None
+        """
+        raise NotImplementedError()
+
+    def write_many(self, updates):
+        """
+        apply the changes to many paths at once, without reading them back.
+
+        :param updates: list of MetaDataUpdate
+        :return: None
+        """
+        raise NotImplementedError()
+
+
+class MetaDataUpdate(object):
+    """
+    pending changes to the metadata of a path, applied in this order: the
+    reset, the parts to remove, then the headers and parts to add.
+    """
+    __slots__ = ['path', 'headers', 'parts', 'remove', 'reset']
+
+    def __init__(self, path):
+        self.path = path
+        self.headers = {}
+        self.parts = set()
+        self.remove = set()
+        self.reset = False
+
+
+def _decode_headers(results):
+    if results is None:
+        return {}
+    return dict((k.decode('ascii'), v.decode('ascii'))
+                for k, v in results.items())
+
+
+def _decode_parts(results):
+    if results is None:
+        return []
+    return [row.decode('ascii') for row in results]
+
+
+class RedisBackend(MetaDataBackend):
+    """
+    keeps the metadata in redis, the headers in a hash at `H{path}` and the
+    parts in a set at `P{path}`. Every operation is a single pipeline.
+    Works with a `ShardedRedis` too.
+    """
+    __slots__ = ['db']
+
+    def __init__(self, db):
+        self.db = db
+
+    def update(self, path, headers=None, parts=None, reset=False):
+        pipe = self.db.pipeline(transaction=False)
+        h_key = headers_key(path)
+        p_key = parts_key(path)
+        if reset:
+            pipe.delete(h_key)
+            pipe.delete(p_key)
+
+        if headers:
+            pipe.hmset(h_key, headers)
+            pipe.expire(h_key, MetaData.HEADER_EXPIRE_TIMEOUT)
+
+        headers_index = len(pipe)
+        pipe.hgetall(h_key)
+
+        if parts is not None:
+            for element in parts:
+                pipe.sadd(p_key, element)
+            pipe.expire(p_key, MetaData.PARTS_EXPIRE_TIMEOUT)
+
+        pipe.smembers(p_key)
+
+        results = pipe.execute()
+        return _decode_headers(results[headers_index]), \
+            _decode_parts(results[-1])
+
+    def compact(self, path, remove, add):
+        p_key = parts_key(path)
+        pipe = self.db.pipeline(transaction=False)
+        for element in remove:
+            pipe.srem(p_key, element)
+            pipe.sadd(p_key, add)
+        pipe.expire(p_key, MetaData.PARTS_EXPIRE_TIMEOUT)
+        pipe.smembers(p_key)
+        return _decode_parts(pipe.execute().pop())
+
+    def get_many(self, paths):
+        if not paths:
+            return []
+        pipe = self.db.pipeline(transaction=False)
+        for path in paths:
+            pipe.hgetall(headers_key(path))
+            pipe.smembers(parts_key(path))
+        rows = pipe.execute()
+        return [(_decode_headers(rows[i * 2]), _decode_parts(rows[i * 2 + 1]))
+                for i in range(len(paths))]
+
+    def delete_many(self, paths):
+        if not paths:
             return
-        for k, v in results.items():
-            self.headers[k.decode('ascii')] = v.decode('ascii')
+        pipe = self.db.pipeline(transaction=False)
+        for path in paths:
+            pipe.delete(headers_key(path))
+            pipe.delete(parts_key(path))
+        pipe.execute()
 
-    def _handle_parts_results(self, results):
-        if results is None:
+    def write_many(self, updates):
+        if not updates:
             return
-        for row in results:
-            self.parts.append(row.decode('ascii'))
+        pipe = self.db.pipeline(transaction=False)
+        for update in updates:
+            h_key = headers_key(update.path)
+            p_key = parts_key(update.path)
+            if update.reset:
+                pipe.delete(h_key)
+                pipe.delete(p_key)
+            if update.headers:
+                pipe.hmset(h_key, update.headers)
+                pipe.expire(h_key, MetaData.HEADER_EXPIRE_TIMEOUT)
+            if update.remove:
+                pipe.srem(p_key, *update.remove)
+            if update.parts:
+                pipe.sadd(p_key, *update.parts)
+                pipe.expire(p_key, MetaData.PARTS_EXPIRE_TIMEOUT)
+        pipe.execute()
+
+
+def get_backend(db):
+    """
+    wrap a redis connection in a `RedisBackend`. Backends are returned as
+    they are.
+
+    :param db: MetaDataBackend or redis connection or None
+    :return: MetaDataBackend or None
+    """
+    if db is None or isinstance(db, MetaDataBackend):
+        return db
+    return RedisBackend(db)
+
+
+def get_many(paths, db=None):
+    """
+    fetch the metadata of many paths at once, using a single round trip to
+    the backend. Much cheaper than creating a `MetaData` per path when there
+    are thousands of them.
+
+    :param paths: list of str
+    :param db: MetaDataBackend or redis connection
+    :return: list of MetaData, in the same order as the paths
+    """
+    results = [MetaData(path) for path in paths]
+    if db is None:
+        return results
+
+    rows = get_backend(db).get_many(paths)
+    for data, (headers, parts) in zip(results, rows):
+        data.disabled = False
+        data.headers = headers
+        data.parts = parts
+        data.total_length, data.completed_at = parse_markers(parts)
+    return results
+
+
+def delete_many(paths, db=None):
+    """
+    remove the metadata of many paths at once.
+
+    :param paths: list of str
+    :param db: MetaDataBackend or redis connection
+    :return: None
+    """
+    if db is None or not paths:
+        return
+    get_backend(db).delete_many(paths)
@@ -1,15 +1,38 @@
 # std lib
 import errno
 import fcntl
+import collections
+import concurrent.futures
 import hashlib
+import heapq
+import mmap
 import os
 import shutil
+import tempfile
+import threading
+import time
+import uuid
 from .helpers import InvalidChecksumException
 
 __all__ = []
 
 READ_BLOCK_SIZE = 1024 * 8
 
+# the names of the temp files new content is written to before it replaces
+# a file start with this.
+TEMP_FILE_PREFIX = '.napfs-tmp-'
+
+# request bodies of unknown size are written out in blocks of this size.
+WRITE_BLOCK_SIZE = 1024 * 64
+
+# request bodies of unknown size that have to be checked before they are
+# written are held in memory up to this size, and in a temp file beyond.
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+# mapped files don't pay for a read() call per chunk, so hand them out in
+# bigger slices.
+MAPPED_BLOCK_SIZE = 1024 * 256
+
 # a mapping of the names for checksum methods.
 supported_checksum_methods = {
     'md5': hashlib.md5,
@@ -17,6 +40,15 @@ supported_checksum_methods = {
     'sha256': hashlib.sha256,
 }
 
+# tree digests hash the content in blocks of this size, in parallel.
+TREE_BLOCK_SIZE = 1024 * 1024
+
+# the hash methods used by each tree digest.
+tree_checksum_methods = {
+    'sha256-tree': hashlib.sha256,
+    'blake2b-tree': hashlib.blake2b,
+}
+
 
 def _mkdirs(dir_name):
     # there's a race condition where we could see the directory doesn't exist
@@ -37,6 +69,69 @@ def copy_file(src, dst):
     shutil.copy(src, dst)
 
 
+def temp_file_path(path):
+    """
+    a unique name for a temp file next to `path`, to write new content to
+    before it replaces the file. Being in the same directory keeps it on
+    the same filesystem, so the rename is atomic.
+
+    :param path: str
+    :return: str
+    """
+    dir_name, name = os.path.split(path)
+    return os.path.join(dir_name, '%s%s.%s' % (TEMP_FILE_PREFIX, name,
+                                               uuid.uuid4().hex))
+
+
+def is_temp_file(name):
+    return name.startswith(TEMP_FILE_PREFIX)
+
+
+def replace_file(src, dst):
+    """
+    atomically move `src` over `dst`. Whoever has the old file open keeps
+    reading the old content, and whoever opens it from now on gets the
+    new one.
+    """
+    os.replace(src, dst)
+
+
+def move_file(src, dst, check=None):
+    """
+    move a file to `dst`, which may be on another filesystem. The content
+    is copied to a temp file next to `dst` that then replaces it, so `dst`
+    is never seen half written, and keeps the times of `src`. If `src` got
+    written to while it was being copied, or `check` returns False once
+    the copy is done, the move is called off.
+
+    :param src: str
+    :param dst: str
+    :param check: callable, or None
+    :return: bool, whether the file got moved
+    """
+    _mkdirs(os.path.dirname(dst))
+    tmp_path = temp_file_path(dst)
+    try:
+        with open(src, 'rb') as f, open(tmp_path, 'wb') as out:
+            before = os.fstat(f.fileno())
+            shutil.copyfileobj(f, out, WRITE_BLOCK_SIZE)
+        os.utime(tmp_path, ns=(before.st_atime_ns, before.st_mtime_ns))
+        after = os.stat(src)
+    except (IOError, OSError):
+        delete_file(tmp_path)
+        return False
+
+    if (before.st_ino, before.st_size, before.st_mtime_ns) != \
+            (after.st_ino, after.st_size, after.st_mtime_ns) or \
+            (check is not None and not check()):
+        delete_file(tmp_path)
+        return False
+
+    os.replace(tmp_path, dst)
+    delete_file(src)
+    return True
+
+
 def delete_file(path):
     try:
         os.unlink(path)
@@ -46,6 +141,159 @@ def delete_file(path):
     return False if os.path.exists(path) else True
 
 
+class FileSlice(object):
+    """
+    `length` bytes of an open file from `offset` on, as a file-like object
+    of its own, so a range of a file can be sent as a request body without
+    reading it into memory. Seeking is relative to the start of the slice,
+    which lets a failed request rewind it and send it again.
+    """
+    __slots__ = ['f', 'offset', 'length', 'pos']
+
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.offset = offset
+        self.length = length
+        self.pos = 0
+
+    def read(self, size=-1):
+        left = self.length - self.pos
+        if size is None or size < 0 or size > left:
+            size = left
+        if size <= 0:
+            return b''
+        chunk = os.pread(self.f.fileno(), size, self.offset + self.pos)
+        self.pos += len(chunk)
+        return chunk
+
+    def seekable(self):
+        return True
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.length
+        self.pos = max(0, min(pos, self.length))
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+def file_slice(f, offset=0, length=None):
+    """
+    :param f: file opened in binary mode
+    :param offset: int
+    :param length: int, or None for the rest of the file
+    :return: FileSlice, cut short if the file ends sooner
+    """
+    size = max(0, os.fstat(f.fileno()).st_size - offset)
+    return FileSlice(f, offset, size if length is None else min(length, size))
+
+
+def delete_tree(path):
+    shutil.rmtree(path, ignore_errors=True)
+    return False if os.path.exists(path) else True
+
+
+def _file_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+def get_file_sizes(paths, workers=16):
+    """
+    stat a batch of files on a pool of threads, so the round trips to the
+    disk overlap instead of adding up.
+
+    :param paths: list of str
+    :param workers: int
+    :return: list of int, None for files that don't exist
+    """
+    if len(paths) < 2:
+        return [_file_size(path) for path in paths]
+    workers = min(workers, len(paths))
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(_file_size, paths))
+
+
+def list_dir(path, after=None, limit=1000):
+    """
+    get a page of the entries in a directory, sorted by name.
+
+    The directory is read with os.scandir and only the `limit` smallest
+    names greater than `after` are kept, so a huge directory never gets
+    loaded into memory. Using the last name of a page as `after` for the
+    next one gives stable pagination, even when entries get added or
+    removed in between. Temp files of uploads in progress are left out.
+
+    :param path: str
+    :param after: str, the cursor
+    :param limit: int
+    :return: list of os.DirEntry
+    """
+    with os.scandir(path) as it:
+        it = (entry for entry in it if not is_temp_file(entry.name))
+        if after is not None:
+            it = (entry for entry in it if entry.name > after)
+        return heapq.nsmallest(limit, it, key=lambda entry: entry.name)
+
+
+def walk_files(path):
+    """
+    iterate over all the files under a directory with os.scandir, without
+    building the list of files up front.
+
+    :param path: str
+    :return: generator of os.DirEntry
+    """
+    stack = [path]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                except OSError:
+                    continue
+                yield entry
+
+
+def remove_empty_dirs(path):
+    """
+    remove a directory tree bottom up, as long as it is empty.
+    Directories that got new files in the meantime are left alone.
+
+    :param path: str
+    :return: int, the number of directories removed
+    """
+    removed = 0
+    try:
+        with os.scandir(path) as it:
+            subdirs = [entry.path for entry in it
+                       if entry.is_dir(follow_symlinks=False)]
+    except OSError:
+        return removed
+
+    for subdir in subdirs:
+        removed += remove_empty_dirs(subdir)
+
+    try:
+        os.rmdir(path)
+        removed += 1
+    except OSError:
+        pass
+    return removed
+
+
 def open_file(path, mode='rb'):
     return open(path, mode=mode)
 
@@ -64,26 +312,275 @@ def _initialize_file_path(path):
     open(path, 'ab').close()
 
 
+def _lap(timings, name, since):
+    if timings is None:
+        return since
+    return timings.lap(name, since)
+
+
+class LockStats(object):
+    """
+    Adds up, across all the calls to `write_file_chunk` in this process, how
+    long they waited on the file locks against how long they held them
+    while reading, hashing and writing the chunk. A write counts as
+    contended when another writer held the lock when it asked for it.
+
+    POSIX record locks (`fcntl.lockf`) belong to the process, so threads of
+    one process never wait on each other for them. Only writers in other
+    processes, or `flock` locks taken through another open file, do.
+    """
+    __slots__ = ['writes', 'contended', 'wait_seconds', 'max_wait_seconds',
+                 'write_seconds', '_lock']
+
+    fields = ['writes', 'contended', 'wait_seconds', 'max_wait_seconds',
+              'write_seconds']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, wait, write, contended):
+        """
+        :param wait: float, seconds spent getting the lock
+        :param write: float, seconds the lock was held
+        :param contended: bool
+        :return: None
+        """
+        with self._lock:
+            self.writes += 1
+            self.contended += int(contended)
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            self.write_seconds += write
+
+    def snapshot(self):
+        """
+        :return: dict of the counters as they are now
+        """
+        with self._lock:
+            return dict((k, getattr(self, k)) for k in self.fields)
+
+    def reset(self):
+        with self._lock:
+            self.writes = 0
+            self.contended = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+            self.write_seconds = 0.0
+
+
+lock_stats = LockStats()
+
+
+def _lock(f, lock, *args):
+    """
+    take an exclusive lock with `lock`, fcntl.lockf or fcntl.flock. It is
+    tried without blocking first to tell whether we have to wait for it.
+
+    :return: bool, whether another writer held the lock
+    """
+    try:
+        lock(f, fcntl.LOCK_EX | fcntl.LOCK_NB, *args)
+        return False
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EACCES, errno.EAGAIN):
+            raise
+    lock(f, fcntl.LOCK_EX, *args)
+    return True
+
+
 def write_file_chunk(path, stream, offset, chunk_size,
-                     checksum=None, checksum_type=None):
+                     checksum=None, checksum_type=None, timings=None):
+    """
+    write a chunk read from the stream into the file at the given offset.
+
+    If `timings` is passed in, the time spent in each phase of the write
+    is added to it: init (creating the file), lock (waiting on the file
+    lock), read (reading the request body), hash and write. The time spent
+    waiting on the lock and holding it is always added to `lock_stats`.
+
+    A `chunk_size` of None means the size isn't known up front, as with a
+    chunked request body. The stream is then copied to the file a block at
+    a time until it runs out. With a checksum, the stream is spooled and
+    checked first, so a bad one never reaches the file.
+
+    :param path: str
+    :param stream: file-like object
+    :param offset: int
+    :param chunk_size: int or None
+    :param checksum: str
+    :param checksum_type: str
+    :param timings: napfs.timing.Timings
+    :return: int, the file position after the write
+    """
+    t = time.perf_counter() if timings is not None else None
+
+    # a length of 0 locks everything from the offset on, for when we don't
+    # know where the chunk ends.
+    length = 0
+    spool = None
+    if chunk_size is None and checksum is not None:
+        spool, length = _spool(stream, checksum, checksum_type, timings, t)
+        stream, checksum = spool, None
+        t = time.perf_counter() if timings is not None else None
+
+    try:
+        return _write_file_chunk(path, stream, offset, chunk_size, length,
+                                 checksum, checksum_type, timings, t)
+    finally:
+        if spool is not None:
+            spool.close()
 
+
+def _write_file_chunk(path, stream, offset, chunk_size, length, checksum,
+                      checksum_type, timings, t):
     _initialize_file_path(path)
 
     with open(path, 'rb+') as f:
-        if chunk_size:
-            fcntl.lockf(f, fcntl.LOCK_EX, chunk_size, offset, 0)
+        t = _lap(timings, 'init', t)
+        start = time.perf_counter()
+        if chunk_size is None:
+            contended = _lock(f, fcntl.lockf, length, offset, 0)
+        elif chunk_size:
+            contended = _lock(f, fcntl.lockf, chunk_size, offset, 0)
+        else:
+            contended = _lock(f, fcntl.flock)
+        locked = time.perf_counter()
+        t = _lap(timings, 'lock', t)
+        try:
+            f.seek(offset)
+            if chunk_size is None:
+                _write_stream(f, stream, checksum, checksum_type, timings, t)
+            else:
+                _write_chunk(f, stream, chunk_size, checksum, checksum_type,
+                             timings, t)
+            return f.tell()
+        finally:
+            lock_stats.record(locked - start, time.perf_counter() - locked,
+                              contended)
+
+
+def _write_chunk(f, stream, chunk_size, checksum, checksum_type, timings, t):
+    chunk = stream.read(chunk_size)
+    t = _lap(timings, 'read', t)
+    if checksum is not None:
+        if checksum_type in tree_checksum_methods:
+            hexdigest = tree_checksum([chunk], checksum_type)
         else:
-            fcntl.flock(f, fcntl.LOCK_EX)
-        f.seek(offset)
-        chunk = stream.read(chunk_size)
-        if checksum is not None:
             hashcalc = supported_checksum_methods.get(checksum_type,
                                                       hashlib.sha1)()
             hashcalc.update(chunk)
-            if hashcalc.hexdigest() != checksum:
-                raise InvalidChecksumException()
-        f.write(chunk)
-        return f.tell()
+            hexdigest = hashcalc.hexdigest()
+        if hexdigest != checksum:
+            raise InvalidChecksumException()
+        t = _lap(timings, 'hash', t)
+    f.write(chunk)
+    f.flush()
+    _lap(timings, 'write', t)
+
+
+def _spool(stream, checksum, checksum_type, timings, t):
+    """
+    copy a stream of unknown size aside and check its checksum.
+
+    :return: the spooled copy rewound to the start, and its size
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    try:
+        _write_stream(spool, stream, checksum, checksum_type, timings, t)
+    except BaseException:
+        spool.close()
+        raise
+    length = spool.tell()
+    spool.seek(0)
+    return spool, length
+
+
+def _write_stream(f, stream, checksum, checksum_type, timings, t):
+    def chunks():
+        since = t
+        while True:
+            chunk = stream.read(WRITE_BLOCK_SIZE)
+            since = _lap(timings, 'read', since)
+            if not chunk:
+                return
+            f.write(chunk)
+            since = _lap(timings, 'write', since)
+            yield chunk
+
+    if checksum is None:
+        for _ in chunks():
+            pass
+    elif checksum_type in tree_checksum_methods:
+        hexdigest = tree_checksum(chunks(), checksum_type)
+    else:
+        hashcalc = supported_checksum_methods.get(checksum_type,
+                                                  hashlib.sha1)()
+        for chunk in chunks():
+            hashcalc.update(chunk)
+        hexdigest = hashcalc.hexdigest()
+    f.flush()
+
+    if checksum is not None and hexdigest != checksum:
+        raise InvalidChecksumException()
+
+
+class FileMaps(object):
+    """
+    A per-process registry of read-only memory maps of the files being
+    served. The mappings are shared, so every worker process reading the same
+    hot file reads it straight out of the page cache instead of copying it
+    into a buffer of its own.
+
+    A mapping is reused across requests for as long as the file keeps the
+    same inode and size. When an upload makes the file grow, or the file gets
+    replaced, a new mapping is created. The old one is never closed
+    explicitly: responses still streaming from it hold on to their views and
+    it goes away once the last of them is done.
+    """
+    __slots__ = ['max_maps', '_maps', '_lock']
+
+    def __init__(self, max_maps=256):
+        self.max_maps = max_maps
+        self._maps = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._maps)
+
+    def view(self, path):
+        """
+        get a memoryview over the whole file.
+        Raises OSError if the file does not exist.
+
+        :param path: str
+        :return: memoryview
+        """
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_size)
+        with self._lock:
+            entry = self._maps.get(path)
+            if entry is not None and entry[0] == key:
+                self._maps.move_to_end(path)
+                return entry[1]
+
+        if st.st_size == 0:
+            view = memoryview(b'')
+        else:
+            with open(path, 'rb') as f:
+                view = memoryview(mmap.mmap(f.fileno(), st.st_size,
+                                            access=mmap.ACCESS_READ))
+
+        with self._lock:
+            self._maps[path] = (key, view)
+            self._maps.move_to_end(path)
+            while len(self._maps) > self.max_maps:
+                self._maps.popitem(last=False)
+        return view
+
+    def forget(self, path):
+        with self._lock:
+            self._maps.pop(path, None)
 
 
 def read_file_chunk(f, first_byte, length):
@@ -94,11 +591,22 @@ def read_file_chunk(f, first_byte, length):
 
     this is especially important for really big files.
 
+    `f` can also be a memoryview from `FileMaps.view`, in which case the
+    generator yields memoryview slices of the mapping without copying.
+
     :param f:
     :param length:
     :param first_byte:
     :return:
     """
+    if isinstance(f, memoryview):
+        def response():
+            last = first_byte + length
+            for offset in range(first_byte, last, MAPPED_BLOCK_SIZE):
+                yield f[offset:min(offset + MAPPED_BLOCK_SIZE, last)]
+
+        return response
+
     def response():
 
         with f:
@@ -113,7 +621,82 @@ def read_file_chunk(f, first_byte, length):
     return response
 
 
+def _leaf_digest(hash_method, block):
+    hashcalc = hash_method(b'\x00')
+    hashcalc.update(block)
+    return hashcalc.digest()
+
+
+def _tree_root(hash_method, level):
+    while len(level) > 1:
+        parents = []
+        for i in range(0, len(level) - 1, 2):
+            parents.append(
+                hash_method(b'\x01' + level[i] + level[i + 1]).digest())
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+def tree_checksum(chunks, checksum, workers=None,
+                  block_size=TREE_BLOCK_SIZE):
+    """
+    compute a tree digest of the bytes in `chunks`.
+
+    The content is split into blocks of `block_size` bytes, and each block
+    is hashed on a thread pool, which spreads the work over all the cores
+    since hashlib lets go of the GIL while it hashes. The leaf hashes are
+    hash(0x00 + block), and each level above hashes pairs of nodes as
+    hash(0x01 + left + right), with an odd node at the end moved up as it
+    is, until a single root is left. Empty content has a single empty
+    block.
+
+    :param chunks: iterable of bytes
+    :param checksum: str, one of `tree_checksum_methods`
+    :param workers: int, defaults to the number of cpus
+    :param block_size: int
+    :return: str, the hex digest of the root
+    """
+    hash_method = tree_checksum_methods[checksum]
+    workers = workers or os.cpu_count() or 1
+    leaves = []
+    pending = collections.deque()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit(block):
+            pending.append(pool.submit(_leaf_digest, hash_method, block))
+            # don't read too far ahead of the hashing.
+            while len(pending) > workers * 2:
+                leaves.append(pending.popleft().result())
+
+        block = bytearray()
+        for chunk in chunks:
+            view = memoryview(chunk)
+            while len(view):
+                if not block and len(view) >= block_size:
+                    # a whole block in one piece, no need to copy it.
+                    submit(view[:block_size])
+                    view = view[block_size:]
+                    continue
+                take = min(block_size - len(block), len(view))
+                block += view[:take]
+                view = view[take:]
+                if len(block) == block_size:
+                    submit(block)
+                    block = bytearray()
+
+        if block or not (leaves or pending):
+            submit(block)
+        leaves.extend(future.result() for future in pending)
+
+    return _tree_root(hash_method, leaves).hex()
+
+
 def checksum_response(response, checksum):
+    if checksum in tree_checksum_methods:
+        return tree_checksum(response(), checksum)
+
     hashcalc = supported_checksum_methods.get(checksum, hashlib.sha1)()
     for chunk in response():
         hashcalc.update(chunk)
@@ -4,6 +4,13 @@ BYTE_RANGE_STRING_PATTERN = re.compile(r'^([0-9]+)\-([0-9]+)$')
 _BYTE_RANGE_HEADER_PATTERN = re.compile(r'^bytes=([0-9]+)\-([0-9]+)?$')
 
 
+# besides byte ranges, the parts of a path can hold the total length the
+# uploader declared and, once the file is complete, a completion marker.
+# parse_byte_ranges_from_list skips them.
+TOTAL_LENGTH_MARKER = 'total:'
+COMPLETE_MARKER = 'complete:'
+
+
 class InvalidChecksumException(Exception):
     pass
 
@@ -106,6 +113,35 @@ def condense_byte_ranges(byte_ranges):
             new_byte_ranges.append(x)
 
         else:
-            byte_ranges[i + 1] = [x[0], y[1]]
+            byte_ranges[i + 1] = [x[0], max(x[1], y[1])]
         i += 1
     return new_byte_ranges
+
+
+def total_length_marker(length):
+    return '%s%d' % (TOTAL_LENGTH_MARKER, length)
+
+
+def complete_marker(length, completed_at):
+    return '%s%d:%.6f' % (COMPLETE_MARKER, length, completed_at)
+
+
+def parse_markers(parts):
+    """
+    find the declared total length and the completion time of a file among
+    its parts.
+
+    :param parts: list of str
+    :return: int or None, float or None
+    """
+    total_length = completed_at = None
+    for part in parts:
+        try:
+            if part.startswith(COMPLETE_MARKER):
+                length, ts = part[len(COMPLETE_MARKER):].split(':')
+                return int(length), float(ts)
+            if part.startswith(TOTAL_LENGTH_MARKER):
+                total_length = int(part[len(TOTAL_LENGTH_MARKER):])
+        except ValueError:
+            continue
+    return total_length, completed_at
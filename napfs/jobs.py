@@ -0,0 +1,373 @@
+import collections
+import logging
+import queue
+import threading
+import time
+import uuid
+
+from .data import delete_many, get_many
+from .fs import walk_files, remove_empty_dirs, delete_file
+from .helpers import parse_byte_ranges_from_list, get_last_contiguous_byte
+
+__all__ = ['JobManager', 'PrefixDeleteJob', 'SweepJob', 'Sweeper']
+
+log = logging.getLogger('napfs')
+
+
+class RateLimiter(object):
+    """
+    paces background work to at most `rate` units per second, so it doesn't
+    eat up the disk and redis capacity the requests need. A rate of None
+    means no limit.
+    """
+    __slots__ = ['rate', 'start', 'done']
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.done = 0
+
+    def wait(self, units=1):
+        self.done += units
+        if not self.rate:
+            return
+        ahead = self.done / float(self.rate) - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class Job(object):
+    """
+    A unit of background work. Subclasses implement `run` and keep their
+    counters up to date in `progress` as they go, so the status endpoint
+    can report on them.
+    """
+    __slots__ = ['id', 'status', 'created', 'started', 'finished', 'error',
+                 'progress']
+    kind = None
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.progress = {}
+
+    def __call__(self):
+        self.status = 'running'
+        self.started = time.time()
+        try:
+            self.run()
+            self.status = 'done'
+        except Exception as e:
+            log.exception('job %s failed', self.id)
+            self.status = 'failed'
+            self.error = '%s' % e
+        finally:
+            self.finished = time.time()
+
+    def run(self):
+        raise NotImplementedError()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'error': self.error,
+            'progress': dict(self.progress),
+        }
+
+
+class PrefixDeleteJob(Job):
+    """
+    deletes every file under a directory along with its metadata.
+
+    Files are found with a scandir traversal and removed in batches. The
+    metadata keys of each batch go away in one pipeline, and `rate` caps
+    the number of files removed per second. The files the `sidecars` keep
+    next to them, manifests and media indexes, go with the directory.
+    """
+    __slots__ = ['local_dir', 'prefix', 'db', 'cache', 'sidecars', 'rate',
+                 'batch_size']
+    kind = 'prefix_delete'
+
+    def __init__(self, local_dir, prefix, db=None, cache=None, rate=None,
+                 batch_size=500, sidecars=()):
+        super(PrefixDeleteJob, self).__init__()
+        self.local_dir = local_dir.rstrip('/')
+        self.prefix = prefix.rstrip('/')
+        self.db = db
+        self.cache = cache
+        self.sidecars = sidecars
+        self.rate = rate
+        self.batch_size = batch_size
+        self.progress.update(files=0, bytes=0, dirs=0)
+
+    def to_dict(self):
+        d = super(PrefixDeleteJob, self).to_dict()
+        d['prefix'] = self.prefix
+        return d
+
+    def run(self):
+        limiter = RateLimiter(self.rate)
+        batch = []
+        for entry in walk_files(self.local_dir):
+            batch.append(entry)
+            if len(batch) >= self.batch_size:
+                self._delete(batch, limiter)
+                batch = []
+        self._delete(batch, limiter)
+        self.progress['dirs'] = remove_empty_dirs(self.local_dir)
+        if self.cache is not None:
+            self.cache.invalidate_prefix(self.prefix + '/')
+        for store in self.sidecars:
+            store.delete_prefix(self.prefix)
+
+    def _delete(self, batch, limiter):
+        if not batch:
+            return
+        paths = []
+        for entry in batch:
+            try:
+                size = entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                size = 0
+            if delete_file(entry.path):
+                self.progress['bytes'] += size
+            paths.append(
+                self.prefix + entry.path[len(self.local_dir):])
+        delete_many(paths, db=self.db)
+        self.progress['files'] += len(batch)
+        limiter.wait(len(batch))
+
+
+class SweepJob(Job):
+    """
+    scans the data dir for uploads nobody is going to finish and removes
+    them.
+
+    A file goes if it hasn't been written to for `orphan_age` seconds and
+    its metadata has expired, which makes it impossible to serve anyway.
+    It also goes if it is still incomplete after `incomplete_age` seconds,
+    meaning the parts don't cover the file from the first byte to the last.
+    Temp files left behind by uploads that died before they were renamed
+    into place never have metadata, so they go as orphans. The files the
+    `sidecars` keep for a removed file go with it.
+
+    The scan goes through the files in batches, with one metadata pipeline
+    per batch, and `rate` caps the number of files looked at per second.
+    """
+    __slots__ = ['data_dir', 'db', 'cache', 'sidecars', 'orphan_age',
+                 'incomplete_age', 'rate', 'batch_size']
+    kind = 'sweep'
+
+    def __init__(self, data_dir, db, cache=None, orphan_age=3600,
+                 incomplete_age=86400 * 3, rate=None, batch_size=500,
+                 sidecars=()):
+        super(SweepJob, self).__init__()
+        self.data_dir = data_dir.rstrip('/')
+        self.db = db
+        self.cache = cache
+        self.sidecars = sidecars
+        self.orphan_age = orphan_age
+        self.incomplete_age = incomplete_age
+        self.rate = rate
+        self.batch_size = batch_size
+        self.progress.update(scanned=0, removed=0, reclaimed_bytes=0)
+
+    def run(self):
+        limiter = RateLimiter(self.rate)
+        batch = []
+        for entry in walk_files(self.data_dir):
+            batch.append(entry)
+            if len(batch) >= self.batch_size:
+                self._sweep(batch, limiter)
+                batch = []
+        self._sweep(batch, limiter)
+
+    def _sweep(self, batch, limiter):
+        if not batch:
+            return
+        now = time.time()
+        min_age = min(self.orphan_age, self.incomplete_age)
+        candidates = []
+        for entry in batch:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            age = now - st.st_mtime
+            if age >= min_age:
+                candidates.append((self._path(entry), entry, st, age))
+
+        metadata = get_many([row[0] for row in candidates], db=self.db)
+        expired = []
+        for (path, entry, st, age), data in zip(candidates, metadata):
+            if self._is_expired(data, st.st_size, age) and \
+                    delete_file(entry.path):
+                expired.append(path)
+                self.progress['removed'] += 1
+                self.progress['reclaimed_bytes'] += st.st_size
+                if self.cache is not None:
+                    self.cache.invalidate(path)
+                for store in self.sidecars:
+                    store.delete(path)
+        delete_many(expired, db=self.db)
+
+        self.progress['scanned'] += len(batch)
+        limiter.wait(len(batch))
+
+    def _is_expired(self, data, size, age):
+        byte_ranges = parse_byte_ranges_from_list(data.parts)
+        if not byte_ranges:
+            return age >= self.orphan_age
+
+        if byte_ranges[0][0] == 0 and \
+                get_last_contiguous_byte(byte_ranges) + 1 >= size:
+            return False
+        return age >= self.incomplete_age
+
+    def _path(self, entry):
+        return entry.path[len(self.data_dir):]
+
+
+class Sweeper(object):
+    """
+    runs a `SweepJob` over the data dir every `interval` seconds on a
+    background thread, and keeps a running total of what got reclaimed.
+
+    Hand it to the `Router`, which starts it. The sweeps also show up on
+    the jobs endpoint when that is enabled.
+    """
+    __slots__ = ['interval', 'orphan_age', 'incomplete_age', 'rate',
+                 'data_dir', 'db', 'jobs', 'cache', 'sidecars', 'runs',
+                 'removed',
+                 'reclaimed_bytes', '_thread', '_stop', '_lock']
+
+    def __init__(self, interval=3600, orphan_age=3600,
+                 incomplete_age=86400 * 3, rate=1000):
+        self.interval = interval
+        self.orphan_age = orphan_age
+        self.incomplete_age = incomplete_age
+        self.rate = rate
+        self.data_dir = None
+        self.db = None
+        self.jobs = None
+        self.cache = None
+        self.sidecars = ()
+        self.runs = 0
+        self.removed = 0
+        self.reclaimed_bytes = 0
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, data_dir, db, jobs=None, cache=None, sidecars=()):
+        if db is None:
+            raise ValueError('the sweeper needs the metadata to tell which '
+                             'files are abandoned')
+        self.data_dir = data_dir
+        self.db = db
+        self.jobs = jobs
+        self.cache = cache
+        self.sidecars = sidecars
+        if self.interval and self._thread is None:
+            self._thread = threading.Thread(target=self._work,
+                                            name='napfs-sweeper')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def sweep(self):
+        """
+        run a sweep right now, in the calling thread.
+
+        :return: SweepJob
+        """
+        job = SweepJob(self.data_dir, self.db, cache=self.cache,
+                       orphan_age=self.orphan_age,
+                       incomplete_age=self.incomplete_age, rate=self.rate,
+                       sidecars=self.sidecars)
+        if self.jobs is not None:
+            self.jobs.track(job)
+        with self._lock:
+            job()
+            self.runs += 1
+            self.removed += job.progress['removed']
+            self.reclaimed_bytes += job.progress['reclaimed_bytes']
+        return job
+
+    def _work(self):
+        while not self._stop.wait(self.interval):
+            self.sweep()
+
+
+class JobManager(object):
+    """
+    runs jobs one at a time on a background thread, and remembers the most
+    recent ones so their status can be looked up.
+    """
+    __slots__ = ['max_history', '_jobs', '_queue', '_thread', '_lock']
+
+    def __init__(self, max_history=100):
+        self.max_history = max_history
+        self._jobs = collections.OrderedDict()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def track(self, job):
+        """
+        remember a job that runs somewhere else, so its status can be
+        looked up here too.
+        """
+        with self._lock:
+            self._track(job)
+
+    def _track(self, job):
+        self._jobs[job.id] = job
+        finished = [k for k, v in self._jobs.items()
+                    if v.finished is not None]
+        for k in finished[:max(0, len(self._jobs) - self.max_history)]:
+            del self._jobs[k]
+
+    def submit(self, job):
+        with self._lock:
+            self._track(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work,
+                                                name='napfs-jobs')
+                self._thread.daemon = True
+                self._thread.start()
+
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def join(self):
+        """
+        block until every job submitted so far has run.
+        """
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job()
+            finally:
+                self._queue.task_done()
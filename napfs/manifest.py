@@ -0,0 +1,156 @@
+import fcntl
+import hashlib
+import os
+import struct
+
+from .fs import delete_file, _initialize_file_path, delete_tree
+from .helpers import parse_byte_ranges_from_list, condense_byte_ranges
+
+__all__ = ['Manifests']
+
+# the manifest starts with the device and inode of the file it describes,
+# so one left behind by a file that got deleted or replaced is ignored.
+_HEADER = struct.Struct('>QQ')
+
+
+def _identity(st):
+    return _HEADER.pack(st.st_dev, st.st_ino)
+
+
+class Manifests(object):
+    """
+    Keeps a manifest of the digest of every `block_size` block of each
+    file, so clients can tell which blocks of their copy differ and only
+    PATCH those, or verify a block aligned range they read without hashing
+    the whole file.
+
+    The manifests live in `root`, one per file at the same relative path
+    plus `.manifest`. Each one is a header identifying the file followed by
+    one fixed size digest per block, so the digests of the blocks a chunk
+    lands on are updated in place. Blocks not written yet are all zeros.
+    """
+    __slots__ = ['root', 'block_size', 'checksum', 'digest_size']
+
+    def __init__(self, root, block_size=1024 * 1024, checksum='sha256'):
+        self.root = root.rstrip('/')
+        self.block_size = block_size
+        self.checksum = checksum
+        self.digest_size = hashlib.new(checksum).digest_size
+
+    def get_local_path(self, path):
+        return '%s%s.manifest' % (self.root, path)
+
+    def update(self, path, local_path, offset, length):
+        """
+        recompute the digests of the blocks of the file that overlap a
+        chunk just written to it.
+
+        :param path: str, the path of the file in napfs
+        :param local_path: str, where the file is
+        :param offset: int
+        :param length: int
+        :return: None
+        """
+        manifest_path = self.get_local_path(path)
+        _initialize_file_path(manifest_path)
+        first = offset // self.block_size
+        last = (offset + max(length, 1) - 1) // self.block_size
+
+        with open(local_path, 'rb') as f, open(manifest_path, 'rb+') as m:
+            self._claim(m, _identity(os.fstat(f.fileno())))
+
+            # lock the slots of these blocks, so whoever hashes last also
+            # saw the last write and it's their digest that sticks.
+            start = _HEADER.size + first * self.digest_size
+            size = (last - first + 1) * self.digest_size
+            fcntl.lockf(m, fcntl.LOCK_EX, size, start, 0)
+            digests = []
+            for block in range(first, last + 1):
+                digests.append(hashlib.new(self.checksum, os.pread(
+                    f.fileno(), self.block_size,
+                    block * self.block_size)).digest())
+            os.pwrite(m.fileno(), b''.join(digests), start)
+
+    def _claim(self, m, identity):
+        fcntl.lockf(m, fcntl.LOCK_EX, _HEADER.size, 0, 0)
+        try:
+            if os.pread(m.fileno(), _HEADER.size, 0) != identity:
+                m.truncate(0)
+                os.pwrite(m.fileno(), identity, 0)
+        finally:
+            fcntl.lockf(m, fcntl.LOCK_UN, _HEADER.size, 0, 0)
+
+    def rebuild(self, path, local_path):
+        """
+        throw away the manifest of a file and compute it again from
+        scratch.
+
+        :param path: str
+        :param local_path: str
+        :return: None
+        """
+        self.delete(path)
+        self.update(path, local_path, 0, os.path.getsize(local_path))
+
+    def delete(self, path):
+        delete_file(self.get_local_path(path))
+
+    def delete_prefix(self, prefix):
+        """
+        drop the manifests of every file under a directory.
+        """
+        delete_tree(self.root + prefix.rstrip('/'))
+
+    def read(self, path, local_path, parts=None, first_byte=0,
+             last_byte=None):
+        """
+        load the digests of the blocks overlapping a range of a file.
+
+        A block gets None instead of a digest if it hasn't been written, or
+        if `parts` is given and doesn't cover all of it.
+
+        :param path: str
+        :param local_path: str
+        :param parts: list of byte range strings, or None
+        :param first_byte: int
+        :param last_byte: int or None for the end of the file
+        :return: dict
+        """
+        st = os.stat(local_path)
+        try:
+            with open(self.get_local_path(path), 'rb') as m:
+                raw = m.read()
+        except (IOError, OSError):
+            raw = b''
+        if raw[:_HEADER.size] != _identity(st):
+            raw = b''
+        raw = raw[_HEADER.size:]
+
+        if last_byte is None or last_byte >= st.st_size:
+            last_byte = st.st_size - 1
+        covered = None if parts is None else condense_byte_ranges(
+            parse_byte_ranges_from_list(parts))
+
+        blocks = []
+        first = first_byte // self.block_size
+        last = max(last_byte, first_byte) // self.block_size
+        empty = b'\x00' * self.digest_size
+        for block in range(first, last + 1):
+            digest = raw[block * self.digest_size:
+                         (block + 1) * self.digest_size]
+            start = block * self.block_size
+            end = min(start + self.block_size, st.st_size) - 1
+            if len(digest) != self.digest_size or digest == empty or \
+                    (covered is not None and
+                     not any(a <= start and end <= b for a, b in covered)):
+                blocks.append(None)
+            else:
+                blocks.append(digest.hex())
+
+        return {
+            'checksum': self.checksum,
+            'block_size': self.block_size,
+            'size': st.st_size,
+            'first_block': first,
+            'blocks': blocks,
+        }
@@ -0,0 +1,510 @@
+import array
+import bisect
+import functools
+import json
+import logging
+import os
+import struct
+import sys
+
+from .fs import delete_file, _initialize_file_path, temp_file_path, \
+    replace_file, delete_tree
+
+__all__ = ['MediaIndexes', 'MediaError']
+
+log = logging.getLogger('napfs')
+
+READ_BLOCK_SIZE = 1024 * 64
+
+# boxes whose payload is only more boxes, on the way to the sample tables.
+_CONTAINERS = frozenset([b'moov', b'trak', b'mdia', b'minf', b'stbl',
+                         b'edts', b'dinf'])
+
+_BOX = struct.Struct('>I4s')
+
+
+class MediaError(ValueError):
+    pass
+
+
+def _box_header(buf, pos, end):
+    """
+    :return: type, header size, box size
+    """
+    if pos + 8 > end:
+        raise MediaError('truncated box header at %d' % pos)
+    size, box_type = _BOX.unpack_from(buf, pos)
+    header = 8
+    if size == 1:
+        if pos + 16 > end:
+            raise MediaError('truncated box header at %d' % pos)
+        size = struct.unpack_from('>Q', buf, pos + 8)[0]
+        header = 16
+    elif size == 0:
+        size = end - pos
+    if size < header or pos + size > end:
+        raise MediaError('bad size for %r box at %d' % (box_type, pos))
+    return box_type, header, size
+
+
+def _children(buf, start, end):
+    pos = start
+    while pos + 8 <= end:
+        box_type, header, size = _box_header(buf, pos, end)
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def _uint32s(buf, pos, count):
+    values = array.array('I')
+    if values.itemsize != 4:
+        values = array.array('L')
+    values.frombytes(bytes(buf[pos:pos + count * 4]))
+    if len(values) != count:
+        raise MediaError('truncated sample table')
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def _top_level_header(f, pos, size):
+    f.seek(pos)
+    head = f.read(16)
+    box_size, box_type = _BOX.unpack_from(head, 0)
+    if box_size == 1:
+        box_size = struct.unpack_from('>Q', head, 8)[0]
+    elif box_size == 0:
+        box_size = size - pos
+    if box_size < 8 or pos + box_size > size:
+        raise MediaError('bad size for %r box at %d' % (box_type, pos))
+    return box_type.decode('latin-1'), box_size
+
+
+def _read_boxes(f, size):
+    boxes = []
+    pos = 0
+    while pos + 8 <= size:
+        box_type, box_size = _top_level_header(f, pos, size)
+        boxes.append((box_type, pos, box_size))
+        pos += box_size
+    return boxes
+
+
+class _Track(object):
+    __slots__ = ['id', 'handler', 'timescale', 'duration', 'stts', 'stss',
+                 'stsc', 'sample_size', 'sizes', 'sample_count',
+                 'chunk_offsets', 'tables']
+
+    def __init__(self):
+        self.id = None
+        self.handler = None
+        self.timescale = 1
+        self.duration = 0
+        self.stts = []
+        self.stss = None
+        self.stsc = []
+        self.sample_size = 0
+        self.sizes = None
+        self.sample_count = 0
+        self.chunk_offsets = []
+        self.tables = []
+
+    def _parse(self, buf, start, end):
+        for box_type, pos, box_end in _children(buf, start, end):
+            if box_type in _CONTAINERS:
+                self._parse(buf, pos, box_end)
+            elif box_type == b'tkhd':
+                version = buf[pos]
+                self.id = struct.unpack_from(
+                    '>I', buf, pos + (20 if version == 1 else 12))[0]
+            elif box_type == b'mdhd':
+                if buf[pos] == 1:
+                    self.timescale, self.duration = struct.unpack_from(
+                        '>IQ', buf, pos + 20)
+                else:
+                    self.timescale, self.duration = struct.unpack_from(
+                        '>II', buf, pos + 12)
+            elif box_type == b'hdlr' and self.handler is None:
+                # quicktime files have a second one in minf for the data
+                # handler, the one in mdia comes first.
+                self.handler = bytes(buf[pos + 8:pos + 12]).decode(
+                    'latin-1')
+            elif box_type == b'stts':
+                count = struct.unpack_from('>I', buf, pos + 4)[0]
+                values = _uint32s(buf, pos + 8, count * 2)
+                self.stts = list(zip(values[::2], values[1::2]))
+            elif box_type == b'stss':
+                count = struct.unpack_from('>I', buf, pos + 4)[0]
+                self.stss = _uint32s(buf, pos + 8, count)
+            elif box_type == b'stsc':
+                count = struct.unpack_from('>I', buf, pos + 4)[0]
+                values = _uint32s(buf, pos + 8, count * 3)
+                self.stsc = list(zip(values[::3], values[1::3]))
+            elif box_type == b'stsz':
+                self.sample_size, self.sample_count = struct.unpack_from(
+                    '>II', buf, pos + 4)
+                if not self.sample_size:
+                    self.sizes = _uint32s(buf, pos + 12, self.sample_count)
+            elif box_type == b'stz2':
+                self._parse_stz2(buf, pos)
+            elif box_type in (b'stco', b'co64'):
+                count = struct.unpack_from('>I', buf, pos + 4)[0]
+                if box_type == b'stco':
+                    self.chunk_offsets = list(_uint32s(buf, pos + 8, count))
+                else:
+                    self.chunk_offsets = list(struct.unpack_from(
+                        '>%dQ' % count, buf, pos + 8))
+                self.tables.append((box_type.decode('latin-1'), pos + 8,
+                                    count))
+
+    def _parse_stz2(self, buf, pos):
+        field_size = buf[pos + 7]
+        self.sample_count = struct.unpack_from('>I', buf, pos + 8)[0]
+        n = self.sample_count
+        data = buf[pos + 12:]
+        if field_size == 4:
+            sizes = []
+            for i in range(n):
+                b = data[i // 2]
+                sizes.append(b >> 4 if i % 2 == 0 else b & 0x0f)
+        elif field_size == 8:
+            sizes = list(data[:n])
+        elif field_size == 16:
+            sizes = list(struct.unpack_from('>%dH' % n, data))
+        else:
+            raise MediaError('bad stz2 field size %d' % field_size)
+        self.sizes = sizes
+
+    def _sample_offsets(self):
+        offsets = []
+        sizes = self.sizes
+        runs = self.stsc + [(len(self.chunk_offsets) + 1, 0)]
+        sample = 0
+        for i in range(len(runs) - 1):
+            first, per_chunk = runs[i]
+            for chunk in range(first, runs[i + 1][0]):
+                if chunk > len(self.chunk_offsets):
+                    break
+                offset = self.chunk_offsets[chunk - 1]
+                for _ in range(per_chunk):
+                    if sample >= self.sample_count:
+                        return offsets
+                    offsets.append(offset)
+                    offset += sizes[sample] if sizes is not None else \
+                        self.sample_size
+                    sample += 1
+        return offsets
+
+    def _sample_times(self):
+        times = []
+        t = 0
+        for count, delta in self.stts:
+            for _ in range(count):
+                times.append(t)
+                t += delta
+        return times
+
+    def summary(self):
+        """
+        the times and offsets of the keyframes and the chunks of the track,
+        all that's needed to find where to start reading for a given time.
+        """
+        offsets = self._sample_offsets()
+        times = self._sample_times()
+        n = min(len(offsets), len(times))
+        scale = float(self.timescale or 1)
+
+        chunks = []
+        last_offset = None
+        for i in range(n):
+            # a new chunk starts wherever the samples stop being contiguous.
+            size = self.sizes[i] if self.sizes is not None else \
+                self.sample_size
+            if last_offset is None or offsets[i] != last_offset:
+                chunks.append([times[i] / scale, offsets[i]])
+            last_offset = offsets[i] + size
+
+        keyframes = None
+        if self.stss is not None:
+            keyframes = [[times[s - 1] / scale, offsets[s - 1]]
+                         for s in self.stss if 0 < s <= n]
+
+        return {
+            'id': self.id,
+            'handler': self.handler,
+            'timescale': self.timescale,
+            'duration': self.duration / scale,
+            'samples': self.sample_count,
+            'keyframes': keyframes,
+            'chunks': chunks,
+        }
+
+
+def build_index(f, size):
+    """
+    read the box layout and the sample tables of an mp4 file.
+
+    :param f: file object
+    :param size: int
+    :return: dict
+    """
+    boxes = _read_boxes(f, size)
+    if not boxes or boxes[0][0] != 'ftyp':
+        raise MediaError('not an mp4 file')
+    moov = [b for b in boxes if b[0] == 'moov']
+    if not moov:
+        raise MediaError('no moov box')
+    _, moov_offset, moov_size = moov[0]
+    f.seek(moov_offset)
+    buf = memoryview(f.read(moov_size))
+    _, header, _ = _box_header(buf, 0, len(buf))
+
+    tracks = []
+    for box_type, pos, end in _children(buf, header, len(buf)):
+        if box_type == b'trak':
+            track = _Track()
+            track._parse(buf, pos, end)
+            tracks.append(track)
+
+    return {
+        'boxes': [list(b) for b in boxes],
+        'moov': [moov_offset, moov_size],
+        'tables': [[kind, pos, count] for t in tracks
+                   for kind, pos, count in t.tables],
+        'tracks': [t.summary() for t in tracks],
+    }
+
+
+class _View(object):
+    """
+    a file as a list of segments, each either a range of the file on disk
+    or bytes held in memory, served as if it was one file.
+    """
+    __slots__ = ['f', 'segments', 'size', 'index', 'insert_at', 'shift',
+                 'moved']
+
+    def __init__(self, f, index, file_size, moov=None):
+        self.f = f
+        self.index = index
+        moov_offset, moov_size = index['moov']
+        mdat = [b[1] for b in index['boxes'] if b[0] == 'mdat']
+        self.insert_at = mdat[0] if mdat else 0
+        self.shift = moov_size
+        self.moved = moov is not None
+        if not self.moved:
+            self.segments = [(0, file_size, None)]
+        else:
+            moov_end = moov_offset + moov_size
+            self.segments = [
+                (0, self.insert_at, None),
+                (0, moov_size, moov),
+                (self.insert_at, moov_offset - self.insert_at, None),
+                (moov_end, file_size - moov_end, None),
+            ]
+            self.segments = [s for s in self.segments if s[1] > 0]
+        self.size = file_size
+
+    def translate(self, offset):
+        """
+        where a byte of the file on disk ends up in this view.
+        """
+        if self.moved and self.insert_at <= offset < self.index['moov'][0]:
+            return offset + self.shift
+        return offset
+
+    def seek(self, t):
+        """
+        find where to start reading to play from `t` seconds on: the last
+        keyframe of the video at or before `t`, and for every track the
+        chunk that holds what plays at that time.
+
+        :param t: float
+        :return: int offset in this view, float time of the keyframe
+        """
+        tracks = self.index['tracks']
+        if not tracks:
+            raise MediaError('no tracks')
+        video = [tr for tr in tracks if tr['handler'] == 'vide']
+        video = video[0] if video else tracks[0]
+        points = video['keyframes'] or video['chunks']
+        if not points:
+            raise MediaError('no samples')
+        i = max(0, bisect.bisect_right([p[0] for p in points], t) - 1)
+        keyframe_time, start = points[i]
+
+        for track in tracks:
+            chunks = track['chunks']
+            if not chunks:
+                continue
+            j = max(0, bisect.bisect_right(
+                [c[0] for c in chunks], keyframe_time) - 1)
+            start = min(start, chunks[j][1])
+        return self.translate(start), keyframe_time
+
+    def reader(self, first_byte, length):
+        """
+        read a range of the view. The file gets closed once it's done.
+
+        :param first_byte: int
+        :param length: int
+        :return: callable returning a generator of bytes
+        """
+        return functools.partial(self._read, first_byte, length)
+
+    def _read(self, first_byte, length):
+        end = first_byte + length
+        pos = 0
+        try:
+            for source_start, size, content in self.segments:
+                seg_first, seg_end = max(first_byte, pos), min(end,
+                                                               pos + size)
+                pos += size
+                if seg_first >= seg_end:
+                    continue
+                start = source_start + seg_first - (pos - size)
+                if content is not None:
+                    yield content[start:start + seg_end - seg_first]
+                    continue
+                remaining = seg_end - seg_first
+                while remaining > 0:
+                    chunk = os.pread(self.f.fileno(),
+                                     min(READ_BLOCK_SIZE, remaining), start)
+                    if not chunk:
+                        break
+                    yield chunk
+                    start += len(chunk)
+                    remaining -= len(chunk)
+        finally:
+            self.f.close()
+
+    def close(self):
+        self.f.close()
+
+
+def _identity(st):
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+class MediaIndexes(object):
+    """
+    Keeps an index of the boxes and the sample tables of the mp4 files, so
+    they can be served with the `moov` box first (faststart), which lets a
+    player start without hunting for it at the end of the file, and so a
+    time can be mapped to the byte to start reading at.
+
+    The indexes live in `root`, one per file at the same relative path plus
+    `.mp4index`, as json. Only paths ending in one of the `extensions` get
+    one. An index is built once an upload is complete, and again whenever
+    it turns out to be older than the file it describes.
+    """
+    __slots__ = ['root', 'extensions']
+
+    def __init__(self, root, extensions=('.mp4', '.m4v', '.m4a', '.mov')):
+        self.root = root.rstrip('/')
+        self.extensions = tuple(extensions)
+
+    def get_local_path(self, path):
+        return '%s%s.mp4index' % (self.root, path)
+
+    def handles(self, path):
+        return path.lower().endswith(self.extensions)
+
+    def update(self, path, local_path):
+        """
+        build the index of a file, unless the one there is up to date.
+
+        :param path: str, the path of the file in napfs
+        :param local_path: str, where the file is
+        :return: dict, the index
+        """
+        with open(local_path, 'rb') as f:
+            return self._update(path, f)
+
+    def _update(self, path, f):
+        st = os.fstat(f.fileno())
+        index = self._load(path)
+        if index is not None and index['identity'] == _identity(st):
+            return index
+
+        try:
+            index = build_index(f, st.st_size)
+        except (MediaError, struct.error) as e:
+            log.info('no media index for %s: %s', path, e)
+            index = {'error': '%s' % e}
+        index['identity'] = _identity(st)
+
+        index_path = self.get_local_path(path)
+        _initialize_file_path(index_path)
+        tmp_path = temp_file_path(index_path)
+        try:
+            with open(tmp_path, 'w') as out:
+                json.dump(index, out)
+            replace_file(tmp_path, index_path)
+        except BaseException:
+            delete_file(tmp_path)
+            raise
+        return index
+
+    def _load(self, path):
+        try:
+            with open(self.get_local_path(path)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def delete(self, path):
+        delete_file(self.get_local_path(path))
+
+    def delete_prefix(self, prefix):
+        """
+        drop the indexes of every file under a directory.
+        """
+        delete_tree(self.root + prefix.rstrip('/'))
+
+    def view(self, path, local_path, faststart=True):
+        """
+        open a file for serving through its index.
+
+        :param path: str
+        :param local_path: str
+        :param faststart: bool, move the moov box in front of the media
+        :return: _View, or None if the file isn't a usable mp4
+        """
+        f = open(local_path, 'rb')
+        try:
+            index = self._update(path, f)
+            if 'error' in index:
+                f.close()
+                return None
+            moov = None
+            moov_offset, moov_size = index['moov']
+            mdat = [b[1] for b in index['boxes'] if b[0] == 'mdat']
+            if faststart and mdat and mdat[0] < moov_offset:
+                moov = self._faststart_moov(f, index)
+            return _View(f, index, index['identity'][2], moov=moov)
+        except BaseException:
+            f.close()
+            raise
+
+    def _faststart_moov(self, f, index):
+        """
+        the moov box with its chunk offsets moved along with the media that
+        ends up after it.
+        """
+        moov_offset, moov_size = index['moov']
+        insert_at = [b[1] for b in index['boxes'] if b[0] == 'mdat'][0]
+        f.seek(moov_offset)
+        moov = bytearray(f.read(moov_size))
+        for kind, pos, count in index['tables']:
+            fmt = '>%dI' % count if kind == 'stco' else '>%dQ' % count
+            offsets = list(struct.unpack_from(fmt, moov, pos))
+            for i, offset in enumerate(offsets):
+                if insert_at <= offset < moov_offset:
+                    offsets[i] = offset + moov_size
+            if kind == 'stco' and offsets and max(offsets) > 0xffffffff:
+                # the offsets no longer fit 32 bits. widening the table
+                # would change the size of the moov box, so leave the file
+                # as it is.
+                return None
+            struct.pack_into(fmt, moov, pos, *offsets)
+        return bytes(moov)
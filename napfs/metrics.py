@@ -0,0 +1,313 @@
+import bisect
+import os
+import threading
+
+from .fs import lock_stats
+
+__all__ = ['Metrics', 'Registry']
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+        for k, v in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+    return '%s' % value
+
+
+class _Metric(object):
+    """
+    If a callback is given, it is called to get the value at scrape time,
+    which keeps the cost off the request path entirely.
+    """
+    __slots__ = ['name', 'help', 'labelnames', 'callback', '_values',
+                 '_lock']
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        if self.callback is not None:
+            return self.callback()
+        return self._values.get(labels, 0)
+
+    def render(self):
+        if self.callback is not None:
+            value = self.callback()
+            if value is None:
+                return []
+            values = [((), value)]
+        else:
+            with self._lock:
+                values = sorted(self._values.items())
+
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for labels, value in values:
+            lines.append('%s%s %s' % (
+                self.name, _format_labels(self.labelnames, labels),
+                _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    __slots__ = []
+    kind = 'counter'
+
+
+class Gauge(_Metric):
+    __slots__ = []
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels=labels)
+
+
+class Histogram(_Metric):
+    __slots__ = ['buckets']
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames=labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(labels)
+            if row is None:
+                # one slot per bucket, one for +Inf, then the sum.
+                row = self._values[labels] = [0] * (len(self.buckets) + 2)
+            row[i] += 1
+            row[-1] += value
+
+    def count(self, labels=()):
+        row = self._values.get(labels)
+        return 0 if row is None else sum(row[:-1])
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        for labels, row in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), row):
+                total += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    _format_labels(self.labelnames, labels,
+                                   ('le', _format_value(float(bound)))),
+                    total))
+            suffix = _format_labels(self.labelnames, labels)
+            lines.append('%s_sum%s %s' % (self.name, suffix, row[-1]))
+            lines.append('%s_count%s %d' % (self.name, suffix, total))
+        return lines
+
+
+class Registry(object):
+    """
+    A minimal collection of metrics that renders itself in the prometheus
+    text exposition format.
+    """
+    __slots__ = ['_metrics']
+
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=(), callback=None):
+        return self._add(Counter(name, help, labelnames=labelnames,
+                                 callback=callback))
+
+    def gauge(self, name, help, labelnames=(), callback=None):
+        return self._add(Gauge(name, help, labelnames=labelnames,
+                               callback=callback))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labelnames=labelnames,
+                                   buckets=buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _count_open_files():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+class Metrics(object):
+    """
+    The metrics napfs keeps about itself when New Relic is not around.
+    Pass an instance to the `Router` to turn them on.
+    """
+    __slots__ = ['registry', 'requests', 'bytes_in', 'bytes_out',
+                 'metadata', 'checksum_failures', 'open_files']
+
+    def __init__(self, registry=None):
+        self.registry = registry = registry or Registry()
+        self.requests = registry.histogram(
+            'napfs_request_duration_seconds',
+            'Time spent in the request handlers.',
+            labelnames=('method',))
+        self.bytes_in = registry.counter(
+            'napfs_received_bytes_total',
+            'Bytes of request bodies written to disk.')
+        self.bytes_out = registry.counter(
+            'napfs_sent_bytes_total',
+            'Bytes of file content sent in responses.')
+        self.metadata = registry.histogram(
+            'napfs_metadata_duration_seconds',
+            'Time spent running metadata pipelines.')
+        self.checksum_failures = registry.counter(
+            'napfs_checksum_failures_total',
+            'Uploads rejected because of a checksum mismatch.')
+        self.open_files = registry.gauge(
+            'napfs_open_files',
+            'File descriptors open in this process.',
+            callback=_count_open_files)
+        registry.counter('napfs_write_lock_wait_seconds_total',
+                         'Time writes spent waiting on file locks.',
+                         callback=lambda: lock_stats.wait_seconds)
+        registry.counter('napfs_write_lock_held_seconds_total',
+                         'Time writes spent holding file locks.',
+                         callback=lambda: lock_stats.write_seconds)
+        registry.counter('napfs_write_lock_contended_total',
+                         'Writes that found their file lock taken.',
+                         callback=lambda: lock_stats.contended)
+
+    def watch_cache(self, cache):
+        """
+        export the hit and miss counters of an `ObjectCache`.
+
+        :param cache: napfs.ObjectCache
+        :return: None
+        """
+        self.registry.counter('napfs_cache_hits_total',
+                              'Reads served from the object cache.',
+                              callback=lambda: cache.hits)
+        self.registry.counter('napfs_cache_misses_total',
+                              'Reads that missed the object cache.',
+                              callback=lambda: cache.misses)
+        self.registry.gauge('napfs_cache_bytes',
+                            'Bytes of content held in the object cache.',
+                            callback=lambda: cache.size)
+
+    def watch_sweeper(self, sweeper):
+        """
+        export what a `Sweeper` has cleaned up so far.
+
+        :param sweeper: napfs.Sweeper
+        :return: None
+        """
+        self.registry.counter('napfs_sweeper_removed_files_total',
+                              'Abandoned uploads removed by the sweeper.',
+                              callback=lambda: sweeper.removed)
+        self.registry.counter('napfs_sweeper_reclaimed_bytes_total',
+                              'Bytes reclaimed by the sweeper.',
+                              callback=lambda: sweeper.reclaimed_bytes)
+
+    def watch_admission(self, admission):
+        """
+        export the writes an `Admission` let in and turned away.
+
+        :param admission: napfs.Admission
+        :return: None
+        """
+        self.registry.gauge('napfs_admission_in_flight',
+                            'Writes in progress.',
+                            callback=lambda: admission.in_flight)
+        self.registry.gauge('napfs_admission_buffered_bytes',
+                            'Declared body bytes of the writes in progress.',
+                            callback=lambda: admission.buffered_bytes)
+        self.registry.counter('napfs_admission_admitted_total',
+                              'Writes let in.',
+                              callback=lambda: admission.admitted)
+        self.registry.counter('napfs_admission_rejected_total',
+                              'Writes turned away with a 503.',
+                              callback=lambda: admission.rejected)
+
+    def watch_replicator(self, replicator):
+        """
+        export how far behind the peers of a `Replicator` are.
+
+        :param replicator: napfs.Replicator
+        :return: None
+        """
+        def lag(key):
+            return lambda: sum(v[key] for v in replicator.lag().values())
+
+        self.registry.gauge('napfs_replication_queued',
+                            'Changes waiting to be sent to the peers.',
+                            callback=lag('queued'))
+        self.registry.gauge('napfs_replication_lag_seconds',
+                            'Age of the oldest change not sent to a peer.',
+                            callback=lambda: max(
+                                [v['oldest_seconds'] for v in
+                                 replicator.lag().values()] or [0]))
+        self.registry.counter('napfs_replication_sent_total',
+                              'Changes sent to the peers.',
+                              callback=lag('sent'))
+        self.registry.counter('napfs_replication_failed_total',
+                              'Changes given up on after retrying.',
+                              callback=lag('failed'))
+
+    def watch_tiering(self, tiering):
+        """
+        export the files a `Tiering` moved between the tiers.
+
+        :param tiering: napfs.Tiering
+        :return: None
+        """
+        self.registry.counter('napfs_tiering_demoted_files_total',
+                              'Files moved to the cold tier.',
+                              callback=lambda: tiering.demoted)
+        self.registry.counter('napfs_tiering_promoted_files_total',
+                              'Files moved back to the fast tier.',
+                              callback=lambda: tiering.promoted)
+        self.registry.gauge('napfs_tiering_promotions_queued',
+                            'Files read from the cold tier waiting to be '
+                            'moved back.',
+                            callback=tiering.pending)
+
+    def render(self):
+        return self.registry.render()
@@ -0,0 +1,112 @@
+import http.client
+import socket
+import threading
+import urllib.parse
+
+__all__ = ['Peer']
+
+# errors that mean a kept alive connection got closed by the other side
+# while it sat in the pool. the request is safe to send again on a new one.
+_STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                 BrokenPipeError, ConnectionResetError)
+
+
+class Peer(object):
+    """
+    Another napfs node, reached over http. Connections are kept alive and
+    pooled, so talking to the same peer over and over doesn't pay for a new
+    tcp connection every time.
+    """
+    __slots__ = ['url', 'host', 'port', 'https', 'timeout', 'max_idle',
+                 '_idle', '_lock']
+
+    def __init__(self, url, timeout=10, max_idle=8):
+        parsed = urllib.parse.urlsplit(url)
+        self.url = url.rstrip('/')
+        self.https = parsed.scheme == 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.https else 80)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Peer(%r)' % self.url
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else \
+            http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def open(self, method, path, body=None, headers=None):
+        """
+        send a request and return the response without reading its body,
+        so it can be streamed. Hand both back to `release` when done.
+
+        :param method: str
+        :param path: str, with the query string
+        :param body: bytes, file-like object or None
+        :param headers: dict
+        :return: http.client.HTTPConnection, http.client.HTTPResponse
+        """
+        # a body streamed from somewhere else can't be sent twice, so it
+        # never goes on a pooled connection that might turn out stale.
+        replayable = body is None or isinstance(body, bytes) or \
+            (hasattr(body, 'seekable') and body.seekable())
+        conn = None
+        if replayable:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+
+        if conn is not None:
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                return conn, conn.getresponse()
+            except _STALE_ERRORS:
+                conn.close()
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+
+        conn = self._connect()
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            return conn, conn.getresponse()
+        except (OSError, socket.timeout, http.client.HTTPException):
+            conn.close()
+            raise
+
+    def release(self, conn, res):
+        """
+        put a connection back in the pool, if its response was read to the
+        end and the peer is willing to keep it open.
+        """
+        if not res.isclosed() or res.will_close:
+            conn.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        send a request and read the whole response.
+
+        :return: int status, list of (name, value) headers, bytes body
+        """
+        conn, res = self.open(method, path, body=body, headers=headers)
+        try:
+            content = res.read()
+        except BaseException:
+            conn.close()
+            raise
+        self.release(conn, res)
+        return res.status, res.getheaders(), content
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
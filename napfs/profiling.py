@@ -0,0 +1,102 @@
+import atexit
+import cProfile
+import functools
+import hmac
+import os
+import pstats
+import random
+import threading
+
+__all__ = ['Profiler', 'profiled']
+
+
+class Profiler(object):
+    """
+    Runs a sample of requests under cProfile and aggregates the stats per
+    handler. The aggregated stats are dumped into `output_dir` as
+    `napfs-<handler>.pstats` files, readable with `pstats` or tools like
+    snakeviz.
+
+    A request gets profiled if it wins the `sample_rate` lottery, or if it
+    carries `header` set to the configured `token`. Without a token, the
+    header is ignored, so nobody can force profiling on a server that
+    didn't ask for it.
+    """
+    __slots__ = ['output_dir', 'sample_rate', 'header', 'token',
+                 'flush_every', 'samples', '_stats', '_pending', '_lock']
+
+    def __init__(self, output_dir, sample_rate=0.0, header='x-napfs-profile',
+                 token=None, flush_every=10):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.header = header
+        self.token = token
+        self.flush_every = flush_every
+        self.samples = 0
+        self._stats = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def should_profile(self, req):
+        if self.token is not None:
+            value = req.get_header(self.header)
+            if value is not None and hmac.compare_digest(value, self.token):
+                return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def run(self, name, f, *args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is already running in this process, most
+            # likely on a concurrent request. skip this one.
+            return f(*args, **kwargs)
+
+        try:
+            return f(*args, **kwargs)
+        finally:
+            profile.disable()
+            self._add(name, profile)
+
+    def _add(self, name, profile):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                self._stats[name] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self.samples += 1
+            self._pending += 1
+            if self._pending < self.flush_every:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            if not os.path.exists(self.output_dir):
+                os.makedirs(self.output_dir)
+            for name, stats in self._stats.items():
+                stats.dump_stats(
+                    os.path.join(self.output_dir, 'napfs-%s.pstats' % name))
+            self._pending = 0
+
+
+def profiled(f):
+    """
+    wrap a `Router` handler so it runs under the router's profiler, if it
+    has one and the request gets picked.
+    """
+    name = f.__name__
+
+    @functools.wraps(f)
+    def inner(self, req, resp):
+        profiler = self.profiler
+        if profiler is None or not profiler.should_profile(req):
+            return f(self, req, resp)
+        return profiler.run(name, f, self, req, resp)
+
+    return inner
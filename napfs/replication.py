@@ -0,0 +1,256 @@
+import collections
+import itertools
+import logging
+import queue
+import threading
+import time
+import urllib.parse
+
+from .fs import file_slice
+from .helpers import parse_byte_ranges_from_list, get_last_contiguous_byte
+from .peers import Peer
+
+__all__ = ['Replicator']
+
+log = logging.getLogger('napfs')
+
+
+class _Op(object):
+    __slots__ = ['kind', 'path', 'offset', 'length', 'headers', 'queued']
+
+    def __init__(self, kind, path, offset=0, length=0, headers=None):
+        self.kind = kind
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.headers = headers or {}
+        self.queued = time.monotonic()
+
+
+def _coalesce(ops, max_bytes):
+    """
+    merge the patches to the same path that touch or overlap into one,
+    without moving them past a post or a delete of that path.
+    """
+    merged = []
+    open_patches = {}
+    for op in ops:
+        last = open_patches.get(op.path)
+        if op.kind != 'patch':
+            open_patches.pop(op.path, None)
+            merged.append(op)
+            continue
+        if last is not None and \
+                last.offset <= op.offset <= last.offset + last.length:
+            end = max(last.offset + last.length, op.offset + op.length)
+            if end - last.offset <= max_bytes:
+                last.length = end - last.offset
+                last.headers.update(op.headers)
+                continue
+        op = _Op('patch', op.path, op.offset, op.length, dict(op.headers))
+        open_patches[op.path] = op
+        merged.append(op)
+    return merged
+
+
+class _Replica(object):
+    """
+    the queue of changes for one peer, and what we know the peer has.
+    """
+    __slots__ = ['peer', 'queue', 'pending', 'prefixes', 'sent', 'failed',
+                 'thread']
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.queue = queue.Queue()
+        self.pending = collections.Counter()
+        self.prefixes = collections.OrderedDict()
+        self.sent = 0
+        self.failed = 0
+        self.thread = None
+
+
+class Replicator(object):
+    """
+    Copies the writes made to this node to peer napfs nodes in the
+    background, so they can take some of the reads.
+
+    Each change gets queued per peer once it is on disk and in the
+    metadata. A thread per peer forwards them: chunks as PATCH requests,
+    with the chunks of a path that touch each other merged up to
+    `max_batch_bytes`, whole files as POST and deletes as DELETE. The
+    content is read from disk when it is sent. Failed requests are retried
+    `max_retries` times, backing off from `retry_delay` seconds.
+
+    From the parts each peer reports back, the replicator knows how much of
+    each file the peer has from the first byte on. With `spread_reads`, a
+    GET goes round robin between this node and the peers that have all of
+    the requested range and nothing queued for the path.
+    """
+    __slots__ = ['replicas', 'batch_size', 'max_batch_bytes', 'max_retries',
+                 'retry_delay', 'spread_reads', 'max_paths', '_local_path',
+                 '_lock', '_rr']
+
+    def __init__(self, peers, batch_size=100, max_batch_bytes=1024 * 1024 * 8,
+                 max_retries=5, retry_delay=0.5, timeout=10,
+                 spread_reads=True, max_paths=100000):
+        self.replicas = [_Replica(Peer(url, timeout=timeout))
+                         for url in peers]
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.spread_reads = spread_reads
+        self.max_paths = max_paths
+        self._local_path = None
+        self._lock = threading.Lock()
+        self._rr = itertools.count()
+
+    def start(self, local_path):
+        """
+        :param local_path: callable giving the local file of a path
+        """
+        self._local_path = local_path
+        for replica in self.replicas:
+            if replica.thread is None:
+                replica.thread = threading.Thread(
+                    target=self._work, args=(replica,),
+                    name='napfs-replicate-%s' % replica.peer.host)
+                replica.thread.daemon = True
+                replica.thread.start()
+
+    def _enqueue(self, op):
+        for replica in self.replicas:
+            with self._lock:
+                replica.pending[op.path] += 1
+            replica.queue.put(op)
+
+    def patch(self, path, offset, length, headers=None):
+        if length > 0:
+            self._enqueue(_Op('patch', path, offset, length, headers))
+
+    def post(self, path, headers=None):
+        self._enqueue(_Op('post', path, headers=headers))
+
+    def delete(self, path):
+        self._enqueue(_Op('delete', path))
+
+    def flush(self):
+        """
+        block until everything queued so far has been sent or given up on.
+        """
+        for replica in self.replicas:
+            replica.queue.join()
+
+    def lag(self):
+        """
+        how far behind each peer is.
+
+        :return: dict of peer url to a dict of stats
+        """
+        now = time.monotonic()
+        stats = {}
+        for replica in self.replicas:
+            with replica.queue.mutex:
+                oldest = replica.queue.queue[0].queued \
+                    if replica.queue.queue else None
+                queued = len(replica.queue.queue)
+            stats[replica.peer.url] = {
+                'queued': queued,
+                'oldest_seconds': 0.0 if oldest is None else now - oldest,
+                'sent': replica.sent,
+                'failed': replica.failed,
+            }
+        return stats
+
+    def replica_for(self, path, last_byte):
+        """
+        pick where a read of `path` up to `last_byte` should go.
+
+        :return: Peer, or None to serve it here
+        """
+        with self._lock:
+            choices = [None] + [
+                r.peer for r in self.replicas
+                if not r.pending[path] and
+                r.prefixes.get(path, -1) >= last_byte]
+        return choices[next(self._rr) % len(choices)]
+
+    def _work(self, replica):
+        while True:
+            ops = [replica.queue.get()]
+            while len(ops) < self.batch_size:
+                try:
+                    ops.append(replica.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for op in _coalesce(ops, self.max_batch_bytes):
+                    self._send(replica, op)
+            finally:
+                with self._lock:
+                    for op in ops:
+                        replica.pending[op.path] -= 1
+                        if not replica.pending[op.path]:
+                            del replica.pending[op.path]
+                for _ in ops:
+                    replica.queue.task_done()
+
+    def _send(self, replica, op):
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                status, headers = self._request(replica.peer, op)
+                if status < 500:
+                    break
+                error = 'status %d' % status
+            except Exception as e:
+                error = '%s' % e
+            if attempt < self.max_retries:
+                time.sleep(delay)
+                delay *= 2
+        else:
+            log.error('replicating %s %s to %s failed: %s', op.kind,
+                      op.path, replica.peer.url, error)
+            replica.failed += 1
+            with self._lock:
+                replica.prefixes.pop(op.path, None)
+            return
+
+        replica.sent += 1
+        with self._lock:
+            replica.prefixes.pop(op.path, None)
+            if op.kind == 'delete' or status >= 300:
+                return
+            ranges = parse_byte_ranges_from_list(
+                dict(headers).get('x-parts', '').split(','))
+            if ranges and ranges[0][0] == 0:
+                replica.prefixes[op.path] = get_last_contiguous_byte(ranges)
+                while len(replica.prefixes) > self.max_paths:
+                    replica.prefixes.popitem(last=False)
+
+    def _request(self, peer, op):
+        url = urllib.parse.quote(op.path)
+        headers = dict(op.headers)
+        if op.kind == 'delete':
+            status, res_headers, _ = peer.request('DELETE', url)
+            return status, res_headers
+
+        try:
+            f = open(self._local_path(op.path), 'rb')
+        except (IOError, OSError):
+            # gone since, a delete will follow.
+            return 200, []
+
+        # the content is streamed from the file, never read into memory.
+        with f:
+            if op.kind == 'patch':
+                body = file_slice(f, op.offset, op.length)
+                url += '?offset=%d' % op.offset
+            else:
+                body = file_slice(f)
+            headers['Content-Length'] = '%d' % body.length
+            status, res_headers, _ = peer.request(
+                'PATCH' if op.kind == 'patch' else 'POST', url, body=body,
+                headers=headers)
+        return status, [(k.lower(), v) for k, v in res_headers]
@@ -1,29 +1,116 @@
+import functools
 import io
+import json
+import logging
 import mimetypes
+import os
 import time
 import falcon
 
 from .fs import open_file, read_file_chunk, checksum_response, copy_file, \
-    delete_file, write_file_chunk
-from .data import MetaData
+    delete_file, write_file_chunk, FileMaps, get_file_sizes, list_dir, \
+    temp_file_path, replace_file
+from .cluster import RebalanceJob
+from .data import MetaData, get_many, get_backend
+from .jobs import JobManager, PrefixDeleteJob
+from .media import MediaError
+from .sharding import ShardedRedis
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .timing import Timings
 
 from .helpers import parse_byte_range_header, \
     get_last_contiguous_byte, parse_byte_ranges_from_list, \
-    condense_byte_ranges, InvalidChecksumException
+    condense_byte_ranges, InvalidChecksumException, complete_marker
+
+log = logging.getLogger('napfs')
 
 
 class Router(object):
     allowed_methods = ['GET', 'PUT', 'PATCH', 'POST', 'DELETE']
 
-    __slots__ = ['data_dir', 'path_tpl', '_db', 'passthru']
+    write_methods = ['PATCH', 'PUT', 'POST']
+
+    read_modes = ['buffered', 'mmap']
+
+    __slots__ = ['data_dir', 'path_tpl', '_db', 'passthru', 'cache', 'maps',
+                 'metrics', 'endpoints', 'server_timing', 'slow_threshold',
+                 'profiler', 'bulk_limit', 'listing', 'listing_limit', 'jobs',
+                 'delete_rate', 'sweeper', 'write_behind', 'manifests',
+                 'shaper', 'admission', 'replicator', 'cluster', 'tiering',
+                 'media', 'sidecars']
 
     def __init__(self, data_dir, redis_connection=None,
-                 passthrough_headers=None):
+                 passthrough_headers=None, cache=None, read_mode='buffered',
+                 metrics=None, metrics_path='/_metrics', server_timing=False,
+                 slow_request_threshold=None, profiler=None, bulk_path=None,
+                 bulk_limit=100000, listing=False, listing_limit=10000,
+                 jobs_path=None, delete_rate=None, sweeper=None,
+                 metadata_backend=None, write_behind=None, manifests=None,
+                 shaper=None, admission=None, replicator=None,
+                 cluster=None, tiering=None, media=None):
+        if read_mode not in self.read_modes:
+            raise ValueError('invalid read_mode %s' % read_mode)
         self.data_dir = data_dir
         self.path_tpl = data_dir + "%s"
-        self._db = redis_connection
+        if isinstance(redis_connection, (list, tuple, dict)):
+            redis_connection = ShardedRedis(redis_connection)
+        if metadata_backend is not None:
+            redis_connection = metadata_backend
+        self._db = get_backend(redis_connection)
+        self.write_behind = write_behind
+        if write_behind is not None:
+            write_behind.start(self._db)
+            self._db = write_behind
         self.passthru = passthrough_headers or []
         self.passthru = [x.lower() for x in self.passthru]
+        self.cache = cache
+        self.maps = FileMaps() if read_mode == 'mmap' else None
+        self.metrics = metrics
+        self.server_timing = server_timing
+        self.slow_threshold = slow_request_threshold
+        self.profiler = profiler
+        self.bulk_limit = bulk_limit
+        self.listing = listing
+        self.listing_limit = listing_limit
+        self.jobs = JobManager() if jobs_path else None
+        self.delete_rate = delete_rate
+        self.sweeper = sweeper
+        self.manifests = manifests
+        self.shaper = shaper
+        self.admission = admission
+        self.replicator = replicator
+        self.cluster = cluster
+        self.media = media
+        # the stores keeping files of their own next to each data file.
+        self.sidecars = [s for s in (manifests, media) if s is not None]
+        self.tiering = tiering
+        if tiering is not None:
+            tiering.start(data_dir, jobs=self.jobs)
+        if replicator is not None:
+            replicator.start(self.get_local_path)
+        if sweeper is not None:
+            sweeper.start(data_dir, self._db, jobs=self.jobs, cache=cache,
+                          sidecars=self.sidecars)
+
+        # paths reserved for napfs itself instead of files in the data dir.
+        self.endpoints = {}
+        if metrics is not None:
+            if cache is not None:
+                metrics.watch_cache(cache)
+            if sweeper is not None:
+                metrics.watch_sweeper(sweeper)
+            if admission is not None:
+                metrics.watch_admission(admission)
+            if replicator is not None:
+                metrics.watch_replicator(replicator)
+            if tiering is not None:
+                metrics.watch_tiering(tiering)
+            if metrics_path:
+                self.endpoints[metrics_path] = self.on_metrics
+        if bulk_path:
+            self.endpoints[bulk_path] = self.on_bulk_meta
+        if jobs_path:
+            self.endpoints[jobs_path] = self.on_jobs
 
     def get_local_path(self, uri):
         return self.path_tpl % uri
@@ -38,6 +125,59 @@ class Router(object):
         :param resp: falcon.Response
         :return: None
         """
+        if self.endpoints:
+            handler = self.endpoints.get(req.path)
+            if handler is not None:
+                return handler(req, resp)
+
+        if self.metrics is None:
+            return self._route(req, resp)
+
+        start = time.time()
+        try:
+            return self._route(req, resp)
+        finally:
+            self.metrics.requests.observe(time.time() - start,
+                                          labels=(req.method,))
+
+    def _route(self, req, resp):
+        if self.cluster is not None:
+            owner = self.cluster.should_forward(req)
+            if owner is not None:
+                return self.cluster.forward(req, resp, owner)
+
+        if self.admission is None or req.method not in self.write_methods:
+            return self._dispatch(req, resp)
+
+        ticket = self.admission.admit(req.path, self._content_length(req))
+        if ticket is None:
+            raise falcon.HTTPServiceUnavailable(
+                title='BUSY',
+                description='too many writes in progress, try again later',
+                retry_after=self.admission.retry_after())
+        try:
+            return self._dispatch(req, resp)
+        finally:
+            self.admission.release(ticket)
+
+    def rebalance(self, rate=None):
+        """
+        move the files this node doesn't own anymore to their new node,
+        after the nodes of the cluster changed. Runs in the background if
+        the jobs endpoint is enabled, so it can be followed there.
+
+        :param rate: int, the most files to move per second
+        :return: RebalanceJob
+        """
+        if self.cluster is None:
+            raise ValueError('not part of a cluster')
+        job = RebalanceJob(self, rate=rate)
+        if self.jobs is not None:
+            return self.jobs.submit(job)
+        job()
+        return job
+
+    def _dispatch(self, req, resp):
         method = req.method
 
         if method == 'GET':
@@ -64,6 +204,12 @@ class Router(object):
         if data.disabled:
             return first_byte, last_byte
 
+        # a complete file has all of its bytes, no need to look at the parts.
+        if data.complete:
+            if last_byte == '' or last_byte >= data.total_length:
+                last_byte = data.total_length - 1
+            return first_byte, last_byte
+
         byte_ranges = parse_byte_ranges_from_list(data.parts)
 
         last_contig_byte = get_last_contiguous_byte(byte_ranges)
@@ -88,44 +234,64 @@ class Router(object):
 
     def _get(self, req, resp, body):
         """
-        Fetch a file or byte range request.
+        Fetch a file or byte range request, or a listing or manifest when
+        asked for one.
 
         :param req: falcon.Request
         :param resp: falcon.Response
         :return: None
         """
-        path = req.path
-
-        if not path:
+        if not req.path:
             raise falcon.HTTPNotFound()
 
-        data = self._data(path=req.path)
+        if self.listing and req.get_param('list') is not None:
+            return self._list(req, resp, body)
 
-        first_byte, last_byte = self._get_byte_range(data, req, resp)
+        if self.manifests is not None and \
+                req.get_param('manifest') is not None:
+            return self._manifest(req, resp, body)
 
-        self._add_metadata_to_resp(resp, data)
+        return self._send_file(req, resp, body)
 
-        try:
-            f = open_file(self.get_local_path(path), 'rb')
-        except IOError:
-            raise falcon.HTTPNotFound()
+    def _open(self, path, req, resp, timings=None):
+        """
+        pick where the content of a GET comes from: the media index, the
+        object cache or the file itself.
 
-        try:
-            f.seek(0, io.SEEK_END)
-            last_file_byte = f.tell() - 1
-        except OSError:
-            raise falcon.HTTPNotFound()
+        :return: first_byte, last_byte, last_file_byte, reader
+        """
+        if self._is_media_request(req):
+            return self._open_media(path, req, resp, timings)
+
+        entry = None if self.cache is None else self.cache.get(path)
+        if entry is None:
+            return self._open_for_read(path, req, resp, timings)
+
+        first_byte, last_byte = parse_byte_range_header(
+            req.get_header('range'))
+        for k, v in entry.headers:
+            resp.append_header(k, v)
+        return first_byte, last_byte, len(entry.content) - 1, entry.reader
+
+    def _send_file(self, req, resp, body):
+        path = req.path
+        timings = self._start_timings()
+
+        first_byte, last_byte, last_file_byte, reader = \
+            self._open(path, req, resp, timings)
+        # a seek into a video answers with the part from the keyframe on.
+        seek = resp.get_header('x-media-time') is not None
 
         if last_byte == '' or last_byte > last_file_byte:
             last_byte = last_file_byte
 
         length = last_byte - first_byte + 1
 
-        response = read_file_chunk(f, first_byte, length)
+        response = reader(first_byte, length)
 
         # if this was a byte range request by the client, be sure to set the
         # proper response headers to match the byte range request.
-        if req.get_header('range'):
+        if req.get_header('range') or seek:
             resp.append_header('Accept-Ranges', 'bytes')
             resp.append_header(
                 'Content-Range', 'bytes %s-%s/%s' %
@@ -158,7 +324,288 @@ class Router(object):
                 'Content-Type',
                 mimetypes.guess_type(path)[0] or 'application/octet-stream')
         if body:
+            if self.metrics is not None and not checksum:
+                self.metrics.bytes_out.inc(max(length, 0))
             resp.stream = response()
+            if self.maps is not None:
+                # wsgi servers only take bytes, so this is the one place
+                # the mapped slices get copied, a chunk at a time.
+                resp.stream = (bytes(chunk) for chunk in resp.stream)
+            if self.shaper is not None and not checksum:
+                resp.stream = self.shaper.stream(req, path, resp.stream,
+                                                 length)
+            if timings is not None:
+                resp.stream = self._timed_stream(req, resp.stream, timings)
+
+        self._finish_timings(req, resp, timings, log=not body)
+
+    def _list(self, req, resp, body):
+        """
+        list a page of what is stored in a directory under the data dir.
+        The entries are streamed back as json lines, sorted by name.
+
+        query params:
+          cursor: only list names after this one. Use the `x-next-cursor`
+            header of the previous page to get the next one.
+          limit: the number of entries per page.
+          stat: include the size and mtime of each entry.
+          meta: include the parts and headers of each entry.
+
+        :param req: falcon.Request
+        :param resp: falcon.Response
+        :return: None
+        """
+        try:
+            limit = int(req.get_param('limit') or self.listing_limit)
+        except ValueError:
+            raise falcon.HTTPInvalidParam('not a number', 'limit')
+        limit = max(1, min(limit, self.listing_limit))
+
+        try:
+            entries = list_dir(self.get_local_path(req.path),
+                               after=req.get_param('cursor'), limit=limit)
+        except (IOError, OSError):
+            raise falcon.HTTPNotFound()
+
+        if len(entries) == limit:
+            resp.append_header('x-next-cursor', entries[-1].name)
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = 'application/x-ndjson'
+        if not body:
+            return
+
+        resp.stream = self._list_response(
+            req.path.rstrip('/'), entries,
+            stat=req.get_param_as_bool('stat') or False,
+            meta=req.get_param_as_bool('meta') or False)
+
+    def _list_response(self, prefix, entries, stat=False, meta=False,
+                       batch_size=500):
+        for i in range(0, len(entries), batch_size):
+            batch = entries[i:i + batch_size]
+            rows = []
+            for entry in batch:
+                row = {'name': entry.name,
+                       'path': '%s/%s' % (prefix, entry.name),
+                       'type': 'dir' if entry.is_dir() else 'file'}
+                if stat:
+                    try:
+                        st = entry.stat()
+                        row['size'] = st.st_size
+                        row['mtime'] = st.st_mtime
+                    except OSError:
+                        row['size'] = row['mtime'] = None
+                rows.append(row)
+
+            if meta:
+                files = [row for row in rows if row['type'] == 'file']
+                metadata = get_many([row['path'] for row in files],
+                                    db=self._db)
+                for row, data in zip(files, metadata):
+                    row['parts'] = None if data.disabled else \
+                        self._condensed_parts(data)
+                    row['headers'] = data.headers
+
+            yield ''.join(json.dumps(row) + '\n' for row in rows).encode(
+                'utf-8')
+
+    def _manifest(self, req, resp, body):
+        """
+        return the block digests of a file as json, so a client can find
+        the blocks that differ from its copy. With a range header, only
+        the blocks overlapping the range are returned.
+
+        :param req: falcon.Request
+        :param resp: falcon.Response
+        :return: None
+        """
+        path = req.path
+        data = self._data(path=path)
+        if not data.disabled and not data.parts:
+            raise falcon.HTTPNotFound()
+
+        first_byte, last_byte = parse_byte_range_header(
+            req.get_header('range'))
+        try:
+            manifest = self.manifests.read(
+                path, self.get_local_path(path),
+                parts=None if data.disabled else data.parts,
+                first_byte=first_byte,
+                last_byte=None if last_byte == '' else last_byte)
+        except (IOError, OSError):
+            raise falcon.HTTPNotFound()
+
+        resp.content_type = 'application/json'
+        if body:
+            resp.text = json.dumps(manifest)
+
+    def _update_manifest(self, path, offset, length, timings=None):
+        if self.manifests is None:
+            return
+        t = time.perf_counter()
+        self.manifests.update(path, self.get_local_path(path), offset, length)
+        if timings is not None:
+            timings.lap('manifest', t)
+
+    def _open_for_read(self, path, req, resp, timings=None):
+        """
+        look up the metadata and open the file for a GET or HEAD request.
+        Small files that are fully uploaded get added to the cache on the
+        way through.
+
+        :param path: str
+        :param req: falcon.Request
+        :param resp: falcon.Response
+        :param timings: Timings
+        :return: first_byte, last_byte, last_file_byte, reader
+        """
+        generation = None if self.cache is None else self.cache.generation
+
+        data = self._data(path=path, timings=timings)
+
+        first_byte, last_byte = self._get_byte_range(data, req, resp)
+
+        if self.replicator is not None and self.replicator.spread_reads and \
+                last_byte != '':
+            peer = self.replicator.replica_for(path, last_byte)
+            if peer is not None:
+                raise falcon.HTTPTemporaryRedirect(
+                    peer.url + req.relative_uri)
+
+        headers = self._metadata_headers(data)
+        for k, v in headers:
+            resp.append_header(k, v)
+
+        f, last_file_byte = self._open_local_file(path)
+
+        if self._is_cacheable(data, last_file_byte):
+            if isinstance(f, memoryview):
+                content = f[:last_file_byte + 1].tobytes()
+            else:
+                with f:
+                    f.seek(0)
+                    content = f.read(last_file_byte + 1)
+            entry = self.cache.set(path, content, headers,
+                                   generation=generation)
+            if entry is not None:
+                return first_byte, last_byte, len(content) - 1, entry.reader
+            f = io.BytesIO(content)
+
+        return first_byte, last_byte, last_file_byte, \
+            functools.partial(read_file_chunk, f)
+
+    def _is_media_request(self, req):
+        return self.media is not None and \
+            self.media.handles(req.path) and \
+            (req.get_param('faststart') is not None or
+             req.get_param('t') is not None)
+
+    def _open_media(self, path, req, resp, timings=None):
+        """
+        open a complete mp4 file through its media index. With `faststart`
+        the moov box comes first, and with `t` the response starts at what
+        is needed to play from the keyframe at or before `t` seconds, whose
+        time is returned in the `x-media-time` header.
+
+        :param path: str
+        :param req: falcon.Request
+        :param resp: falcon.Response
+        :param timings: Timings
+        :return: first_byte, last_byte, last_file_byte, reader
+        """
+        data = self._data(path=path, timings=timings)
+        if not data.disabled and not data.complete:
+            raise falcon.HTTPConflict(
+                title='INCOMPLETE',
+                description='the file has to be complete to be served '
+                            'as media')
+
+        t = req.get_param_as_float('t')
+        first_byte, last_byte = parse_byte_range_header(
+            req.get_header('range'))
+        try:
+            view = self.media.view(
+                path, self.get_local_path(path),
+                faststart=req.get_param('faststart') is not None)
+        except (IOError, OSError):
+            raise falcon.HTTPNotFound()
+        if view is None:
+            raise falcon.HTTPNotFound(
+                title='NOT_MEDIA',
+                description='the file is not an mp4 that can be indexed')
+
+        if t is not None:
+            try:
+                first_byte, keyframe = view.seek(t)
+            except MediaError:
+                view.close()
+                raise falcon.HTTPNotFound()
+            resp.append_header('x-media-time', '%.6f' % keyframe)
+
+        for k, v in self._metadata_headers(data):
+            resp.append_header(k, v)
+        return first_byte, last_byte, view.size - 1, view.reader
+
+    def _update_media(self, path):
+        if self.media is None or not self.media.handles(path):
+            return
+        try:
+            self.media.update(path, self.get_local_path(path))
+        except (IOError, OSError):
+            log.exception('indexing %s failed', path)
+
+    def _open_local_file(self, path):
+        if self.tiering is None:
+            return self._open_path(self.get_local_path(path))
+
+        self.tiering.touch(path)
+        try:
+            return self._open_path(self.get_local_path(path))
+        except falcon.HTTPNotFound:
+            pass
+        opened = self._open_path(self.tiering.cold_path(path))
+        self.tiering.promote_later(path)
+        return opened
+
+    def _open_path(self, local_path):
+        if self.maps is not None:
+            try:
+                f = self.maps.view(local_path)
+            except (IOError, OSError, ValueError):
+                raise falcon.HTTPNotFound()
+            return f, len(f) - 1
+
+        try:
+            f = open_file(local_path, 'rb')
+        except IOError:
+            raise falcon.HTTPNotFound()
+
+        try:
+            f.seek(0, io.SEEK_END)
+            return f, f.tell() - 1
+        except OSError:
+            f.close()
+            raise falcon.HTTPNotFound()
+
+    def _is_cacheable(self, data, last_file_byte):
+        if self.cache is None or data.disabled:
+            return False
+
+        if last_file_byte < 0 or last_file_byte >= self.cache.max_object_size:
+            return False
+
+        if data.complete:
+            return data.total_length == last_file_byte + 1
+
+        byte_ranges = \
+            condense_byte_ranges(parse_byte_ranges_from_list(data.parts))
+        return len(byte_ranges) == 1 and \
+            tuple(byte_ranges[0]) == (0, last_file_byte)
+
+    def _invalidate(self, path):
+        if self.cache is not None:
+            self.cache.invalidate(path)
 
     def on_post(self, req, resp):
         """
@@ -169,46 +616,126 @@ class Router(object):
         :param resp: falcon.Response
         :return: None
         """
+        timings = self._start_timings()
         src = req.get_header('x-source')
         headers = self._extract_headers(req)
 
         path = req.path
+        local_path = self.get_local_path(path)
+        start = time.time()
         if src:
-            start = time.time()
             if src[0] != '/':
                 self._error_to_response(resp, falcon.HTTPInvalidParam(
                     'invalid source %s' % src, param_name='x-source'))
 
-            copy_file(self.get_local_path(src), self.get_local_path(path))
-            src_data = self._data(path=src)
+            t = time.perf_counter()
+            tmp_path = temp_file_path(local_path)
+            try:
+                copy_file(self.get_local_path(src), tmp_path)
+            except BaseException:
+                delete_file(tmp_path)
+                raise
+            if timings is not None:
+                timings.lap('copy', t)
+            src_data = self._data(path=src, timings=timings)
             headers.update(src_data.headers)
-            data = self._data(path=path, reset=True, parts=src_data.parts,
-                              headers=headers)
+            parts = src_data.parts
+        else:
+            tmp_path = temp_file_path(local_path)
+            length = self._content_length(req)
+            stream = self._request_body(req, length)
+            try:
+                written = write_file_chunk(
+                    tmp_path,
+                    stream=stream,
+                    offset=0,
+                    chunk_size=length,
+                    checksum=req.get_header('x-checksum'),
+                    checksum_type=req.get_header('x-checksum-type'),
+                    timings=timings)
+            except InvalidChecksumException:
+                delete_file(tmp_path)
+                if self.metrics is not None:
+                    self.metrics.checksum_failures.inc()
+                self._error_to_response(resp,
+                                        falcon.HTTPPreconditionFailed(
+                                            'CHECKSUM_FAIL',
+                                            'Checksum mismatch.'))
+            except BaseException:
+                delete_file(tmp_path)
+                raise
+            finally:
+                if stream is not req.stream:
+                    stream.close()
+            if self.metrics is not None:
+                self.metrics.bytes_in.inc(written)
+            parts = ['%d-%d' % (0, written - 1),
+                     complete_marker(written, time.time())]
 
-            resp.text = 'OK'
-            resp.append_header('x-start', "%.6f" % start)
-            resp.append_header('x-end', "%.6f" % time.time())
+        # swap in the new content and its metadata back to back. readers
+        # that already opened the old file keep streaming it.
+        replace_file(tmp_path, local_path)
+        if self.tiering is not None:
+            self.tiering.discard(path)
+        data = self._data(path=path, reset=True, parts=parts,
+                          headers=headers, timings=timings)
+        self._invalidate(path)
+        if self.replicator is not None:
+            self.replicator.post(path, self._forward_headers(headers))
 
-        else:
-            start = time.time()
-            content_length = int(req.get_header('Content-Length'))
-            path = req.path
-            delete_file(self.get_local_path(path))
-            write_file_chunk(self.get_local_path(path),
-                             stream=req.stream,
-                             offset=0,
-                             chunk_size=content_length,
-                             checksum=req.get_header('x-checksum'),
-                             checksum_type=req.get_header('x-checksum-type'))
-
-            resp.text = 'OK'
-            resp.append_header('x-start', "%.6f" % start)
-            resp.append_header('x-end', "%.6f" % time.time())
-            data = self._data(path=path,
-                              parts=['%d-%d' % (0, content_length - 1)],
-                              headers=headers, reset=True)
+        if self.manifests is not None:
+            t = time.perf_counter()
+            self.manifests.rebuild(path, local_path)
+            if timings is not None:
+                timings.lap('manifest', t)
+        self._update_media(path)
+
+        resp.text = 'OK'
+        resp.append_header('x-start', "%.6f" % start)
+        resp.append_header('x-end', "%.6f" % time.time())
 
         self._add_metadata_to_resp(resp, data)
+        self._finish_timings(req, resp, timings)
+
+    def _content_length(self, req):
+        """
+        the size of the request body, or None when it comes with chunked
+        transfer encoding and the size isn't known until it ends. Reading
+        a chunked body needs a wsgi server that decodes it, like gunicorn.
+
+        :param req: falcon.Request
+        :return: int or None
+        """
+        encoding = req.get_header('transfer-encoding') or ''
+        if 'chunked' in encoding.lower():
+            return None
+        return req.content_length or 0
+
+    def _total_length(self, req):
+        """
+        the size of the whole file, if the upload declares it with the
+        `x-total-length` header. Once the parts uploaded cover it, the file
+        is marked complete.
+
+        :param req: falcon.Request
+        :return: int or None
+        """
+        value = req.get_header('x-total-length')
+        if value is None:
+            return None
+        try:
+            total_length = int(value)
+        except ValueError:
+            total_length = -1
+        if total_length < 0:
+            raise falcon.HTTPInvalidHeader('not a valid length',
+                                           'x-total-length')
+        return total_length
+
+    def _request_body(self, req, length):
+        if self.shaper is None:
+            return req.stream
+        return self.shaper.body(req, req.path, req.stream, length)
 
     def on_patch(self, req, resp):
 
@@ -221,26 +748,44 @@ class Router(object):
         """
 
         start = time.time()
+        timings = self._start_timings()
         path = req.path
         try:
             offset = int(req.get_param('offset'))
         except TypeError:
             offset = 0
 
-        content_length = int(req.get_header('Content-Length'))
+        total_length = self._total_length(req)
 
+        if self.tiering is not None:
+            self.tiering.before_write(path)
+
+        length = self._content_length(req)
+        stream = self._request_body(req, length)
         try:
-            write_file_chunk(self.get_local_path(path),
-                             stream=req.stream,
-                             offset=offset,
-                             chunk_size=content_length,
-                             checksum=req.get_header('x-checksum'),
-                             checksum_type=req.get_header('x-checksum-type'))
+            written = write_file_chunk(
+                self.get_local_path(path),
+                stream=stream,
+                offset=offset,
+                chunk_size=length,
+                checksum=req.get_header('x-checksum'),
+                checksum_type=req.get_header('x-checksum-type'),
+                timings=timings) - offset
         except InvalidChecksumException:
+            if self.metrics is not None:
+                self.metrics.checksum_failures.inc()
             self._error_to_response(resp,
                                     falcon.HTTPPreconditionFailed(
                                         'CHECKSUM_FAIL',
                                         'Checksum mismatch.'))
+        finally:
+            if stream is not req.stream:
+                stream.close()
+
+        self._update_manifest(path, offset, written, timings)
+
+        if self.metrics is not None:
+            self.metrics.bytes_in.inc(written)
 
         resp.text = 'OK'
         resp.append_header('x-start', "%.6f" % start)
@@ -249,8 +794,18 @@ class Router(object):
         path = req.path
         headers = self._extract_headers(req)
         data = self._data(path=path, parts=[
-            '%d-%d' % (offset, offset + content_length - 1)], headers=headers)
+            '%d-%d' % (offset, offset + written - 1)], headers=headers,
+            total_length=total_length, timings=timings)
+        self._invalidate(path)
+        if self.replicator is not None:
+            forwarded = self._forward_headers(headers)
+            if data.total_length is not None:
+                forwarded['x-total-length'] = '%d' % data.total_length
+            self.replicator.patch(path, offset, written, forwarded)
+        if data.complete and data.completed_at >= start:
+            self._update_media(path)
         self._add_metadata_to_resp(resp, data)
+        self._finish_timings(req, resp, timings)
 
     def on_delete(self, req, resp):
         """
@@ -261,8 +816,13 @@ class Router(object):
         :return: None
         """
 
+        if req.get_param_as_bool('prefix'):
+            return self._delete_prefix(req, resp)
+
         path = req.path
         res = delete_file(self.get_local_path(path))
+        if self.tiering is not None:
+            self.tiering.discard(path)
 
         if not res:
             raise falcon.HTTPInternalServerError(
@@ -272,7 +832,73 @@ class Router(object):
 
         resp.text = 'OK'
 
+        for store in self.sidecars:
+            store.delete(path)
         self._data(path=path, reset=True)
+        self._invalidate(path)
+        if self.replicator is not None:
+            self.replicator.delete(path)
+
+    def _delete_prefix(self, req, resp):
+        """
+        delete everything under a directory in the background.
+        Responds right away with the id of the job doing the work; its
+        progress can be followed on the jobs endpoint.
+
+        :param req: falcon.Request
+        :param resp: falcon.Response
+        :return: None
+        """
+        if self.jobs is None:
+            raise falcon.HTTPBadRequest(
+                title='PREFIX_DELETE_DISABLED',
+                description='prefix deletes need the jobs endpoint enabled')
+
+        path = req.path.rstrip('/')
+        if not path:
+            raise falcon.HTTPBadRequest(
+                title='INVALID_PREFIX',
+                description='refusing to delete the whole data dir')
+
+        local_dirs = [self.get_local_path(path)]
+        if self.tiering is not None:
+            local_dirs.append(self.tiering.cold_path(path))
+        local_dirs = [d for d in local_dirs if os.path.isdir(d)]
+        if not local_dirs:
+            raise falcon.HTTPNotFound()
+
+        resp.status = falcon.HTTP_202
+        for local_path in local_dirs:
+            job = self.jobs.submit(PrefixDeleteJob(
+                local_path, path, db=self._db, cache=self.cache,
+                rate=self.delete_rate, sidecars=self.sidecars))
+            resp.append_header('x-job-id', job.id)
+        resp.content_type = 'application/json'
+        resp.text = json.dumps(job.to_dict())
+
+    def on_jobs(self, req, resp):
+        """
+        report on background jobs. With an `id` query param, returns that
+        job, otherwise all the recent ones.
+
+        :param req: falcon.Request
+        :param resp: falcon.Response
+        :return: None
+        """
+        if req.method not in ('GET', 'HEAD'):
+            raise falcon.HTTPMethodNotAllowed(allowed_methods=['GET'])
+
+        job_id = req.get_param('id')
+        if job_id is None:
+            body = {'jobs': [job.to_dict() for job in self.jobs.jobs()]}
+        else:
+            job = self.jobs.get(job_id)
+            if job is None:
+                raise falcon.HTTPNotFound()
+            body = job.to_dict()
+
+        resp.content_type = 'application/json'
+        resp.text = json.dumps(body)
 
     def _extract_headers(self, req):
         try:
@@ -288,24 +914,146 @@ class Router(object):
             return {}
 
     def _add_metadata_to_resp(self, resp, data):
-        if data.disabled:
-            return
-        byte_ranges = \
-            condense_byte_ranges(parse_byte_ranges_from_list(data.parts))
-        parts = ['%d-%d' % (row[0], row[1]) for row in byte_ranges]
-        resp.append_header('x-parts', ','.join(parts))
-        for k, v in data.headers.items():
+        for k, v in self._metadata_headers(data):
             try:
-                resp.append_header(
-                    '{prefix}{name}'.format(
-                        prefix='' if k in self.passthru else 'x-head-',
-                        name=k),
-                    '{}'.format(v))
+                resp.append_header(k, v)
             except Exception:
                 pass
 
-    def _data(self, **kwargs):
-        return MetaData(db=self._db, **kwargs)
+    def _metadata_headers(self, data):
+        if data.disabled:
+            return []
+        headers = [('x-parts', self._condensed_parts(data))]
+        if data.total_length is not None:
+            headers.append(('x-total-length', '%d' % data.total_length))
+        if data.complete:
+            headers.append(('x-completed-at', '%.6f' % data.completed_at))
+        headers.extend(self._forward_headers(data.headers).items())
+        return headers
+
+    def _forward_headers(self, headers):
+        """
+        turn stored headers back into the request headers they came from.
+        """
+        return dict((
+            '{prefix}{name}'.format(
+                prefix='' if k in self.passthru else 'x-head-',
+                name=k),
+            '{}'.format(v)) for k, v in headers.items())
+
+    def _condensed_parts(self, data):
+        if data.complete:
+            return '0-%d' % (data.total_length - 1) if data.total_length \
+                else ''
+        byte_ranges = \
+            condense_byte_ranges(parse_byte_ranges_from_list(data.parts))
+        return ','.join('%d-%d' % (row[0], row[1]) for row in byte_ranges)
+
+    def on_bulk_meta(self, req, resp):
+        """
+        look up the metadata and on-disk size of many files in one request,
+        instead of a HEAD per file.
+
+        The body is a json list of paths, or an object with a `paths` list.
+        The metadata for all of them comes from a single redis pipeline.
+
+        :param req: falcon.Request
+        :param resp: falcon.Response
+        :return: None
+        """
+        if req.method != 'POST':
+            raise falcon.HTTPMethodNotAllowed(allowed_methods=['POST'])
+
+        try:
+            paths = json.load(req.bounded_stream)
+        except ValueError:
+            raise falcon.HTTPBadRequest(title='INVALID_BODY',
+                                        description='body is not valid json')
+        if isinstance(paths, dict):
+            paths = paths.get('paths')
+        if not isinstance(paths, list) or not all(
+                isinstance(p, str) and p.startswith('/') for p in paths):
+            raise falcon.HTTPBadRequest(
+                title='INVALID_PATHS',
+                description='expected a list of absolute paths')
+        if len(paths) > self.bulk_limit:
+            raise falcon.HTTPBadRequest(
+                title='TOO_MANY_PATHS',
+                description='at most %d paths per request' % self.bulk_limit)
+
+        metadata = get_many(paths, db=self._db)
+        sizes = get_file_sizes([self.get_local_path(p) for p in paths])
+
+        results = []
+        for path, data, size in zip(paths, metadata, sizes):
+            results.append({
+                'path': path,
+                'size': size,
+                'parts': None if data.disabled else
+                self._condensed_parts(data),
+                'headers': data.headers,
+                'total_length': data.total_length,
+                'completed_at': data.completed_at,
+            })
+
+        resp.content_type = 'application/json'
+        resp.text = json.dumps({'results': results})
+
+    def on_metrics(self, req, resp):
+        """
+        render the built-in metrics in the prometheus text format.
+
+        :param req: falcon.Request
+        :param resp: falcon.Response
+        :return: None
+        """
+        if req.method not in ('GET', 'HEAD'):
+            raise falcon.HTTPMethodNotAllowed(allowed_methods=['GET'])
+        resp.content_type = METRICS_CONTENT_TYPE
+        resp.text = self.metrics.render()
+
+    def _data(self, timings=None, **kwargs):
+        if self._db is None or (self.metrics is None and timings is None):
+            return MetaData(db=self._db, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return MetaData(db=self._db, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.metrics is not None:
+                self.metrics.metadata.observe(elapsed)
+            if timings is not None:
+                timings.add('meta', elapsed)
+
+    def _start_timings(self):
+        if self.server_timing or self.slow_threshold is not None:
+            return Timings()
+        return None
+
+    def _finish_timings(self, req, resp, timings, log=True):
+        """
+        add the Server-Timing header to the response and, unless the
+        response still has to be streamed, log the request if it was slow.
+        """
+        if timings is None:
+            return
+        if self.server_timing:
+            resp.append_header('Server-Timing', timings.header())
+        if log and self.slow_threshold is not None:
+            timings.log(req.method, req.path, self.slow_threshold)
+
+    def _timed_stream(self, req, stream, timings):
+        # the headers are gone by the time the body streams, so the
+        # streaming phase only shows up in the slow request log.
+        start = time.perf_counter()
+        try:
+            for chunk in stream:
+                yield chunk
+        finally:
+            timings.lap('stream', start)
+            if self.slow_threshold is not None:
+                timings.log(req.method, req.path, self.slow_threshold)
 
     def _error_to_response(self, resp, ex):
         if ex.title is not None:
@@ -0,0 +1,250 @@
+import collections
+import itertools
+import threading
+import time
+
+__all__ = ['Shaper', 'TokenBucket']
+
+
+class TokenBucket(object):
+    """
+    A token bucket refilled at `rate` tokens per second, holding at most
+    `burst` tokens. Taking more tokens than there are puts the bucket in
+    debt, and the caller is told how long to wait for the debt to be paid
+    off, so concurrent takers end up queued fairly behind each other.
+    """
+    __slots__ = ['rate', 'burst', 'tokens', 'updated', '_lock']
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(rate if burst is None else burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, n):
+        """
+        take `n` tokens.
+
+        :param n: int
+        :return: float, the seconds to wait before using them
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class _Flow(object):
+    """
+    a single response or request body going through the shaper.
+    """
+    __slots__ = ['id', 'weight', 'buckets', 'small', 'due']
+
+    def __init__(self, flow_id, weight, buckets, small):
+        self.id = flow_id
+        self.weight = weight
+        self.buckets = buckets
+        self.small = small
+        self.due = time.monotonic()
+
+
+class _ShapedInput(object):
+    """
+    a file-like wrapper for a request body that paces the reads.
+    """
+    __slots__ = ['_shaper', '_flow', '_stream']
+
+    def __init__(self, shaper, flow, stream):
+        self._shaper = shaper
+        self._flow = flow
+        self._stream = stream
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = float('inf')
+        pieces = []
+        while size > 0:
+            data = self._stream.read(int(min(size, self._shaper.block_size)))
+            if not data:
+                break
+            self._shaper.pace(self._flow, len(data))
+            pieces.append(data)
+            size -= len(data)
+        return b''.join(pieces)
+
+    def close(self):
+        self._shaper.finish(self._flow)
+
+
+class Shaper(object):
+    """
+    Paces response streams and upload bodies, so a few clients moving huge
+    files can't take all the bandwidth and disk from everyone else.
+
+    Three kinds of limits apply, all in bytes per second:
+
+      rate: the total for the whole process. It gets shared between the
+        flows in progress in proportion to their weight, which comes from
+        `weights`, a dict of path prefix to weight. Paths that match no
+        prefix have a weight of 1.
+      client_rate: a token bucket per client, keyed by the remote address,
+        or by the `client_header` request header when napfs sits behind a
+        proxy.
+      prefix_rates: a dict of path prefix to the rate of a token bucket
+        shared by every flow under that prefix.
+
+    The token buckets allow bursts of `burst` seconds worth of their rate.
+    Flows of at most `small_size` bytes never wait. Their bytes still count
+    against the buckets, which makes the big flows yield to them.
+    """
+    __slots__ = ['rate', 'client_rate', 'prefix_rates', 'weights', 'burst',
+                 'small_size', 'client_header', 'block_size', 'max_clients',
+                 '_clients', '_prefix_buckets', '_flows', '_total_weight',
+                 '_ids', '_lock']
+
+    def __init__(self, rate=None, client_rate=None, prefix_rates=None,
+                 weights=None, burst=1.0, small_size=1024 * 64,
+                 client_header=None, block_size=1024 * 64,
+                 max_clients=10000):
+        self.rate = rate
+        self.client_rate = client_rate
+        self.prefix_rates = self._by_length(prefix_rates)
+        self.weights = self._by_length(weights)
+        self.burst = burst
+        self.small_size = small_size
+        self.client_header = client_header
+        self.block_size = block_size
+        self.max_clients = max_clients
+        self._clients = collections.OrderedDict()
+        self._prefix_buckets = dict(
+            (prefix, TokenBucket(r, r * burst))
+            for prefix, r in self.prefix_rates)
+        self._flows = {}
+        self._total_weight = 0
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _by_length(prefixes):
+        # longest prefixes first, so the most specific one wins.
+        return sorted((prefixes or {}).items(), key=lambda x: -len(x[0]))
+
+    def _client_bucket(self, req):
+        if not self.client_rate:
+            return None
+        key = None
+        if self.client_header:
+            key = req.get_header(self.client_header)
+        key = key or req.remote_addr
+        with self._lock:
+            bucket = self._clients.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.client_rate,
+                                     self.client_rate * self.burst)
+            self._clients[key] = bucket
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        return bucket
+
+    def start(self, req, path, length):
+        """
+        register a flow of about `length` bytes for a request.
+
+        :param req: falcon.Request
+        :param path: str
+        :param length: int or None if unknown
+        :return: _Flow
+        """
+        buckets = []
+        client = self._client_bucket(req)
+        if client is not None:
+            buckets.append(client)
+        for prefix, _ in self.prefix_rates:
+            if path.startswith(prefix):
+                buckets.append(self._prefix_buckets[prefix])
+                break
+
+        weight = 1
+        for prefix, w in self.weights:
+            if path.startswith(prefix):
+                weight = w
+                break
+
+        small = length is not None and length <= self.small_size
+        flow = _Flow(next(self._ids), weight, buckets, small)
+        if not small:
+            with self._lock:
+                self._flows[flow.id] = flow
+                self._total_weight += weight
+        return flow
+
+    def finish(self, flow):
+        with self._lock:
+            if self._flows.pop(flow.id, None) is not None:
+                self._total_weight -= flow.weight
+
+    def pace(self, flow, n):
+        """
+        account for `n` bytes of a flow, sleeping as long as it takes for
+        the flow to be within its limits.
+
+        :param flow: _Flow
+        :param n: int
+        :return: float, the seconds slept
+        """
+        wait = 0.0
+        for bucket in flow.buckets:
+            wait = max(wait, bucket.take(n))
+
+        if self.rate and not flow.small:
+            with self._lock:
+                share = self.rate * flow.weight / max(self._total_weight,
+                                                      flow.weight)
+            # the flow may send once the bytes before these are paid for
+            # at its share of the rate.
+            now = time.monotonic()
+            start = max(flow.due, now)
+            flow.due = start + n / share
+            wait = max(wait, start - now)
+
+        if flow.small or wait <= 0:
+            return 0.0
+        time.sleep(wait)
+        return wait
+
+    def stream(self, req, path, chunks, length):
+        """
+        pace a response stream.
+
+        :param req: falcon.Request
+        :param path: str
+        :param chunks: iterable of bytes
+        :param length: int
+        :return: generator of bytes
+        """
+        flow = self.start(req, path, length)
+        try:
+            for chunk in chunks:
+                self.pace(flow, len(chunk))
+                yield chunk
+        finally:
+            self.finish(flow)
+
+    def body(self, req, path, stream, length):
+        """
+        pace the reads of a request body. Close the returned stream when
+        done with it.
+
+        :param req: falcon.Request
+        :param path: str
+        :param stream: file-like object
+        :param length: int or None if unknown
+        :return: file-like object
+        """
+        return _ShapedInput(self, self.start(req, path, length), stream)
@@ -0,0 +1,185 @@
+import bisect
+import hashlib
+
+__all__ = ['HashRing', 'ShardedRedis', 'reshard']
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def hash_tag(key):
+    """
+    the part of a key used to pick its node. Like redis cluster, if the key
+    has a non-empty `{...}` section, only that part counts, so `H{path}` and
+    `P{path}` always end up on the same node.
+
+    :param key: str or bytes
+    :return: str
+    """
+    if isinstance(key, bytes):
+        key = key.decode('utf-8')
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+class HashRing(object):
+    """
+    A consistent hash ring. Each node is placed on the ring `replicas`
+    times, and a key belongs to the first node found going clockwise from
+    the hash of the key. Adding or removing a node only moves the keys of
+    the ring segments it owns.
+    """
+    __slots__ = ['nodes', '_keys', '_owners']
+
+    def __init__(self, nodes, replicas=128):
+        self.nodes = sorted(nodes)
+        points = []
+        for node in self.nodes:
+            for i in range(replicas):
+                points.append((_hash('%s-%d' % (node, i)), node))
+        points.sort()
+        self._keys = [p[0] for p in points]
+        self._owners = [p[1] for p in points]
+
+    def get(self, key):
+        if not self._keys:
+            raise ValueError('the hash ring has no nodes')
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._owners[i]
+
+
+def _node_name(client):
+    kwargs = client.connection_pool.connection_kwargs
+    if kwargs.get('path'):
+        return '%s/%s' % (kwargs['path'], kwargs.get('db', 0))
+    return '%s:%s/%s' % (kwargs.get('host', 'localhost'),
+                         kwargs.get('port', 6379), kwargs.get('db', 0))
+
+
+class ShardedRedis(object):
+    """
+    Spreads the napfs metadata over several redis instances, using a
+    consistent hash of the path in each key.
+
+    `nodes` is a dict of node name to redis client. The names decide where
+    the keys go, so keep them the same across processes and restarts. A
+    plain list of clients also works; the names then come from the
+    connection settings of each client.
+
+    Only `pipeline` is supported, which is all napfs uses. Commands queued
+    on the pipeline are grouped per node and each node gets one round
+    trip when the pipeline executes.
+    """
+    __slots__ = ['nodes', 'ring']
+
+    def __init__(self, nodes, replicas=128):
+        if not isinstance(nodes, dict):
+            nodes = dict((_node_name(client), client) for client in nodes)
+        self.nodes = nodes
+        self.ring = HashRing(nodes.keys(), replicas=replicas)
+
+    def node_name(self, key):
+        return self.ring.get(hash_tag(key))
+
+    def node(self, key):
+        return self.nodes[self.node_name(key)]
+
+    def pipeline(self, transaction=False):
+        return ShardedPipeline(self)
+
+
+class ShardedPipeline(object):
+    """
+    collects commands for a `ShardedRedis`, routing each one by its first
+    argument, the key.
+    """
+    __slots__ = ['_sharded', '_pipes', '_order']
+
+    def __init__(self, sharded):
+        self._sharded = sharded
+        self._pipes = {}
+        self._order = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(key, *args, **kwargs):
+            node = self._sharded.node_name(key)
+            pipe = self._pipes.get(node)
+            if pipe is None:
+                pipe = self._pipes[node] = \
+                    self._sharded.nodes[node].pipeline(transaction=False)
+            getattr(pipe, name)(key, *args, **kwargs)
+            self._order.append(node)
+            return self
+
+        return command
+
+    def __len__(self):
+        return len(self._order)
+
+    def execute(self):
+        results = dict((node, iter(pipe.execute()))
+                       for node, pipe in self._pipes.items())
+        order = self._order
+        self._pipes = {}
+        self._order = []
+        return [next(results[node]) for node in order]
+
+
+def _migrate(client, target, keys):
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.dump(key)
+        pipe.pttl(key)
+    rows = pipe.execute()
+
+    moved = []
+    pipe = target.pipeline()
+    for i, key in enumerate(keys):
+        value, ttl = rows[i * 2], rows[i * 2 + 1]
+        if value is None:
+            continue
+        pipe.restore(key, ttl if ttl > 0 else 0, value, replace=True)
+        moved.append(key)
+    if moved:
+        pipe.execute()
+
+        pipe = client.pipeline(transaction=False)
+        for key in moved:
+            pipe.delete(key)
+        pipe.execute()
+    return len(moved)
+
+
+def reshard(source, target, batch_size=500):
+    """
+    move the napfs metadata keys that live on the wrong node after the set
+    of nodes changed. Call it with the `ShardedRedis` for the old set of
+    nodes and the one for the new set. Nodes are matched by name, and only
+    the keys whose owner changed get moved, along with their ttl.
+
+    :param source: ShardedRedis
+    :param target: ShardedRedis
+    :param batch_size: int
+    :return: int, the number of keys moved
+    """
+    moved = 0
+    for name, client in source.nodes.items():
+        batch = []
+        for key in client.scan_iter(match='[HP]{*', count=batch_size):
+            if target.node_name(key) == name:
+                continue
+            batch.append(key)
+            if len(batch) >= batch_size:
+                moved += _migrate(client, target, batch)
+                batch = []
+        if batch:
+            moved += _migrate(client, target, batch)
+    return moved
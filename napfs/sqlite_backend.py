@@ -0,0 +1,236 @@
+import sqlite3
+import threading
+import time
+
+from .data import MetaData, MetaDataBackend
+
+__all__ = ['SqliteBackend']
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS headers ('
+    'path TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, '
+    'PRIMARY KEY (path, name)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS parts ('
+    'path TEXT NOT NULL, part TEXT NOT NULL, '
+    'PRIMARY KEY (path, part)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS expires ('
+    'path TEXT NOT NULL, kind TEXT NOT NULL, expires REAL NOT NULL, '
+    'PRIMARY KEY (path, kind)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS expires_at ON expires (expires)',
+]
+
+# the tables holding the data for each kind of expiry.
+_TABLES = {'H': 'headers', 'P': 'parts'}
+
+# sqlite caps the number of parameters in a single statement.
+_MAX_VARIABLES = 500
+
+
+class SqliteBackend(MetaDataBackend):
+    """
+    keeps the metadata in a local sqlite database, for single node
+    deployments that don't want to run redis just for the range
+    bookkeeping.
+
+    The database runs in WAL mode, so readers don't block the writer, and
+    every call is a single transaction with the rows written in batches.
+    Expiry works like in redis: each path has a deadline for its headers
+    and one for its parts, pushed back whenever they get written. Expired
+    rows are ignored when read, dropped the next time the path is written,
+    and purged from the whole database every `purge_every` writes.
+
+    Each thread gets its own connection.
+    """
+    __slots__ = ['path', 'purge_every', '_local', '_writes', '_lock']
+
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+        conn = self._conn()
+        for statement in _SCHEMA:
+            conn.execute(statement)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, f, *args):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = f(conn, *args)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    def _write(self, f, *args):
+        result = self._transaction(f, *args)
+        with self._lock:
+            self._writes += 1
+            purge = self.purge_every and self._writes >= self.purge_every
+            if purge:
+                self._writes = 0
+        if purge:
+            self.purge()
+        return result
+
+    def update(self, path, headers=None, parts=None, reset=False):
+        return self._write(self._update, path, headers, parts, reset)
+
+    def _update(self, conn, path, headers, parts, reset):
+        now = time.time()
+        if reset:
+            _delete(conn, [path])
+        else:
+            _drop_expired(conn, path, now)
+
+        if headers:
+            conn.executemany(
+                'INSERT OR REPLACE INTO headers (path, name, value) '
+                'VALUES (?, ?, ?)',
+                [(path, k, '%s' % v) for k, v in headers.items()])
+            _touch(conn, path, 'H', now + MetaData.HEADER_EXPIRE_TIMEOUT)
+
+        if parts is not None:
+            conn.executemany(
+                'INSERT OR IGNORE INTO parts (path, part) VALUES (?, ?)',
+                [(path, part) for part in parts])
+            _touch(conn, path, 'P', now + MetaData.PARTS_EXPIRE_TIMEOUT)
+
+        return _read(conn, [path], now)[path]
+
+    def compact(self, path, remove, add):
+        return self._write(self._compact, path, remove, add)
+
+    def _compact(self, conn, path, remove, add):
+        now = time.time()
+        conn.executemany('DELETE FROM parts WHERE path = ? AND part = ?',
+                         [(path, part) for part in remove])
+        conn.execute('INSERT OR IGNORE INTO parts (path, part) VALUES (?, ?)',
+                     (path, add))
+        _touch(conn, path, 'P', now + MetaData.PARTS_EXPIRE_TIMEOUT)
+        return _read(conn, [path], now)[path][1]
+
+    def get_many(self, paths):
+        if not paths:
+            return []
+        conn = self._conn()
+        now = time.time()
+        found = {}
+        for i in range(0, len(paths), _MAX_VARIABLES):
+            found.update(_read(conn, paths[i:i + _MAX_VARIABLES], now))
+        return [found[path] for path in paths]
+
+    def delete_many(self, paths):
+        if not paths:
+            return
+        for i in range(0, len(paths), _MAX_VARIABLES):
+            self._write(_delete, paths[i:i + _MAX_VARIABLES])
+
+    def write_many(self, updates):
+        if updates:
+            self._write(self._write_many, updates)
+
+    def _write_many(self, conn, updates):
+        now = time.time()
+        resets = [u.path for u in updates if u.reset]
+        if resets:
+            _delete(conn, resets)
+        for u in updates:
+            if not u.reset:
+                _drop_expired(conn, u.path, now)
+        conn.executemany('DELETE FROM parts WHERE path = ? AND part = ?',
+                         [(u.path, part) for u in updates
+                          for part in u.remove])
+        conn.executemany('INSERT OR REPLACE INTO headers (path, name, value) '
+                         'VALUES (?, ?, ?)',
+                         [(u.path, k, '%s' % v) for u in updates
+                          for k, v in u.headers.items()])
+        conn.executemany('INSERT OR IGNORE INTO parts (path, part) '
+                         'VALUES (?, ?)',
+                         [(u.path, part) for u in updates
+                          for part in u.parts])
+        conn.executemany(
+            'INSERT OR REPLACE INTO expires (path, kind, expires) '
+            'VALUES (?, ?, ?)',
+            [(u.path, 'H', now + MetaData.HEADER_EXPIRE_TIMEOUT)
+             for u in updates if u.headers] +
+            [(u.path, 'P', now + MetaData.PARTS_EXPIRE_TIMEOUT)
+             for u in updates if u.parts])
+
+    def purge(self):
+        """
+        remove every expired row from the database.
+
+        :return: int, the number of paths whose metadata expired
+        """
+        return self._transaction(self._purge)
+
+    def _purge(self, conn):
+        rows = conn.execute(
+            'SELECT path, kind FROM expires WHERE expires <= ?',
+            (time.time(),)).fetchall()
+        for kind, table in _TABLES.items():
+            conn.executemany('DELETE FROM %s WHERE path = ?' % table,
+                             [(path,) for path, k in rows if k == kind])
+        conn.executemany('DELETE FROM expires WHERE path = ? AND kind = ?',
+                         rows)
+        return len(rows)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def _touch(conn, path, kind, expires):
+    conn.execute('INSERT OR REPLACE INTO expires (path, kind, expires) '
+                 'VALUES (?, ?, ?)', (path, kind, expires))
+
+
+def _drop_expired(conn, path, now):
+    rows = conn.execute('SELECT kind FROM expires '
+                        'WHERE path = ? AND expires <= ?',
+                        (path, now)).fetchall()
+    for (kind,) in rows:
+        conn.execute('DELETE FROM %s WHERE path = ?' % _TABLES[kind], (path,))
+        conn.execute('DELETE FROM expires WHERE path = ? AND kind = ?',
+                     (path, kind))
+
+
+def _delete(conn, paths):
+    args = [(path,) for path in paths]
+    for table in ('headers', 'parts', 'expires'):
+        conn.executemany('DELETE FROM %s WHERE path = ?' % table, args)
+
+
+def _read(conn, paths, now):
+    marks = ','.join('?' * len(paths))
+    results = dict((path, ({}, [])) for path in paths)
+    live = set(conn.execute(
+        'SELECT path, kind FROM expires WHERE path IN (%s) AND expires > ?'
+        % marks, list(paths) + [now]).fetchall())
+
+    for path, name, value in conn.execute(
+            'SELECT path, name, value FROM headers WHERE path IN (%s)'
+            % marks, paths):
+        if (path, 'H') in live:
+            results[path][0][name] = value
+
+    for path, part in conn.execute(
+            'SELECT path, part FROM parts WHERE path IN (%s)' % marks, paths):
+        if (path, 'P') in live:
+            results[path][1].append(part)
+    return results
@@ -0,0 +1,265 @@
+import collections
+import contextlib
+import logging
+import os
+import queue
+import threading
+import time
+
+from .fs import walk_files, move_file, delete_file, is_temp_file
+from .jobs import Job, RateLimiter
+
+__all__ = ['Tiering', 'DemoteJob']
+
+log = logging.getLogger('napfs')
+
+
+class DemoteJob(Job):
+    """
+    moves the files of the fast tier nobody has written or read for
+    `cold_after` seconds over to the cold tier. `rate` caps the files looked
+    at per second.
+    """
+    __slots__ = ['tiering', 'rate']
+    kind = 'demote'
+
+    def __init__(self, tiering, rate=None):
+        super(DemoteJob, self).__init__()
+        self.tiering = tiering
+        self.rate = rate
+        self.progress.update(scanned=0, demoted=0, bytes=0)
+
+    def run(self):
+        limiter = RateLimiter(self.rate)
+        tiering = self.tiering
+        data_dir = tiering.data_dir.rstrip('/')
+        for entry in walk_files(data_dir):
+            self.progress['scanned'] += 1
+            limiter.wait()
+            if is_temp_file(entry.name):
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            path = entry.path[len(data_dir):]
+            if tiering.is_cold(path, st.st_mtime) and tiering.demote(path):
+                self.progress['demoted'] += 1
+                self.progress['bytes'] += st.st_size
+
+
+class Tiering(object):
+    """
+    Keeps the files being used on the fast volume of the data dir, and the
+    ones that went cold in `cold_dir`, a slower and cheaper one, under the
+    same relative paths.
+
+    A file goes cold when it hasn't been written for `cold_after` seconds,
+    going by its mtime, nor read for that long. Reads are only tracked in
+    memory, the most recent `max_tracked` paths, so a GET never writes
+    anything. Paths without a tracked read count as read when the tracking
+    started, which means nothing goes cold in the first `cold_after`
+    seconds after a restart.
+
+    Every `interval` seconds a `DemoteJob` moves the cold files over. A GET
+    of a file in the cold tier is served from there, and with `promote` the
+    file gets moved back to the fast tier in the background. A write to a
+    file in the cold tier moves it back first.
+
+    Moves copy the file and only remove the original once the copy is in
+    place, and a move is called off if the file got written to while it
+    was being copied. Moves of the same path take turns.
+    """
+    __slots__ = ['cold_dir', 'cold_after', 'interval', 'promote_reads',
+                 'rate', 'max_tracked', 'data_dir', 'jobs', 'started',
+                 'demoted', 'promoted', '_access', '_promotions', '_queued',
+                 '_thread', '_stop', '_lock', '_moving']
+
+    def __init__(self, cold_dir, cold_after=86400 * 7, interval=3600,
+                 promote=True, rate=1000, max_tracked=1000000):
+        self.cold_dir = cold_dir.rstrip('/')
+        self.cold_after = cold_after
+        self.interval = interval
+        self.promote_reads = promote
+        self.rate = rate
+        self.max_tracked = max_tracked
+        self.data_dir = None
+        self.jobs = None
+        self.started = time.time()
+        self.demoted = 0
+        self.promoted = 0
+        self._access = collections.OrderedDict()
+        self._promotions = queue.Queue()
+        self._queued = set()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._moving = {}
+
+    def start(self, data_dir, jobs=None):
+        self.data_dir = data_dir.rstrip('/')
+        self.jobs = jobs
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work,
+                                            name='napfs-tiering')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._promotions.put(None)
+
+    def hot_path(self, path):
+        return self.data_dir + path
+
+    def cold_path(self, path):
+        return self.cold_dir + path
+
+    def touch(self, path):
+        """
+        note that a file just got used. Only touches memory.
+
+        :param path: str
+        :return: None
+        """
+        now = time.time()
+        with self._lock:
+            self._access[path] = now
+            self._access.move_to_end(path)
+            if len(self._access) > self.max_tracked:
+                self._access.popitem(last=False)
+
+    def last_access(self, path):
+        with self._lock:
+            return self._access.get(path, self.started)
+
+    def is_cold(self, path, mtime):
+        return time.time() - max(mtime, self.last_access(path)) >= \
+            self.cold_after
+
+    @contextlib.contextmanager
+    def _move_lock(self, path):
+        """
+        hold the lock for moving one path, dropped once nobody needs it.
+        """
+        with self._lock:
+            lock, users = self._moving.get(path, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self._moving[path] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, users = self._moving[path]
+                if users > 1:
+                    self._moving[path] = (lock, users - 1)
+                else:
+                    del self._moving[path]
+
+    def demote(self, path):
+        """
+        move a file to the cold tier, unless it got used in the meantime.
+
+        :param path: str
+        :return: bool, whether the file moved
+        """
+        with self._move_lock(path):
+            try:
+                mtime = os.stat(self.hot_path(path)).st_mtime
+            except OSError:
+                return False
+            accessed = self.last_access(path)
+            # a write touches the file before it starts, so one that
+            # started while the file was copied calls the move off.
+            if not self.is_cold(path, mtime) or \
+                    not move_file(self.hot_path(path), self.cold_path(path),
+                                  lambda: self.last_access(path) == accessed):
+                return False
+            self.demoted += 1
+            return True
+
+    def promote(self, path):
+        """
+        move a file back to the fast tier now, if it is in the cold tier.
+
+        :param path: str
+        :return: bool, whether the file moved
+        """
+        cold_path = self.cold_path(path)
+        # checked under the lock, so a demote in progress finishes first and
+        # its file gets moved back.
+        with self._move_lock(path):
+            if not os.path.exists(cold_path):
+                return False
+            # whatever is in the fast tier got written after the file went
+            # cold, so it wins.
+            if os.path.exists(self.hot_path(path)):
+                delete_file(cold_path)
+                return False
+            if not move_file(cold_path, self.hot_path(path)):
+                return False
+            self.promoted += 1
+            return True
+
+    def promote_later(self, path):
+        """
+        queue a file that just got read from the cold tier to be moved back
+        by the background thread.
+        """
+        if not self.promote_reads:
+            return
+        with self._lock:
+            if path in self._queued:
+                return
+            self._queued.add(path)
+        self._promotions.put(path)
+
+    def before_write(self, path):
+        self.touch(path)
+        self.promote(path)
+
+    def discard(self, path):
+        """
+        drop the cold copy of a file that got replaced or deleted.
+        """
+        delete_file(self.cold_path(path))
+
+    def demote_all(self):
+        """
+        run a `DemoteJob` right now, in the calling thread.
+
+        :return: DemoteJob
+        """
+        job = DemoteJob(self, rate=self.rate)
+        if self.jobs is not None:
+            self.jobs.track(job)
+        job()
+        return job
+
+    def pending(self):
+        return self._promotions.qsize()
+
+    def _work(self):
+        next_run = time.monotonic() + self.interval if self.interval \
+            else None
+        while not self._stop.is_set():
+            timeout = None if next_run is None else \
+                max(0.0, next_run - time.monotonic())
+            try:
+                path = self._promotions.get(timeout=timeout)
+            except queue.Empty:
+                path = None
+
+            if path is not None:
+                with self._lock:
+                    self._queued.discard(path)
+                try:
+                    self.promote(path)
+                except Exception:
+                    log.exception('promoting %s failed', path)
+
+            if next_run is not None and time.monotonic() >= next_run:
+                self.demote_all()
+                next_run = time.monotonic() + self.interval
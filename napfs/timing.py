@@ -0,0 +1,75 @@
+import json
+import logging
+import time
+
+__all__ = ['Timings']
+
+log = logging.getLogger('napfs')
+
+
+class Timings(object):
+    """
+    Collects how long each phase of a request took, so it can be sent back
+    in a `Server-Timing` header or logged when the request is slow.
+
+    Phases with the same name add up, so a phase that happens several times
+    in one request is reported once.
+    """
+    __slots__ = ['start', 'phases']
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+
+    def add(self, name, seconds):
+        for i, (k, v) in enumerate(self.phases):
+            if k == name:
+                self.phases[i] = (k, v + seconds)
+                return
+        self.phases.append((name, seconds))
+
+    def lap(self, name, since):
+        """
+        record the time elapsed since `since` under `name`.
+        returns the current time so calls can be chained.
+
+        :param name: str
+        :param since: float, from time.perf_counter()
+        :return: float
+        """
+        now = time.perf_counter()
+        self.add(name, now - since)
+        return now
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def header(self):
+        """
+        render the phases as a `Server-Timing` header value. durations are
+        in milliseconds.
+
+        :return: str
+        """
+        phases = self.phases + [('total', self.total())]
+        return ', '.join('%s;dur=%.3f' % (k, v * 1000) for k, v in phases)
+
+    def log(self, method, path, threshold):
+        """
+        write a structured log line if the request took longer than
+        `threshold` seconds.
+
+        :return: bool, whether the request was slow
+        """
+        total = self.total()
+        if total < threshold:
+            return False
+        log.warning(json.dumps({
+            'event': 'slow_request',
+            'method': method,
+            'path': path,
+            'total_ms': round(total * 1000, 3),
+            'phases_ms': dict((k, round(v * 1000, 3))
+                              for k, v in self.phases),
+        }, sort_keys=True))
+        return True
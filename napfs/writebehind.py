@@ -0,0 +1,184 @@
+import atexit
+import logging
+import threading
+
+from .data import MetaDataBackend, MetaDataUpdate, get_backend
+from .helpers import parse_byte_ranges_from_list, condense_byte_ranges, \
+    BYTE_RANGE_STRING_PATTERN
+
+__all__ = ['WriteBehind']
+
+log = logging.getLogger('napfs')
+
+
+def _merge(older, newer):
+    if newer is None:
+        return older
+    if newer.reset:
+        return newer
+    older.headers.update(newer.headers)
+    older.parts = (older.parts - newer.remove) | newer.parts
+    older.remove = (older.remove | newer.remove) - older.parts
+    return older
+
+
+def _overlay(headers, parts, update):
+    if update is None:
+        return headers, parts
+    if update.reset:
+        headers, parts = {}, set()
+    headers.update(update.headers)
+    parts = (parts - update.remove) | update.parts
+    return headers, parts
+
+
+class WriteBehind(MetaDataBackend):
+    """
+    Queues metadata changes in memory and writes them to the real backend
+    every `interval` seconds, so a burst of PATCH requests costs one
+    round trip per window instead of one per chunk. The parts queued for a
+    path are merged into as few ranges as possible before they are written.
+
+    Reads still go to the backend, with the changes of this process that
+    are queued or being flushed laid over what comes back, so requests in
+    this process always see their own writes as well as everything other
+    processes have flushed. Other processes only see these writes after
+    the flush.
+
+    Hand it to the `Router`, which starts it in front of the configured
+    backend. Whatever is queued gets flushed when the process exits.
+    """
+    __slots__ = ['interval', 'backend', 'flushes', 'flushed', '_pending',
+                 '_flushing', '_lock', '_flush_lock', '_thread', '_stop']
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.backend = None
+        self.flushes = 0
+        self.flushed = 0
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self, db):
+        if db is None:
+            raise ValueError('write behind needs a metadata backend to '
+                             'write to')
+        self.backend = get_backend(db)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work,
+                                            name='napfs-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _queued(self, path):
+        update = self._pending.get(path)
+        if update is None:
+            update = self._pending[path] = MetaDataUpdate(path)
+        return update
+
+    def update(self, path, headers=None, parts=None, reset=False):
+        if headers or parts is not None or reset:
+            with self._lock:
+                if reset:
+                    update = self._pending[path] = MetaDataUpdate(path)
+                    update.reset = True
+                else:
+                    update = self._queued(path)
+                if headers:
+                    update.headers.update(headers)
+                if parts:
+                    update.parts.update(parts)
+                    update.remove.difference_update(parts)
+        return self.get_many([path])[0]
+
+    def compact(self, path, remove, add):
+        with self._lock:
+            update = self._queued(path)
+            update.parts.difference_update(remove)
+            update.parts.add(add)
+            update.remove.update(remove)
+            update.remove.discard(add)
+        return self.get_many([path])[0][1]
+
+    def get_many(self, paths):
+        found = self.backend.get_many(paths)
+        results = []
+        with self._lock:
+            for path, (headers, parts) in zip(paths, found):
+                headers, parts = _overlay(dict(headers), set(parts),
+                                          self._flushing.get(path))
+                headers, parts = _overlay(headers, parts,
+                                          self._pending.get(path))
+                results.append((headers, list(parts)))
+        return results
+
+    def delete_many(self, paths):
+        for path in paths:
+            self.update(path, reset=True)
+
+    def write_many(self, updates):
+        self.backend.write_many(updates)
+
+    def flush(self):
+        """
+        write everything queued so far to the backend.
+
+        :return: int, the number of paths written
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                for update in pending.values():
+                    self._condense(update)
+                self._flushing = pending
+
+            if not pending:
+                return 0
+
+            try:
+                self.backend.write_many(list(pending.values()))
+            except Exception:
+                log.exception('write behind flush of %d paths failed',
+                              len(pending))
+                with self._lock:
+                    for path, update in pending.items():
+                        self._pending[path] = _merge(
+                            update, self._pending.get(path))
+                    self._flushing = {}
+                return 0
+
+            with self._lock:
+                self._flushing = {}
+            self.flushes += 1
+            self.flushed += len(pending)
+            return len(pending)
+
+    @staticmethod
+    def _condense(update):
+        if len(update.parts) < 2:
+            return
+        parts = set('%d-%d' % (first, last) for first, last in
+                    condense_byte_ranges(
+                        parse_byte_ranges_from_list(update.parts)))
+        # the total length and completion markers go through as they are.
+        parts.update(p for p in update.parts
+                     if not BYTE_RANGE_STRING_PATTERN.match(p))
+        update.parts = parts
+        update.remove.difference_update(parts)
+
+    def _work(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
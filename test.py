@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import unittest
+import unittest.mock
 import string
 import random
 import webtest
@@ -8,9 +9,22 @@ import shutil
 import redislite
 import napfs
 import falcon
+import falcon.testing
+import fcntl
 import hashlib
+import io
+import json
+import pstats
+import socketserver
+import threading
+import time
+from wsgiref.simple_server import make_server, WSGIServer, \
+    WSGIRequestHandler
 from napfs.helpers import condense_byte_ranges, \
     get_last_contiguous_byte
+from napfs.fs import tree_checksum, TREE_BLOCK_SIZE, write_file_chunk, \
+    lock_stats, file_slice
+from napfs.media import build_index
 
 redis_connection = redislite.StrictRedis(dbfilename='/tmp/test-napfs.db')
 NAPFS_DATA_DIR = '/tmp/test-napfs'
@@ -19,11 +33,12 @@ NOT_FOUND_BODY = b'{"title": "404 Not Found"}'
 NOT_FOUND_BODY_LEN = str(len(NOT_FOUND_BODY))
 
 
-def create_app():
+def create_app(**kwargs):
     if not os.path.exists(NAPFS_DATA_DIR):
         os.mkdir(NAPFS_DATA_DIR)
     return webtest.TestApp(napfs.create_app(
-        data_dir=NAPFS_DATA_DIR, redis_connection=redis_connection))
+        data_dir=NAPFS_DATA_DIR, redis_connection=redis_connection,
+        **kwargs))
 
 
 def create_router_app(router):
@@ -402,6 +417,63 @@ class ChecksumPartTest(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
 
 
+def sha256_tree(content, block_size=TREE_BLOCK_SIZE):
+    level = [hashlib.sha256(b'\x00' + content[i:i + block_size]).digest()
+             for i in range(0, max(len(content), 1), block_size)]
+    while len(level) > 1:
+        pairs = [level[i:i + 2] for i in range(0, len(level), 2)]
+        level = [hashlib.sha256(b'\x01' + p[0] + p[1]).digest()
+                 if len(p) == 2 else p[0] for p in pairs]
+    return level[0].hex()
+
+
+class TreeChecksumTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+
+    def tearDown(self):
+        clean()
+
+    def test_digest(self):
+        content = os.urandom(1000)
+        chunks = [content[i:i + 7] for i in range(0, len(content), 7)]
+        for block_size in (1, 10, 64, 333, 1000, 4096):
+            for workers in (1, 4):
+                self.assertEqual(
+                    tree_checksum(chunks, 'sha256-tree', workers=workers,
+                                  block_size=block_size),
+                    sha256_tree(content, block_size))
+        self.assertEqual(tree_checksum([], 'sha256-tree'), sha256_tree(b''))
+        self.assertNotEqual(tree_checksum([content], 'blake2b-tree'),
+                            tree_checksum([content], 'sha256-tree'))
+
+    def test_get(self):
+        uri = "/test/%s.txt" % random_string(10)
+        content = random_string(TREE_BLOCK_SIZE * 2 + 100)
+        self.app.patch(uri, params=content,
+                       headers={'x-checksum-type': 'sha256-tree',
+                                'x-checksum': sha256_tree(content)})
+
+        res = self.app.get(uri, headers={'x-checksum': 'sha256-tree'})
+        self.assertEqual(res.body, sha256_tree(content).encode('utf-8'))
+
+        res = self.app.get(uri, headers={'x-checksum': 'sha256-tree',
+                                         'range': 'bytes=5-'})
+        self.assertEqual(res.body, sha256_tree(content[5:]).encode('utf-8'))
+
+        res = self.app.get(uri, headers={'x-checksum': 'sha256'})
+        self.assertEqual(res.body, hashlib.sha256(content).hexdigest().encode(
+            'utf-8'))
+
+    def test_patch_fail(self):
+        uri = "/test/%s.txt" % random_string(10)
+        res = self.app.patch(uri, params='a',
+                             headers={'x-checksum-type': 'blake2b-tree',
+                                      'x-checksum': sha256_tree(b'a')},
+                             expect_errors=True)
+        self.assertEqual(res.status_code, 412)
+
+
 class PassthroughHeadersTest(unittest.TestCase):
     def setUp(self):
         self.app = create_app()
@@ -532,5 +604,1618 @@ class NoRedisTest(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
 
 
+class ObjectCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = napfs.ObjectCache(max_bytes=4096, max_object_size=2048)
+        self.app = create_app(cache=self.cache)
+
+    def tearDown(self):
+        clean()
+
+    def test_hit(self):
+        uri = "/test/%s.txt" % random_string(10)
+        data = random_string()
+        self.app.post(uri, params=data, headers={'x-head-foo': 'bar'})
+
+        res = self.app.get(uri)
+        self.assertEqual(res.body, data)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+        self.assertEqual(self.cache.stats()['entries'], 1)
+
+        res = self.app.get(uri)
+        self.assertEqual(res.body, data)
+        self.assertEqual(res.headers['x-parts'], '0-1023')
+        self.assertEqual(res.headers['x-head-foo'], 'bar')
+        self.assertEqual(self.cache.hits, 1)
+
+        res = self.app.get(uri, headers={'Range': 'bytes=100-199'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.body, data[100:200])
+
+        res = self.app.head(uri)
+        self.assertEqual(res.headers['content-length'], '1024')
+        self.assertEqual(self.cache.hits, 3)
+
+    def test_invalidate(self):
+        uri = "/test/%s.txt" % random_string(10)
+        data = random_string()
+        self.app.patch(uri, params=data)
+        self.app.get(uri)
+        self.assertEqual(len(self.cache), 1)
+
+        chunk = random_string()
+        self.app.patch('%s?offset=%d' % (uri, len(data)), params=chunk)
+        self.assertEqual(len(self.cache), 0)
+        res = self.app.get(uri)
+        self.assertEqual(res.body, data + chunk)
+
+        self.app.post(uri, params=chunk)
+        res = self.app.get(uri)
+        self.assertEqual(res.body, chunk)
+
+        self.app.delete(uri)
+        self.assertEqual(len(self.cache), 0)
+        res = self.app.get(uri, expect_errors=True)
+        self.assertEqual(res.status_code, 404)
+
+    def test_skip_partial_and_large(self):
+        uri = "/test/%s.txt" % random_string(10)
+        self.app.patch('%s?offset=6' % uri, params='ccc')
+        self.app.patch(uri, params='aaa')
+        self.app.get(uri)
+        self.assertEqual(len(self.cache), 0)
+
+        uri = "/test/%s.txt" % random_string(10)
+        self.app.post(uri, params=random_string(4000))
+        self.app.get(uri)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_budget(self):
+        uris = ["/test/%s.txt" % random_string(10) for _ in range(5)]
+        for uri in uris:
+            self.app.post(uri, params=random_string())
+            self.app.get(uri)
+        self.assertEqual(len(self.cache), 4)
+        self.assertLessEqual(self.cache.size, 4096)
+        self.assertIsNone(self.cache.get(uris[0]))
+
+
+class MmapReadModeTest(unittest.TestCase):
+    def setUp(self):
+        self.router = napfs.Router(data_dir=NAPFS_DATA_DIR,
+                                   redis_connection=redis_connection,
+                                   read_mode='mmap')
+        self.app = create_router_app(self.router)
+
+    def tearDown(self):
+        clean()
+
+    def test_grow(self):
+        uri = "/test/%s.txt" % random_string(10)
+        data = random_string(1024 * 300)
+        self.app.patch(uri, params=data)
+
+        res = self.app.get(uri)
+        self.assertEqual(res.body, data)
+        view = self.router.maps.view(self.router.get_local_path(uri))
+
+        res = self.app.get(uri, headers={'Range': 'bytes=100-'})
+        self.assertEqual(res.body, data[100:])
+        self.assertIs(
+            self.router.maps.view(self.router.get_local_path(uri)), view)
+
+        chunk = random_string()
+        self.app.patch('%s?offset=%d' % (uri, len(data)), params=chunk)
+        res = self.app.get(uri)
+        self.assertEqual(res.body, data + chunk)
+        self.assertEqual(len(self.router.maps), 1)
+        self.assertEqual(bytes(view[:100]), data[:100])
+
+        res = self.app.get(uri, headers={'x-checksum': 'sha1'})
+        self.assertEqual(res.body, hashlib.sha1(
+            data + chunk).hexdigest().encode('utf-8'))
+
+    def test_replace(self):
+        uri = "/test/%s.txt" % random_string(10)
+        self.app.post(uri, params='aaa')
+        self.assertEqual(self.app.get(uri).body, b'aaa')
+        self.app.post(uri, params='bbb')
+        self.assertEqual(self.app.get(uri).body, b'bbb')
+        self.app.delete(uri)
+        res = self.app.get(uri, expect_errors=True)
+        self.assertEqual(res.status_code, 404)
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, napfs.Router, data_dir=NAPFS_DATA_DIR,
+                          read_mode='bogus')
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = napfs.Metrics()
+        self.app = create_app(metrics=self.metrics,
+                              cache=napfs.ObjectCache())
+
+    def tearDown(self):
+        clean()
+
+    def test(self):
+        uri = "/test/%s.txt" % random_string(10)
+        data = random_string()
+        self.app.patch(uri, params=data)
+        self.app.get(uri)
+        self.app.get(uri, headers={'Range': 'bytes=0-99'})
+        self.app.patch(uri, params='a', headers={'x-checksum': 'garbage'},
+                       expect_errors=True)
+
+        self.assertEqual(self.metrics.requests.count(('GET',)), 2)
+        self.assertEqual(self.metrics.requests.count(('PATCH',)), 2)
+        self.assertEqual(self.metrics.bytes_in.value(), 1024)
+        self.assertEqual(self.metrics.bytes_out.value(), 1124)
+        self.assertEqual(self.metrics.checksum_failures.value(), 1)
+        self.assertEqual(self.metrics.metadata.count(), 2)
+
+        res = self.app.get('/_metrics')
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        body = res.body.decode('utf-8')
+        self.assertIn('# TYPE napfs_request_duration_seconds histogram',
+                      body)
+        self.assertIn('napfs_request_duration_seconds_count{method="GET"} 2',
+                      body)
+        self.assertIn(
+            'napfs_request_duration_seconds_bucket{method="GET",le="+Inf"} 2',
+            body)
+        self.assertIn('napfs_checksum_failures_total 1', body)
+        self.assertIn('napfs_cache_hits_total 1', body)
+        self.assertIn('napfs_open_files ', body)
+        self.assertIn('napfs_write_lock_wait_seconds_total ', body)
+
+
+class ServerTimingTest(unittest.TestCase):
+    def tearDown(self):
+        clean()
+
+    def test_header(self):
+        app = create_app(server_timing=True)
+        uri = "/test/%s.txt" % random_string(10)
+        res = app.patch(uri, params=random_string(),
+                        headers={'x-checksum': hashlib.sha1(
+                            b'').hexdigest()}, expect_errors=True)
+        self.assertEqual(res.status_code, 412)
+
+        res = app.patch(uri, params=random_string())
+        phases = [p.split(';')[0] for p in
+                  res.headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['init', 'lock', 'read', 'write', 'meta',
+                                  'total'])
+
+        res = app.post(uri, params=random_string())
+        self.assertIn('lock;dur=', res.headers['Server-Timing'])
+
+        res = app.get(uri)
+        self.assertTrue(res.headers['Server-Timing'].startswith('meta;dur='))
+
+    def test_slow_log(self):
+        app = create_app(slow_request_threshold=0)
+        uri = "/test/%s.txt" % random_string(10)
+        with self.assertLogs('napfs', level='WARNING') as logs:
+            res = app.patch(uri, params=random_string())
+            app.get(uri)
+        self.assertNotIn('Server-Timing', res.headers)
+        self.assertEqual(len(logs.records), 2)
+        entry = json.loads(logs.records[1].getMessage())
+        self.assertEqual(entry['event'], 'slow_request')
+        self.assertEqual(entry['method'], 'GET')
+        self.assertEqual(entry['path'], uri)
+        self.assertIn('stream', entry['phases_ms'])
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = os.path.join(NAPFS_DATA_DIR, '_profiles')
+
+    def tearDown(self):
+        clean()
+
+    def test_sample(self):
+        profiler = napfs.Profiler(self.output_dir, sample_rate=1.0)
+        app = create_app(profiler=profiler)
+        uri = "/test/%s.txt" % random_string(10)
+        app.patch(uri, params=random_string())
+        app.get(uri)
+        profiler.flush()
+
+        self.assertEqual(profiler.samples, 2)
+        stats = pstats.Stats(
+            os.path.join(self.output_dir, 'napfs-on_patch.pstats'))
+        self.assertTrue(any(func[2] == 'write_file_chunk'
+                            for func in stats.stats))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.output_dir, 'napfs-on_get.pstats')))
+
+    def test_debug_header(self):
+        profiler = napfs.Profiler(self.output_dir, token='secret')
+        app = create_app(profiler=profiler)
+        uri = "/test/%s.txt" % random_string(10)
+        app.patch(uri, params='a')
+        app.patch(uri, params='a', headers={'x-napfs-profile': 'wrong'})
+        self.assertEqual(profiler.samples, 0)
+        app.patch(uri, params='a', headers={'x-napfs-profile': 'secret'})
+        self.assertEqual(profiler.samples, 1)
+        profiler.flush()
+
+
+class BulkMetaTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(bulk_path='/_meta')
+
+    def tearDown(self):
+        clean()
+
+    def test(self):
+        uris = ["/test/%s.txt" % random_string(10) for _ in range(3)]
+        self.app.patch(uris[0], params=random_string(),
+                       headers={'x-head-foo': 'bar'})
+        self.app.patch('%s?offset=10' % uris[1], params='aaa')
+        self.app.patch(uris[1], params='bb')
+
+        res = self.app.post_json('/_meta', {'paths': uris})
+        results = res.json['results']
+        self.assertEqual([r['path'] for r in results], uris)
+
+        self.assertEqual(results[0]['parts'], '0-1023')
+        self.assertEqual(results[0]['headers'], {'foo': 'bar'})
+        self.assertEqual(results[0]['size'], 1024)
+
+        self.assertEqual(results[1]['parts'], '0-1,10-12')
+        self.assertEqual(results[1]['size'], 13)
+
+        self.assertEqual(results[2]['parts'], '')
+        self.assertEqual(results[2]['headers'], {})
+        self.assertIsNone(results[2]['size'])
+
+        res = self.app.post_json('/_meta', uris[:1])
+        self.assertEqual(res.json['results'][0]['size'], 1024)
+
+    def test_invalid(self):
+        res = self.app.post('/_meta', params='nope', expect_errors=True)
+        self.assertEqual(res.status_code, 400)
+        res = self.app.post_json('/_meta', ['relative'], expect_errors=True)
+        self.assertEqual(res.status_code, 400)
+        res = self.app.get('/_meta', expect_errors=True)
+        self.assertEqual(res.status_code, 405)
+
+
+class ListingTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(listing=True)
+
+    def tearDown(self):
+        clean()
+
+    def list(self, uri, **params):
+        res = self.app.get(uri, params=dict(list=1, **params))
+        self.assertEqual(res.content_type, 'application/x-ndjson')
+        rows = [json.loads(line) for line in res.body.splitlines()]
+        return rows, res.headers.get('x-next-cursor')
+
+    def test(self):
+        prefix = "/test/%s" % random_string(10).decode('utf-8')
+        names = sorted('%s.txt' % random_string(6).decode('utf-8')
+                       for _ in range(5))
+        for name in names:
+            self.app.patch('%s/%s' % (prefix, name), params='aaa',
+                           headers={'x-head-foo': 'bar'})
+        self.app.patch('%s/sub/x.txt' % prefix, params='a')
+
+        rows, cursor = self.list(prefix + '/', stat=1, meta=1)
+        self.assertIsNone(cursor)
+        self.assertEqual([r['name'] for r in rows], sorted(names + ['sub']))
+        rows = dict((r['name'], r) for r in rows)
+        row = rows[names[0]]
+        self.assertEqual(row['path'], '%s/%s' % (prefix, names[0]))
+        self.assertEqual(row['type'], 'file')
+        self.assertEqual(row['size'], 3)
+        self.assertEqual(row['parts'], '0-2')
+        self.assertEqual(row['headers'], {'foo': 'bar'})
+        self.assertEqual(rows['sub']['type'], 'dir')
+        self.assertNotIn('parts', rows['sub'])
+
+        listed = []
+        cursor = None
+        while True:
+            params = {'limit': 2}
+            if cursor is not None:
+                params['cursor'] = cursor
+            rows, cursor = self.list(prefix, **params)
+            self.assertLessEqual(len(rows), 2)
+            listed.extend(r['name'] for r in rows)
+            if cursor is None:
+                break
+        self.assertEqual(listed, sorted(names + ['sub']))
+
+    def test_missing(self):
+        res = self.app.get('/nothing/here', params={'list': 1},
+                           expect_errors=True)
+        self.assertEqual(res.status_code, 404)
+
+    def test_disabled(self):
+        app = create_app()
+        app.patch('/test/a.txt', params='aaa')
+        res = app.get('/test', params={'list': 1}, expect_errors=True)
+        self.assertEqual(res.status_code, 404)
+
+
+class PrefixDeleteTest(unittest.TestCase):
+    def setUp(self):
+        self.router = napfs.Router(data_dir=NAPFS_DATA_DIR,
+                                   redis_connection=redis_connection,
+                                   jobs_path='/_jobs')
+        self.app = create_router_app(self.router)
+
+    def tearDown(self):
+        clean()
+
+    def test(self):
+        prefix = "/test/%s" % random_string(10).decode('utf-8')
+        uris = ['%s/%s.txt' % (prefix, i) for i in range(3)]
+        uris.append('%s/sub/dir/x.txt' % prefix)
+        for uri in uris:
+            self.app.patch(uri, params='aaa')
+        other = "/test/%s.txt" % random_string(10)
+        self.app.patch(other, params='aaa')
+
+        res = self.app.delete(prefix + '?prefix=1')
+        self.assertEqual(res.status_code, 202)
+        job_id = res.headers['x-job-id']
+        self.router.jobs.join()
+
+        res = self.app.get('/_jobs', params={'id': job_id})
+        self.assertEqual(res.json['status'], 'done')
+        self.assertEqual(res.json['progress']['files'], 4)
+        self.assertEqual(res.json['progress']['bytes'], 12)
+        self.assertEqual(res.json['prefix'], prefix)
+
+        for uri in uris:
+            res = self.app.get(uri, expect_errors=True)
+            self.assertEqual(res.status_code, 404)
+            self.assertEqual(redis_connection.exists('P{%s}' % uri), 0)
+        self.assertFalse(os.path.exists(NAPFS_DATA_DIR + prefix))
+        self.assertEqual(self.app.get(other).body, b'aaa')
+
+        res = self.app.get('/_jobs')
+        self.assertEqual([j['id'] for j in res.json['jobs']], [job_id])
+
+    def test_invalid(self):
+        res = self.app.delete('/nothing?prefix=1', expect_errors=True)
+        self.assertEqual(res.status_code, 404)
+        res = self.app.delete('/?prefix=1', expect_errors=True)
+        self.assertEqual(res.status_code, 400)
+        res = self.app.get('/_jobs', params={'id': 'nope'},
+                           expect_errors=True)
+        self.assertEqual(res.status_code, 404)
+
+        app = create_app()
+        app.patch('/test/a.txt', params='aaa')
+        res = app.delete('/test?prefix=1', expect_errors=True)
+        self.assertEqual(res.status_code, 400)
+
+
+class SweeperTest(unittest.TestCase):
+    def setUp(self):
+        self.sweeper = napfs.Sweeper(interval=None, orphan_age=60,
+                                     incomplete_age=3600)
+        self.app = create_app(sweeper=self.sweeper, jobs_path='/_jobs')
+
+    def tearDown(self):
+        clean()
+
+    def age(self, uri, seconds):
+        path = NAPFS_DATA_DIR + uri
+        t = os.stat(path).st_mtime - seconds
+        os.utime(path, (t, t))
+
+    def test(self):
+        complete = "/test/%s.txt" % random_string(10)
+        self.app.post(complete, params='aaa')
+        self.age(complete, 7200)
+
+        incomplete = "/test/%s.txt" % random_string(10)
+        self.app.patch(incomplete, params='aaa')
+        self.app.patch('%s?offset=6' % incomplete, params='ccc')
+        self.age(incomplete, 7200)
+
+        recent = "/test/%s.txt" % random_string(10)
+        self.app.patch(recent, params='aaa')
+        self.app.patch('%s?offset=6' % recent, params='ccc')
+
+        orphan = "/test/%s.txt" % random_string(10)
+        self.app.post(orphan, params='aaaa')
+        redis_connection.delete('P{%s}' % orphan)
+        self.age(orphan, 120)
+
+        job = self.sweeper.sweep()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.progress['scanned'], 4)
+        self.assertEqual(job.progress['removed'], 2)
+        self.assertEqual(self.sweeper.reclaimed_bytes, 13)
+
+        self.assertFalse(os.path.exists(NAPFS_DATA_DIR + incomplete))
+        self.assertFalse(os.path.exists(NAPFS_DATA_DIR + orphan))
+        self.assertEqual(redis_connection.exists('P{%s}' % incomplete), 0)
+        self.assertEqual(self.app.get(complete).body, b'aaa')
+        self.assertEqual(self.app.get(recent).body, b'aaa')
+
+        res = self.app.get('/_jobs', params={'id': job.id})
+        self.assertEqual(res.json['kind'], 'sweep')
+        self.assertEqual(res.json['progress']['reclaimed_bytes'], 13)
+
+    def test_needs_metadata(self):
+        self.assertRaises(ValueError, napfs.Router, data_dir=NAPFS_DATA_DIR,
+                          sweeper=napfs.Sweeper())
+
+
+class ShardedRedisTest(unittest.TestCase):
+    node_names = ['a', 'b', 'c']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.nodes = dict(
+            (name, redislite.StrictRedis(
+                dbfilename='/tmp/test-napfs-shard-%s.db' % name))
+            for name in cls.node_names)
+
+    def setUp(self):
+        if not os.path.exists(NAPFS_DATA_DIR):
+            os.mkdir(NAPFS_DATA_DIR)
+        self.sharded = napfs.ShardedRedis(
+            dict((k, self.nodes[k]) for k in self.node_names[:2]))
+        self.app = webtest.TestApp(napfs.create_app(
+            data_dir=NAPFS_DATA_DIR, redis_connection=self.sharded))
+
+    def tearDown(self):
+        clean()
+        for node in self.nodes.values():
+            node.flushdb()
+
+    def upload(self, count=30):
+        uris = ["/test/%s.txt" % random_string(10).decode('utf-8')
+                for _ in range(count)]
+        for uri in uris:
+            self.app.patch(uri, params='aaa', headers={'x-head-foo': 'bar'})
+            self.app.patch('%s?offset=3' % uri, params='bbb')
+        return uris
+
+    def test_distribution(self):
+        uris = self.upload()
+        for uri in uris:
+            node = self.sharded.node(uri)
+            self.assertEqual(node.exists('P{%s}' % uri, 'H{%s}' % uri), 2)
+            res = self.app.get(uri)
+            self.assertEqual(res.body, b'aaabbb')
+            self.assertEqual(res.headers['x-parts'], '0-5')
+            self.assertEqual(res.headers['x-head-foo'], 'bar')
+        self.assertTrue(self.nodes['a'].dbsize())
+        self.assertTrue(self.nodes['b'].dbsize())
+
+        pipe = self.sharded.pipeline()
+        for uri in uris:
+            pipe.smembers('P{%s}' % uri)
+        self.assertEqual(pipe.execute(), [{b'0-2', b'3-5'}] * len(uris))
+
+    def test_reshard(self):
+        uris = self.upload()
+        target = napfs.ShardedRedis(self.nodes)
+        moved = napfs.reshard(self.sharded, target)
+        self.assertTrue(moved > 0)
+        self.assertTrue(self.nodes['c'].dbsize())
+        self.assertEqual(self.nodes['c'].dbsize(), moved)
+
+        app = webtest.TestApp(napfs.create_app(
+            data_dir=NAPFS_DATA_DIR, redis_connection=target))
+        for uri in uris:
+            res = app.get(uri)
+            self.assertEqual(res.headers['x-parts'], '0-5')
+            self.assertEqual(res.headers['x-head-foo'], 'bar')
+            self.assertTrue(target.node(uri).ttl('P{%s}' % uri) > 0)
+
+    def test_ring(self):
+        ring = napfs.sharding.HashRing(['a', 'b', 'c'])
+        bigger = napfs.sharding.HashRing(['a', 'b', 'c', 'd'])
+        keys = ['/%d' % i for i in range(1000)]
+        moved = [k for k in keys if ring.get(k) != bigger.get(k)]
+        self.assertTrue(all(bigger.get(k) == 'd' for k in moved))
+        self.assertTrue(150 < len(moved) < 350)
+
+
+class SqliteBackendTest(unittest.TestCase):
+    db_path = '/tmp/test-napfs-meta.sqlite'
+
+    def setUp(self):
+        self.backend = napfs.SqliteBackend(self.db_path)
+        self.app = create_app(metadata_backend=self.backend,
+                              bulk_path='/_meta')
+
+    def tearDown(self):
+        clean()
+        self.backend.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
+
+    def test(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        for i in reversed(range(5)):
+            self.app.patch('%s?offset=%d' % (uri, i * 2), params='ab',
+                           headers={'x-head-foo': 'bar'})
+        res = self.app.get(uri)
+        self.assertEqual(res.body, b'ab' * 5)
+        self.assertEqual(res.headers['x-parts'], '0-9')
+        self.assertEqual(res.headers['x-head-foo'], 'bar')
+        self.assertEqual(self.backend.update(uri)[1], ['0-9'])
+
+        # nothing went to redis.
+        self.assertFalse(redis_connection.dbsize())
+
+    def test_bulk(self):
+        uris = ["/test/%s.txt" % random_string(10).decode('utf-8')
+                for _ in range(3)]
+        self.app.patch(uris[0], params='aaa', headers={'x-head-foo': 'bar'})
+        self.app.patch('%s?offset=10' % uris[1], params='aaa')
+        results = self.app.post_json('/_meta', uris).json['results']
+        self.assertEqual(results[0]['parts'], '0-2')
+        self.assertEqual(results[0]['headers'], {'foo': 'bar'})
+        self.assertEqual(results[1]['parts'], '10-12')
+        self.assertEqual(results[2]['parts'], '')
+
+        napfs.data.delete_many(uris, db=self.backend)
+        self.assertEqual(self.backend.get_many(uris), [({}, [])] * 3)
+
+    def test_expire(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.patch(uri, params='aaa', headers={'x-head-foo': 'bar'})
+
+        conn = self.backend._conn()
+        conn.execute("UPDATE expires SET expires = 0 WHERE kind = 'H'")
+        headers, parts = self.backend.update(uri)
+        self.assertEqual(headers, {})
+        self.assertEqual(parts, ['0-2'])
+
+        other = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.patch(other, params='aaa', headers={'x-head-foo': 'bar'})
+        conn.execute('UPDATE expires SET expires = 0')
+        res = self.app.get(uri, expect_errors=True)
+        self.assertEqual(res.status_code, 404)
+
+        # the read dropped the rows of the first path, the purge gets the
+        # headers and parts of the other one.
+        self.assertEqual(self.backend.purge(), 2)
+        self.assertEqual(
+            conn.execute('SELECT COUNT(*) FROM parts').fetchone()[0], 0)
+
+
+class WriteBehindTest(unittest.TestCase):
+    def setUp(self):
+        self.write_behind = napfs.WriteBehind(interval=60)
+        self.app = create_app(write_behind=self.write_behind)
+
+    def tearDown(self):
+        self.write_behind.stop()
+        clean()
+
+    def test(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        for i in [2, 0, 3]:
+            res = self.app.patch('%s?offset=%d' % (uri, i * 2), params='ab',
+                                 headers={'x-head-foo': 'bar'})
+        self.assertEqual(res.headers['x-parts'], '0-1,4-7')
+
+        # nothing written yet, but this process sees its own writes.
+        self.assertFalse(redis_connection.exists('P{%s}' % uri))
+        self.app.patch('%s?offset=2' % uri, params='ab')
+        res = self.app.get(uri)
+        self.assertEqual(res.body, b'ab' * 4)
+        self.assertEqual(res.headers['x-head-foo'], 'bar')
+
+        self.assertEqual(self.write_behind.flush(), 1)
+        self.assertEqual(redis_connection.smembers('P{%s}' % uri),
+                         {b'0-7'})
+        self.assertEqual(redis_connection.hgetall('H{%s}' % uri),
+                         {b'foo': b'bar'})
+        self.assertEqual(self.write_behind.flush(), 0)
+
+        self.app.patch('%s?offset=8' % uri, params='ab')
+        self.assertEqual(self.app.get(uri).headers['x-parts'], '0-9')
+        self.write_behind.flush()
+        self.assertEqual(redis_connection.smembers('P{%s}' % uri),
+                         {b'0-7', b'8-9'})
+
+    def test_delete(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.patch(uri, params='aaa')
+        self.write_behind.flush()
+        self.app.delete(uri)
+        res = self.app.get(uri, expect_errors=True)
+        self.assertEqual(res.status_code, 404)
+        self.write_behind.flush()
+        self.assertFalse(redis_connection.exists('P{%s}' % uri))
+
+    def test_two_processes(self):
+        # another worker process, with its own write behind on the same
+        # redis.
+        other = napfs.WriteBehind(interval=60)
+        other_app = create_app(write_behind=other)
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        try:
+            self.app.patch(uri, params='a' * 100,
+                           headers={'x-total-length': '300'})
+            self.write_behind.flush()
+            other_app.patch('%s?offset=100' % uri, params='b' * 100)
+            other.flush()
+            res = self.app.patch('%s?offset=200' % uri, params='c' * 100)
+            self.assertEqual(res.headers['x-parts'], '0-299')
+            self.write_behind.flush()
+
+            res = other_app.get(uri)
+            self.assertEqual(res.body, b'a' * 100 + b'b' * 100 + b'c' * 100)
+            self.assertIn('x-completed-at', res.headers)
+        finally:
+            other.stop()
+
+    def test_stop(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.patch(uri, params='aaa')
+        self.assertEqual(self.write_behind.pending(), 1)
+        self.write_behind.stop()
+        self.assertEqual(self.write_behind.pending(), 0)
+        self.assertEqual(redis_connection.smembers('P{%s}' % uri),
+                         {b'0-2'})
+
+
+class ManifestTest(unittest.TestCase):
+    manifest_dir = '/tmp/test-napfs-manifests'
+
+    def setUp(self):
+        self.app = create_app(manifests=napfs.Manifests(self.manifest_dir,
+                                                        block_size=4))
+
+    def tearDown(self):
+        clean()
+        shutil.rmtree(self.manifest_dir, ignore_errors=True)
+
+    def digests(self, content):
+        return [hashlib.sha256(content[i:i + 4]).hexdigest()
+                for i in range(0, len(content), 4)]
+
+    def test(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        content = b'0123456789abcdefghij'
+        self.app.patch('%s?offset=10' % uri, params=content[10:])
+        self.app.patch('%s?offset=0' % uri, params=content[:6])
+
+        manifest = self.app.get('%s?manifest=1' % uri).json
+        self.assertEqual(manifest['block_size'], 4)
+        self.assertEqual(manifest['checksum'], 'sha256')
+        self.assertEqual(manifest['size'], 20)
+        # bytes 6-9 are missing, so blocks 1 and 2 aren't known yet.
+        digests = self.digests(content)
+        self.assertEqual(manifest['blocks'],
+                         [digests[0], None, None, digests[3], digests[4]])
+
+        self.app.patch('%s?offset=6' % uri, params=content[6:10])
+        manifest = self.app.get('%s?manifest=1' % uri).json
+        self.assertEqual(manifest['blocks'], digests)
+
+        # a client changes one block, and only sends that one.
+        changed = content[:8] + b'XXXX' + content[12:]
+        mine = self.digests(changed)
+        diff = [i for i, d in enumerate(manifest['blocks']) if d != mine[i]]
+        self.assertEqual(diff, [2])
+        self.app.patch('%s?offset=8' % uri, params=changed[8:12])
+        self.assertEqual(self.app.get(uri).body, changed)
+        self.assertEqual(self.app.get('%s?manifest=1' % uri).json['blocks'],
+                         mine)
+
+        manifest = self.app.get('%s?manifest=1' % uri,
+                                headers={'range': 'bytes=9-13'}).json
+        self.assertEqual(manifest['first_block'], 2)
+        self.assertEqual(manifest['blocks'], mine[2:4])
+
+    def test_post_copy_delete(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        copy = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.patch(uri, params='aaaaaaaaaa')
+        self.app.post(uri, params='bbbbbb')
+        self.assertEqual(self.app.get('%s?manifest=1' % uri).json['blocks'],
+                         self.digests(b'bbbbbb'))
+
+        self.app.post(copy, headers={'x-source': uri})
+        self.assertEqual(self.app.get('%s?manifest=1' % copy).json['blocks'],
+                         self.digests(b'bbbbbb'))
+
+        self.app.delete(uri)
+        res = self.app.get('%s?manifest=1' % uri, expect_errors=True)
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(os.path.exists(self.manifest_dir + uri +
+                                        '.manifest'))
+
+    def test_prefix_delete_and_sweep(self):
+        manifests = napfs.Manifests(self.manifest_dir, block_size=4)
+        sweeper = napfs.Sweeper(interval=None, orphan_age=60)
+        router = napfs.Router(data_dir=NAPFS_DATA_DIR,
+                              redis_connection=redis_connection,
+                              jobs_path='/_jobs', manifests=manifests,
+                              sweeper=sweeper)
+        app = create_router_app(router)
+        prefix = "/test/%s" % random_string(10).decode('utf-8')
+        uri = '%s/sub/a.txt' % prefix
+        app.patch(uri, params='aaaaaa')
+        self.assertTrue(os.path.exists(manifests.get_local_path(uri)))
+        app.delete(prefix + '?prefix=1')
+        router.jobs.join()
+        self.assertFalse(os.path.exists(self.manifest_dir + prefix))
+
+        orphan = "/test/%s.txt" % random_string(10).decode('utf-8')
+        app.post(orphan, params='aaaa')
+        redis_connection.delete('P{%s}' % orphan)
+        t = time.time() - 120
+        os.utime(NAPFS_DATA_DIR + orphan, (t, t))
+        self.assertEqual(sweeper.sweep().progress['removed'], 1)
+        self.assertFalse(os.path.exists(manifests.get_local_path(orphan)))
+
+
+class ChunkedUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+
+    def tearDown(self):
+        clean()
+
+    def chunked(self, method, uri, body, headers=None, **kwargs):
+        headers = dict(headers or {}, **{'Transfer-Encoding': 'chunked'})
+        return self.app.request(uri, method=method, body=body,
+                                headers=headers, **kwargs)
+
+    def test_patch(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        content = random_string(1024 * 150)
+        self.chunked('PATCH', '%s?offset=10' % uri, content[10:])
+        res = self.chunked('PATCH', uri, content[:10])
+        self.assertEqual(res.headers['x-parts'], '0-153599')
+        self.assertEqual(self.app.get(uri).body, content)
+
+    def test_post_checksum(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        content = random_string(1024 * 100)
+        res = self.chunked('POST', uri, content, headers={
+            'x-checksum-type': 'sha256',
+            'x-checksum': hashlib.sha256(content).hexdigest()})
+        self.assertEqual(res.headers['x-parts'], '0-102399')
+        self.assertEqual(self.app.get(uri).body, content)
+
+        res = self.chunked('PATCH', uri, b'abc', headers={
+            'x-checksum-type': 'sha256-tree', 'x-checksum': 'garbage'},
+            expect_errors=True)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(self.app.get(uri).headers['x-parts'], '0-102399')
+
+    def test_patch_bad_checksum(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.patch(uri, params=b'A' * 100)
+        res = self.chunked('PATCH', uri, b'B' * 50, headers={
+            'x-checksum-type': 'sha256', 'x-checksum': 'garbage'},
+            expect_errors=True)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(self.app.get(uri).body, b'A' * 100)
+
+        body = b'B' * 50
+        self.chunked('PATCH', uri, body, headers={
+            'x-checksum-type': 'sha256',
+            'x-checksum': hashlib.sha256(body).hexdigest()})
+        self.assertEqual(self.app.get(uri).body, b'B' * 50 + b'A' * 50)
+
+
+class AtomicOverwriteTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(listing=True)
+
+    def tearDown(self):
+        clean()
+
+    def test(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        old = random_string(1024 * 64)
+        self.app.post(uri, params=old)
+
+        # a reader that started before the overwrite keeps the old content.
+        router = napfs.Router(NAPFS_DATA_DIR, redis_connection)
+        resp = falcon.Response()
+        req = falcon.Request(falcon.testing.create_environ(path=uri))
+        router(req, resp)
+        stream = resp.stream
+        first = next(stream)
+
+        new = random_string(100)
+        self.app.post(uri, params=new)
+        self.assertEqual(first + b''.join(stream), old)
+
+        res = self.app.get(uri)
+        self.assertEqual(res.body, new)
+        self.assertEqual(res.headers['x-parts'], '0-99')
+        self.assertEqual(os.listdir(NAPFS_DATA_DIR + '/test'),
+                         [uri.split('/')[-1]])
+
+    def test_checksum_fail(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.post(uri, params='aaa')
+        res = self.app.post(uri, params='bbb', headers={'x-checksum': 'no'},
+                            expect_errors=True)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(res.headers['x-error-code'], 'CHECKSUM_FAIL')
+        self.assertEqual(self.app.get(uri).body, b'aaa')
+        self.assertEqual(len(os.listdir(NAPFS_DATA_DIR + '/test')), 1)
+
+    def test_copy(self):
+        src = "/test/%s.txt" % random_string(10).decode('utf-8')
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.post(src, params='aaa', headers={'x-head-foo': 'bar'})
+        self.app.post(uri, params='bbbbbb')
+        self.app.post(uri, headers={'x-source': src})
+        res = self.app.get(uri)
+        self.assertEqual(res.body, b'aaa')
+        self.assertEqual(res.headers['x-head-foo'], 'bar')
+        self.assertEqual(len(os.listdir(NAPFS_DATA_DIR + '/test')), 2)
+
+    def test_listing_skips_temp_files(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.post(uri, params='aaa')
+        open(napfs.fs.temp_file_path(NAPFS_DATA_DIR + uri), 'w').close()
+        rows = [json.loads(line) for line in
+                self.app.get('/test?list=1').body.splitlines()]
+        self.assertEqual([row['name'] for row in rows],
+                         [uri.split('/')[-1]])
+
+
+class ShaperTest(unittest.TestCase):
+    def setUp(self):
+        self.shaper = napfs.Shaper(client_rate=1024 * 1024, burst=0.05,
+                                   small_size=1024 * 16)
+        self.app = create_app(shaper=self.shaper)
+
+    def tearDown(self):
+        clean()
+
+    def test_token_bucket(self):
+        bucket = napfs.TokenBucket(1000, burst=100)
+        self.assertEqual(bucket.take(100), 0)
+        self.assertAlmostEqual(bucket.take(100), 0.1, places=2)
+        self.assertAlmostEqual(bucket.take(100), 0.2, places=2)
+
+    def test_client_rate(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        content = random_string(1024 * 256)
+        start = time.time()
+        self.app.patch(uri, params=content)
+        self.assertTrue(time.time() - start > 0.15)
+
+        start = time.time()
+        self.assertEqual(self.app.get(uri).body, content)
+        self.assertTrue(time.time() - start > 0.2)
+        self.assertFalse(self.shaper._flows)
+
+        # small reads don't wait, even with the bucket in debt.
+        start = time.time()
+        self.app.get(uri, headers={'range': 'bytes=0-1023'})
+        self.assertTrue(time.time() - start < 0.1)
+
+    def test_fair_share(self):
+        shaper = napfs.Shaper(rate=1000, weights={'/big/': 3})
+        flows = [shaper.start(None, path, None)
+                 for path in ('/big/a', '/b')]
+        self.assertEqual(shaper.pace(flows[0], 750), 0)
+        self.assertEqual(shaper.pace(flows[1], 250), 0)
+        self.assertAlmostEqual(flows[0].due - flows[1].due, 0, places=2)
+        shaper.finish(flows[0])
+        shaper.finish(flows[1])
+        self.assertEqual(shaper._total_weight, 0)
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.admission = napfs.Admission(max_writes=2, max_writes_per_path=1,
+                                         max_buffered_bytes=1000,
+                                         max_retry_after=30)
+        self.metrics = napfs.Metrics()
+        self.app = create_app(admission=self.admission, metrics=self.metrics)
+
+    def tearDown(self):
+        clean()
+
+    def test_limits(self):
+        admission = self.admission
+        first = admission.admit('/a', 600)
+        self.assertIsNotNone(first)
+        self.assertIsNone(admission.admit('/a', 1))
+        self.assertIsNone(admission.admit('/b', 600))
+        second = admission.admit('/b', 400)
+        self.assertIsNone(admission.admit('/c', 0))
+        self.assertEqual(admission.stats()['rejected_by'],
+                         {'path': 1, 'bytes': 1, 'writes': 1})
+
+        admission.release(first)
+        admission.release(second)
+        self.assertEqual(admission.in_flight, 0)
+        self.assertEqual(admission.buffered_bytes, 0)
+
+        # a body over the limit gets in on its own.
+        big = admission.admit('/a', 5000)
+        self.assertIsNotNone(big)
+        admission.release(big)
+
+    def test_retry_after(self):
+        admission = napfs.Admission(max_retry_after=30)
+        self.assertEqual(admission.retry_after(), 1)
+        tickets = [admission.admit('/a', 0) for _ in range(100)]
+        admission._interval = 0.5
+        self.assertEqual(admission.retry_after(), 30)
+        for ticket in tickets[:90]:
+            admission.release(ticket)
+        admission._interval = 0.5
+        self.assertEqual(admission.retry_after(), 5)
+
+    def test_reject(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        ticket = self.admission.admit(uri, 0)
+        res = self.app.patch(uri, params='aaa', expect_errors=True)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['retry-after'], '1')
+        self.assertFalse(os.path.exists(NAPFS_DATA_DIR + uri))
+
+        # reads and other paths still go through.
+        other = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.patch(other, params='aaa')
+        self.assertEqual(self.app.get(other).body, b'aaa')
+
+        self.admission.release(ticket)
+        self.app.patch(uri, params='aaa')
+        self.assertEqual(self.admission.in_flight, 0)
+
+        body = self.app.get('/_metrics').text
+        self.assertIn('napfs_admission_rejected_total 1', body)
+        self.assertIn('napfs_admission_admitted_total 3', body)
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(app=None):
+    """
+    run a wsgi app in a threaded http server on a free port of localhost.
+    """
+    httpd = make_server('127.0.0.1', 0, app,
+                        server_class=_ThreadingWSGIServer,
+                        handler_class=_QuietHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd, 'http://127.0.0.1:%d' % httpd.server_address[1]
+
+
+class ReplicationTest(unittest.TestCase):
+    PEER_DATA_DIR = '/tmp/test-napfs-peer'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.peer_redis = redislite.StrictRedis(
+            dbfilename='/tmp/test-napfs-peer.db')
+        if not os.path.exists(cls.PEER_DATA_DIR):
+            os.mkdir(cls.PEER_DATA_DIR)
+        cls.httpd, cls.peer_url = serve(napfs.create_app(
+            data_dir=cls.PEER_DATA_DIR, redis_connection=cls.peer_redis))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+        shutil.rmtree(cls.PEER_DATA_DIR)
+        cls.peer_redis.flushdb()
+
+    def setUp(self):
+        self.replicator = napfs.Replicator([self.peer_url], retry_delay=0)
+        self.app = create_app(replicator=self.replicator)
+        self.peer = napfs.Peer(self.peer_url)
+
+    def tearDown(self):
+        self.peer.close()
+        clean()
+
+    def test_patch(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        content = random_string(1024 * 10)
+        for offset in range(0, len(content), 1024):
+            self.app.patch(uri + '?offset=%d' % offset,
+                           params=content[offset:offset + 1024],
+                           headers={'Content-Type': 'text/plain'})
+        self.replicator.flush()
+
+        lag = self.replicator.lag()[self.peer_url]
+        self.assertEqual(lag['queued'], 0)
+        self.assertEqual(lag['failed'], 0)
+        self.assertTrue(1 <= lag['sent'] <= 10)
+
+        status, headers, body = self.peer.request('GET', uri)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, content)
+        headers = dict((k.lower(), v) for k, v in headers)
+        self.assertEqual(headers['content-type'], 'text/plain')
+        self.assertEqual(headers['x-parts'], '0-%d' % (len(content) - 1))
+
+    def test_spread_reads(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        content = random_string(1024)
+        self.app.patch(uri, params=content)
+        self.replicator.flush()
+
+        statuses = set()
+        for _ in range(4):
+            res = self.app.get(uri, expect_errors=True)
+            statuses.add(res.status_code)
+            if res.status_code == 307:
+                self.assertEqual(res.headers['location'],
+                                 self.peer_url + uri)
+            else:
+                self.assertEqual(res.body, content)
+        self.assertEqual(statuses, {200, 307})
+
+        # past what the peer has, the read stays here.
+        self.app.patch(uri + '?offset=1024', params=content)
+        self.replicator.flush()
+        self.replicator.replicas[0].prefixes[uri] = 1023
+        for _ in range(4):
+            res = self.app.get(uri)
+            self.assertEqual(res.body, content + content)
+
+    def test_post_and_delete(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.post(uri, params=b'abc')
+        self.replicator.flush()
+        self.assertEqual(self.peer.request('GET', uri)[2], b'abc')
+
+        self.app.delete(uri)
+        self.replicator.flush()
+        self.assertEqual(self.peer.request('GET', uri)[0], 404)
+        self.assertNotIn(uri, self.replicator.replicas[0].prefixes)
+
+    def test_unreachable_peer(self):
+        replicator = napfs.Replicator(['http://127.0.0.1:1'], max_retries=1,
+                                      retry_delay=0, timeout=1)
+        app = create_app(replicator=replicator)
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        app.patch(uri, params=b'abc')
+        replicator.flush()
+        self.assertEqual(replicator.lag()['http://127.0.0.1:1']['failed'], 1)
+        self.assertEqual(app.get(uri).body, b'abc')
+
+    def test_coalesce(self):
+        from napfs.replication import _coalesce, _Op
+        ops = [
+            _Op('patch', '/a', 0, 10),
+            _Op('patch', '/a', 10, 10),
+            _Op('patch', '/b', 0, 10),
+            _Op('patch', '/a', 5, 20),
+            _Op('patch', '/a', 40, 10),
+            _Op('delete', '/b'),
+            _Op('patch', '/b', 10, 10),
+        ]
+        merged = [(op.kind, op.path, op.offset, op.length)
+                  for op in _coalesce(ops, 1000)]
+        self.assertEqual(merged, [
+            ('patch', '/a', 0, 25),
+            ('patch', '/b', 0, 10),
+            ('patch', '/a', 40, 10),
+            ('delete', '/b', 0, 0),
+            ('patch', '/b', 10, 10),
+        ])
+        merged = _coalesce(ops[:2], 15)
+        self.assertEqual([op.length for op in merged], [10, 10])
+
+
+class ClusterTest(unittest.TestCase):
+    NODE_B_DATA_DIR = '/tmp/test-napfs-node-b'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.redis_b = redislite.StrictRedis(
+            dbfilename='/tmp/test-napfs-node-b.db')
+        cls.httpd_a, cls.url_a = serve()
+        cls.httpd_b, cls.url_b = serve()
+
+    @classmethod
+    def tearDownClass(cls):
+        for httpd in (cls.httpd_a, cls.httpd_b):
+            httpd.shutdown()
+            httpd.server_close()
+        cls.redis_b.flushdb()
+
+    def setUp(self):
+        for d in (NAPFS_DATA_DIR, self.NODE_B_DATA_DIR):
+            if not os.path.exists(d):
+                os.mkdir(d)
+        self.client = napfs.Peer(self.url_a)
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.NODE_B_DATA_DIR)
+        self.redis_b.flushdb()
+        clean()
+
+    def start(self, nodes, mode='redirect'):
+        routers = []
+        for url, data_dir, db, httpd in [
+                (self.url_a, NAPFS_DATA_DIR, redis_connection, self.httpd_a),
+                (self.url_b, self.NODE_B_DATA_DIR, self.redis_b,
+                 self.httpd_b)]:
+            cluster = None
+            if url in nodes:
+                cluster = napfs.Cluster(nodes, url, mode=mode)
+            router = napfs.Router(data_dir=data_dir, redis_connection=db,
+                                  cluster=cluster)
+            app = falcon.API()
+            app.add_sink(router, '/')
+            httpd.set_app(app)
+            routers.append(router)
+        return routers
+
+    def paths(self, cluster, count=20):
+        local, remote = [], []
+        for i in range(count):
+            path = '/test/%d-%s.txt' % (i, random_string(8).decode('utf-8'))
+            (local if cluster.is_local(path) else remote).append(path)
+        self.assertTrue(local and remote)
+        return local, remote
+
+    def test_redirect(self):
+        router_a, _ = self.start([self.url_a, self.url_b])
+        local, remote = self.paths(router_a.cluster)
+
+        status, headers, _ = self.client.request('PATCH', remote[0],
+                                                 body=b'abc')
+        self.assertEqual(status, 307)
+        self.assertEqual(dict(headers)['location'], self.url_b + remote[0])
+        self.assertEqual(self.client.request('PATCH', local[0],
+                                             body=b'abc')[0], 200)
+
+    def test_proxy(self):
+        router_a, _ = self.start([self.url_a, self.url_b], mode='proxy')
+        local, remote = self.paths(router_a.cluster)
+        content = random_string(1024 * 100)
+
+        for path in local + remote:
+            status, _, _ = self.client.request(
+                'PATCH', path, body=content, headers={'x-head-foo': 'bar'})
+            self.assertEqual(status, 200)
+
+        for path in remote:
+            self.assertFalse(os.path.exists(NAPFS_DATA_DIR + path))
+            with open(self.NODE_B_DATA_DIR + path, 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+        for path in local + remote:
+            status, headers, body = self.client.request('GET', path)
+            self.assertEqual(status, 200)
+            self.assertEqual(body, content)
+            headers = dict((k.lower(), v) for k, v in headers)
+            self.assertEqual(headers['x-parts'],
+                             '0-%d' % (len(content) - 1))
+            self.assertEqual(headers['x-head-foo'], 'bar')
+
+        status, _, _ = self.client.request('DELETE', remote[0])
+        self.assertEqual(status, 200)
+        self.assertEqual(self.client.request('GET', remote[0])[0], 404)
+
+    def test_rebalance(self):
+        self.start([self.url_a])
+        local, remote = self.paths(
+            napfs.Cluster([self.url_a, self.url_b], self.url_a))
+        for path in local + remote:
+            self.client.request('PATCH', path, body=b'a' * 10,
+                                headers={'x-head-foo': 'bar'})
+            self.client.request('PATCH', path + '?offset=20',
+                                body=b'b' * 10)
+
+        router_a, _ = self.start([self.url_a, self.url_b])
+        job = router_a.rebalance()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.progress['files'], len(remote))
+        self.assertEqual(job.progress['bytes'], len(remote) * 20)
+        self.assertTrue(os.path.isdir(NAPFS_DATA_DIR))
+
+        for path in local:
+            self.assertTrue(os.path.exists(NAPFS_DATA_DIR + path))
+            self.assertFalse(os.path.exists(self.NODE_B_DATA_DIR + path))
+        for path in remote:
+            self.assertFalse(os.path.exists(NAPFS_DATA_DIR + path))
+            self.assertFalse(
+                redis_connection.exists('P{%s}' % path))
+            status, headers, body = self.client.request('GET', path)
+            self.assertEqual(status, 307)
+            peer = napfs.Peer(self.url_b)
+            status, headers, body = peer.request('GET', path)
+            peer.close()
+            self.assertEqual(body, b'a' * 10)
+            headers = dict((k.lower(), v) for k, v in headers)
+            self.assertEqual(headers['x-parts'], '0-9,20-29')
+            self.assertEqual(headers['x-head-foo'], 'bar')
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, napfs.Cluster, [self.url_a],
+                          self.url_b)
+        self.assertRaises(ValueError, napfs.Cluster, [self.url_a],
+                          self.url_a, mode='nope')
+
+
+class TieringTest(unittest.TestCase):
+    COLD_DIR = '/tmp/test-napfs-cold'
+
+    def setUp(self):
+        self.tiering = napfs.Tiering(self.COLD_DIR, cold_after=3600,
+                                     interval=0)
+        self.metrics = napfs.Metrics()
+        self.app = create_app(tiering=self.tiering, metrics=self.metrics)
+        # as if the tracking had started long ago.
+        self.tiering.started -= 7200
+
+    def tearDown(self):
+        self.tiering.stop()
+        shutil.rmtree(self.COLD_DIR, ignore_errors=True)
+        clean()
+
+    def upload(self, content=b'abc'):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.patch(uri, params=content)
+        self.age(uri)
+        return uri
+
+    def age(self, uri):
+        old = time.time() - 7200
+        os.utime(NAPFS_DATA_DIR + uri, (old, old))
+        self.tiering._access[uri] = old
+
+    def wait_for_promotion(self):
+        for _ in range(500):
+            if not self.tiering.pending() and not self.tiering._queued:
+                return
+            time.sleep(0.01)
+
+    def test_demote_and_promote(self):
+        uri = self.upload()
+        fresh = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.patch(fresh, params=b'def')
+
+        job = self.tiering.demote_all()
+        self.assertEqual(job.progress['demoted'], 1)
+        self.assertFalse(os.path.exists(NAPFS_DATA_DIR + uri))
+        with open(self.COLD_DIR + uri, 'rb') as f:
+            self.assertEqual(f.read(), b'abc')
+        self.assertTrue(os.path.exists(NAPFS_DATA_DIR + fresh))
+
+        res = self.app.get(uri)
+        self.assertEqual(res.body, b'abc')
+        self.wait_for_promotion()
+        self.assertTrue(os.path.exists(NAPFS_DATA_DIR + uri))
+        self.assertFalse(os.path.exists(self.COLD_DIR + uri))
+        self.assertEqual(self.app.get(uri).body, b'abc')
+
+        # it was just read, so it stays put.
+        self.assertEqual(self.tiering.demote_all().progress['demoted'], 0)
+
+        body = self.app.get('/_metrics').text
+        self.assertIn('napfs_tiering_demoted_files_total 1', body)
+        self.assertIn('napfs_tiering_promoted_files_total 1', body)
+
+    def test_write_during_demote(self):
+        uri = self.upload()
+        move_file = napfs.tiering.move_file
+
+        def move(src, dst, check=None):
+            # a PATCH comes in while the file is being copied.
+            self.tiering.before_write(uri)
+            return move_file(src, dst, check)
+
+        with unittest.mock.patch('napfs.tiering.move_file', move):
+            self.assertFalse(self.tiering.demote(uri))
+        self.assertEqual(self.app.get(uri).body, b'abc')
+        self.assertFalse(os.path.exists(self.COLD_DIR + uri))
+        self.assertEqual(self.tiering._moving, {})
+
+    def test_no_promote(self):
+        self.tiering.promote_reads = False
+        uri = self.upload()
+        self.tiering.demote_all()
+        self.assertEqual(self.app.get(uri).body, b'abc')
+        self.assertEqual(self.app.get(uri, headers={'Range': 'bytes=1-'}
+                                      ).body, b'bc')
+        self.assertFalse(os.path.exists(NAPFS_DATA_DIR + uri))
+
+    def test_write_promotes(self):
+        uri = self.upload()
+        self.tiering.demote_all()
+        self.app.patch(uri + '?offset=3', params=b'def')
+        self.assertFalse(os.path.exists(self.COLD_DIR + uri))
+        self.assertEqual(self.app.get(uri).body, b'abcdef')
+
+    def test_replace_and_delete(self):
+        uri = self.upload()
+        self.tiering.demote_all()
+        self.app.post(uri, params=b'xyz')
+        self.assertFalse(os.path.exists(self.COLD_DIR + uri))
+        self.assertEqual(self.app.get(uri).body, b'xyz')
+
+        self.age(uri)
+        self.assertEqual(self.tiering.demote_all().progress['demoted'], 1)
+        self.app.delete(uri)
+        self.assertFalse(os.path.exists(self.COLD_DIR + uri))
+        self.app.get(uri, status=404)
+
+
+class CompletionTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(bulk_path='/_meta')
+
+    def tearDown(self):
+        clean()
+
+    def test_complete(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        content = random_string(1024 * 10)
+        offsets = list(range(0, len(content), 1024))
+        random.shuffle(offsets)
+        for i, offset in enumerate(offsets):
+            headers = {'x-total-length': str(len(content))} if i == 0 \
+                else {}
+            res = self.app.patch(uri + '?offset=%d' % offset,
+                                 params=content[offset:offset + 1024],
+                                 headers=headers)
+            self.assertEqual(res.headers['x-total-length'],
+                             str(len(content)))
+            if i < len(offsets) - 1:
+                self.assertNotIn('x-completed-at', res.headers)
+
+        self.assertIn('x-completed-at', res.headers)
+        self.assertEqual(res.headers['x-parts'], '0-%d' % (len(content) - 1))
+        members = redis_connection.smembers('P{%s}' % uri)
+        self.assertEqual(len(members), 2)
+        self.assertIn(('0-%d' % (len(content) - 1)).encode('utf-8'),
+                      members)
+
+        res = self.app.get(uri)
+        self.assertEqual(res.body, content)
+        self.assertIn('x-completed-at', res.headers)
+        res = self.app.get(uri, headers={'Range': 'bytes=100-'})
+        self.assertEqual(res.body, content[100:])
+        res = self.app.get(uri, headers={
+            'Range': 'bytes=100-%d' % (len(content) * 2)})
+        self.assertEqual(res.body, content[100:])
+        self.assertEqual(res.headers['content-range'],
+                         'bytes 100-%d/%d' % (len(content) - 1,
+                                              len(content)))
+
+        res = self.app.post('/_meta', params=json.dumps([uri]))
+        row = res.json['results'][0]
+        self.assertEqual(row['total_length'], len(content))
+        self.assertIsNotNone(row['completed_at'])
+
+    def test_incomplete(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        res = self.app.patch(uri, params=b'abc',
+                             headers={'x-total-length': '6'})
+        self.assertNotIn('x-completed-at', res.headers)
+        res = self.app.patch(uri + '?offset=4', params=b'ef')
+        self.assertNotIn('x-completed-at', res.headers)
+        self.assertEqual(self.app.get(uri).body, b'abc')
+        res = self.app.patch(uri + '?offset=3', params=b'd')
+        self.assertIn('x-completed-at', res.headers)
+        self.assertEqual(self.app.get(uri).body, b'abcdef')
+
+    def test_post(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        res = self.app.post(uri, params=b'abc')
+        self.assertEqual(res.headers['x-total-length'], '3')
+        self.assertIn('x-completed-at', res.headers)
+        res = self.app.get(uri)
+        self.assertEqual(res.body, b'abc')
+        self.assertEqual(res.headers['x-parts'], '0-2')
+
+    def test_invalid(self):
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        for value in ('abc', '-1'):
+            self.app.patch(uri, params=b'abc', status=400,
+                           headers={'x-total-length': value})
+        self.assertFalse(os.path.exists(NAPFS_DATA_DIR + uri))
+
+    def test_write_behind(self):
+        write_behind = napfs.WriteBehind(interval=60)
+        app = create_app(write_behind=write_behind)
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        app.patch(uri, params=b'abc', headers={'x-total-length': '6'})
+        app.patch(uri + '?offset=3', params=b'def')
+        write_behind.flush()
+        write_behind.stop()
+        data = napfs.data.MetaData(uri, db=redis_connection)
+        self.assertTrue(data.complete)
+        self.assertEqual(data.total_length, 6)
+
+
+class MediaTest(unittest.TestCase):
+    MEDIA_DIR = '/tmp/test-napfs-media'
+
+    def setUp(self):
+        self.media = napfs.MediaIndexes(self.MEDIA_DIR)
+        self.app = create_app(media=self.media)
+        with open(os.path.join(os.path.dirname(__file__) or '.',
+                               'sample-video.mp4'), 'rb') as f:
+            self.content = f.read()
+        self.uri = "/test/%s.mp4" % random_string(10).decode('utf-8')
+
+    def tearDown(self):
+        shutil.rmtree(self.MEDIA_DIR, ignore_errors=True)
+        clean()
+
+    def upload(self, chunk_size=16 * 1024):
+        total = {'x-total-length': str(len(self.content))}
+        for offset in range(0, len(self.content), chunk_size):
+            self.app.patch(self.uri + '?offset=%d' % offset,
+                           params=self.content[offset:offset + chunk_size],
+                           headers=total)
+
+    def index(self, content):
+        return build_index(io.BytesIO(content), len(content))
+
+    def test_index_on_complete(self):
+        index_path = self.media.get_local_path(self.uri)
+        self.app.patch(self.uri, params=self.content[:1024],
+                       headers={'x-total-length': str(len(self.content))})
+        self.assertFalse(os.path.exists(index_path))
+        self.app.get(self.uri + '?faststart', status=409)
+
+        self.app.patch(self.uri + '?offset=1024', params=self.content[1024:])
+        self.assertTrue(os.path.exists(index_path))
+        with open(index_path) as f:
+            index = json.load(f)
+        self.assertEqual([b[0] for b in index['boxes']],
+                         ['ftyp', 'free', 'mdat', 'moov'])
+        handlers = [t['handler'] for t in index['tracks']]
+        self.assertIn('vide', handlers)
+        self.assertIn('soun', handlers)
+
+        self.app.delete(self.uri)
+        self.assertFalse(os.path.exists(index_path))
+
+    def test_faststart(self):
+        self.upload()
+        res = self.app.get(self.uri + '?faststart')
+        body = res.body
+        self.assertEqual(len(body), len(self.content))
+        self.assertEqual(res.headers['content-type'], 'video/mp4')
+
+        before, after = self.index(self.content), self.index(body)
+        self.assertEqual([b[0] for b in after['boxes']],
+                         ['ftyp', 'free', 'moov', 'mdat'])
+        for old, new in zip(before['tracks'], after['tracks']):
+            self.assertEqual(len(old['chunks']), len(new['chunks']))
+            for (_, a), (_, b) in zip(old['chunks'], new['chunks']):
+                self.assertEqual(self.content[a:a + 64], body[b:b + 64])
+
+        res = self.app.get(self.uri + '?faststart',
+                           headers={'Range': 'bytes=30-4000'})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.body, body[30:4001])
+
+        # the plain file is still there as it was.
+        self.assertEqual(self.app.get(self.uri).body, self.content)
+
+    def test_seek(self):
+        self.upload()
+        faststart = self.app.get(self.uri + '?faststart').body
+
+        res = self.app.get(self.uri + '?t=1.0')
+        self.assertEqual(res.status_code, 206)
+        keyframe = float(res.headers['x-media-time'])
+        self.assertTrue(0 <= keyframe <= 1.0)
+        start = int(res.headers['content-range'].split(' ')[1].split('-')[0])
+        self.assertTrue(0 < start < len(self.content))
+        self.assertEqual(res.body, self.content[start:])
+
+        res = self.app.get(self.uri + '?faststart&t=1.0')
+        start = int(res.headers['content-range'].split(' ')[1].split('-')[0])
+        self.assertEqual(res.body, faststart[start:])
+        self.assertGreater(start, self.index(faststart)['moov'][0])
+
+        self.app.get(self.uri + '?t=abc', status=400)
+
+    def test_not_media(self):
+        self.app.post(self.uri, params=b'not really a video')
+        self.app.get(self.uri + '?faststart', status=404)
+        self.assertEqual(self.app.get(self.uri).body, b'not really a video')
+
+        uri = "/test/%s.txt" % random_string(10).decode('utf-8')
+        self.app.post(uri, params=b'abc')
+        self.assertEqual(self.app.get(uri + '?faststart').body, b'abc')
+        self.assertFalse(os.path.exists(self.media.get_local_path(uri)))
+
+
+class LockStatsTest(unittest.TestCase):
+    def setUp(self):
+        os.mkdir(NAPFS_DATA_DIR)
+        self.path = os.path.join(NAPFS_DATA_DIR, 'locked.txt')
+        lock_stats.reset()
+
+    def tearDown(self):
+        lock_stats.reset()
+        shutil.rmtree(NAPFS_DATA_DIR)
+
+    def test_uncontended(self):
+        write_file_chunk(self.path, io.BytesIO(b'abc'), 0, 3)
+        write_file_chunk(self.path, io.BytesIO(b'def'), 3, None)
+        stats = lock_stats.snapshot()
+        self.assertEqual(stats['writes'], 2)
+        self.assertEqual(stats['contended'], 0)
+        self.assertGreater(stats['write_seconds'], 0)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'abcdef')
+
+    def test_contended(self):
+        # flock locks belong to the open file, so another open of the file
+        # in this process is enough to hold up the writer.
+        open(self.path, 'wb').close()
+        with open(self.path, 'rb') as holder:
+            fcntl.flock(holder, fcntl.LOCK_EX)
+            writer = threading.Thread(target=write_file_chunk, args=(
+                self.path, io.BytesIO(b''), 0, 0))
+            writer.start()
+            time.sleep(0.2)
+            self.assertTrue(writer.is_alive())
+            fcntl.flock(holder, fcntl.LOCK_UN)
+            writer.join()
+
+        stats = lock_stats.snapshot()
+        self.assertEqual(stats['writes'], 1)
+        self.assertEqual(stats['contended'], 1)
+        self.assertGreaterEqual(stats['wait_seconds'], 0.1)
+        self.assertEqual(stats['max_wait_seconds'], stats['wait_seconds'])
+
+
+class FileSliceTest(unittest.TestCase):
+    def setUp(self):
+        os.mkdir(NAPFS_DATA_DIR)
+        self.path = os.path.join(NAPFS_DATA_DIR, 'slice.txt')
+        with open(self.path, 'wb') as f:
+            f.write(b'0123456789')
+
+    def tearDown(self):
+        shutil.rmtree(NAPFS_DATA_DIR)
+
+    def test(self):
+        with open(self.path, 'rb') as f:
+            body = file_slice(f, 2, 5)
+            self.assertEqual(body.length, 5)
+            self.assertEqual(body.read(3), b'234')
+            self.assertEqual(body.read(), b'56')
+            self.assertEqual(body.read(), b'')
+            body.seek(0)
+            self.assertEqual(body.read(100), b'23456')
+
+            # cut short where the file ends.
+            self.assertEqual(file_slice(f, 8, 5).read(), b'89')
+            self.assertEqual(file_slice(f).read(), b'0123456789')
+            self.assertEqual(file_slice(f, 20).length, 0)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)